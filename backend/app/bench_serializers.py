@@ -0,0 +1,122 @@
+"""一覧のレスポンスを作る 2 つの経路の速度比較。
+
+同じ医療機関の一覧 (メモリ上の ORM オブジェクト、DB は使わない) を
+
+- ``old``: ``response_model=List[schemas.MedicalFacility]`` で ORM を返す
+  (FastAPI が 1 行ずつ検証してから JSON にする、以前の経路)
+- ``new``: ``serializers.facility_dict`` の dict を ``FastJSONResponse`` で返す
+
+の 2 つのエンドポイントから取得し、所要時間の中央値を表示する。
+両者の JSON が同じであることも確かめる。
+
+例::
+
+    python -m backend.app.bench_serializers --facilities 2000 --functions 10
+"""
+
+import argparse
+import json
+import statistics
+import time
+from typing import List, Optional
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from . import models, schemas, serializers
+from .responses import FastJSONResponse
+
+
+def make_facilities(count: int, functions: int) -> List[models.MedicalFacility]:
+    funcs = [
+        models.Function(
+            id=i,
+            name=f"機能{i}",
+            description="説明" * 5,
+            memo=None,
+            selection_type="multiple",
+            choices=["あり", "なし", "要相談"],
+            category_id=1,
+            is_deleted=False,
+        )
+        for i in range(1, functions + 1)
+    ]
+    facilities = []
+    for i in range(1, count + 1):
+        fac = models.MedicalFacility(
+            id=i,
+            short_name=f"医療機関{i}",
+            official_name=f"医療法人 医療機関{i}",
+            prefecture="福岡県",
+            city="福岡市",
+            address_detail=f"中央区{i}-1",
+            phone_numbers=[{"value": "092-000-0000", "comment": "代表"}],
+            emails=[{"value": f"info{i}@example.jp", "comment": None}],
+            fax="092-000-0001",
+            remarks="備考",
+            is_deleted=False,
+        )
+        fac.functions = [
+            models.FacilityFunctionEntry(
+                id=i * functions + j,
+                selected_values=["あり"],
+                remarks=None,
+                function=f,
+            )
+            for j, f in enumerate(funcs)
+        ]
+        facilities.append(fac)
+    return facilities
+
+
+def make_app(facilities: List[models.MedicalFacility]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/old", response_model=List[schemas.MedicalFacility])
+    def old():
+        return facilities
+
+    @app.get("/new")
+    def new():
+        return FastJSONResponse([serializers.facility_dict(f) for f in facilities])
+
+    return app
+
+
+def run(facilities: int = 2000, functions: int = 10, repeat: int = 5) -> dict:
+    """各経路の所要時間の中央値 (ミリ秒) とレスポンスのバイト数を返す。"""
+    client = TestClient(make_app(make_facilities(facilities, functions)))
+    result = {}
+    bodies = {}
+    for path in ("old", "new"):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get(f"/{path}")
+            times.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+        bodies[path] = response.content
+        result[f"{path}_ms"] = statistics.median(times)
+        result[f"{path}_bytes"] = len(response.content)
+    if json.loads(bodies["old"]) != json.loads(bodies["new"]):
+        raise AssertionError("old and new responses differ")
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare list serialization paths.")
+    parser.add_argument("--facilities", type=int, default=2000)
+    parser.add_argument("--functions", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    result = run(args.facilities, args.functions, args.repeat)
+    print(
+        f"facilities={args.facilities} functions={args.functions} "
+        f"old={result['old_ms']:.1f}ms new={result['new_ms']:.1f}ms "
+        f"speedup={result['old_ms'] / result['new_ms']:.1f}x "
+        f"bytes={result['new_bytes']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,610 @@
+"""削除済みデータのアーカイブ。
+
+メモ・テンプレート・タグ・医療機関・機能は ``is_deleted`` による論理削除のため、
+削除済みの行が一覧のスキャンやインデックスに残り続ける。削除から
+``DELETED_ARCHIVE_DAYS`` 日 (既定 30 日) を過ぎた行を、履歴・タグの紐付け・
+画像・機能エントリとまとめて zlib 圧縮した JSON にし、``deleted_record_archive``
+へ移して元のテーブルから消す。
+
+- 画像の実データ (image_blobs) は参照数を残したまま保持し、参照を
+  ``archived_blob_refs`` に記録するため、アーカイブ中に画像 GC で消えることはない。
+- 他のメモ・テンプレート (履歴を含む) の本文が参照している画像は
+  ``note_images`` に残し (メモとの紐付けだけ外す)、復元時に紐付け直す。
+- 子メモを持つメモ、メモが残っている医療機関はアーカイブしない
+  (子メモ・メモが先にアーカイブされれば次の実行で対象になる)。
+- タグ・機能の紐付け先がアーカイブ済みの場合、紐付けは相手側の
+  アーカイブに移し、相手を復元したときに戻す。
+
+各 API の ``/restore`` はテーブルに無い場合にアーカイブから戻してから復元する。
+``deleted_at`` が無い頃に削除された行は、最初の実行時から日数を数える。
+
+例::
+
+    python -m backend.app.deleted_archive --days 30
+"""
+
+import argparse
+import base64
+import json
+import os
+import uuid
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import (
+    TIMESTAMP,
+    LargeBinary,
+    delete,
+    exists,
+    func,
+    insert,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models, phone_lookup, tag_usage, template_search
+from .database import SessionLocal
+
+ARCHIVE_DAYS = int(os.getenv("DELETED_ARCHIVE_DAYS", "30"))
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, memoryview)):
+        return base64.b64encode(bytes(value)).decode("ascii")
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _load_row(model, data: dict) -> dict:
+    """JSON にした行を列の型に合わせて戻す。"""
+    row = {}
+    for col in model.__table__.columns:
+        if col.name not in data:
+            continue
+        value = data[col.name]
+        if value is not None:
+            if isinstance(col.type, TIMESTAMP):
+                value = datetime.fromisoformat(value)
+            elif isinstance(col.type, LargeBinary):
+                value = base64.b64decode(value)
+            elif isinstance(col.type, PG_UUID):
+                value = uuid.UUID(value)
+        row[col.name] = value
+    return row
+
+
+def encode(payload: dict) -> bytes:
+    return zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+
+def decode(data: bytes) -> dict:
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def _rows(db, model, where) -> List[dict]:
+    return [
+        {k: _dump_value(v) for k, v in r._mapping.items()}
+        for r in db.execute(select(model.__table__).where(where))
+    ]
+
+
+def _grouped(db, model, owner: str, ids: List[int]) -> Dict[int, List[dict]]:
+    grouped: Dict[int, List[dict]] = {}
+    for row in _rows(db, model, getattr(model, owner).in_(ids)):
+        grouped.setdefault(row[owner], []).append(row)
+    return grouped
+
+
+def _insert(db, model, rows: Iterable[dict]) -> None:
+    rows = [_load_row(model, r) for r in rows]
+    if rows:
+        db.execute(insert(model.__table__), rows)
+
+
+def _existing_ids(db, model, ids: Iterable[int]) -> set:
+    ids = {i for i in ids if i is not None}
+    if not ids:
+        return set()
+    return set(db.execute(select(model.id).where(model.id.in_(ids))).scalars())
+
+
+def _hand_off(db, kind: str, record_id: int, key: str, items: List) -> None:
+    """紐付けをアーカイブ済みの相手側のデータに移す。"""
+    archive = models.DeletedRecordArchive
+    row = db.execute(
+        select(archive)
+        .where(archive.kind == kind, archive.record_id == record_id)
+        .with_for_update()
+    ).scalar_one_or_none()
+    if row is None:
+        return
+    payload = decode(row.payload)
+    payload.setdefault(key, []).extend(items)
+    row.payload = encode(payload)
+
+
+def _require(db, model, record_id: Optional[int], detail: str) -> None:
+    if record_id is not None and not _existing_ids(db, model, [record_id]):
+        raise HTTPException(status_code=409, detail=detail)
+
+
+# --- メモ -----------------------------------------------------------------
+
+
+def _referenced_elsewhere(db: Session, image_ids: List[str], memo_ids: List[int]) -> set:
+    """``memo_ids`` 以外のメモ・テンプレートの本文・履歴が参照している画像 ID。"""
+    if not image_ids:
+        return set()
+    params = {"pattern": f"({'|'.join(image_ids)})", "memo_ids": memo_ids}
+    extract = "lower((regexp_matches(content, :pattern, 'gi'))[1])"
+    rows = db.execute(
+        text(
+            f"SELECT {extract} FROM facility_memos WHERE NOT (id = ANY(:memo_ids)) "
+            f"UNION SELECT {extract} FROM facility_memo_versions "
+            "WHERE NOT (memo_id = ANY(:memo_ids)) "
+            f"UNION SELECT {extract} FROM memo_templates "
+            f"UNION SELECT {extract} FROM memo_template_versions"
+        ),
+        params,
+    )
+    return {r[0] for r in rows}
+
+
+def _archive_memos(db: Session, ids: List[int]) -> Dict[int, dict]:
+    memo = models.FacilityMemo
+    link = models.FacilityMemoTagLink
+    image = models.NoteImage
+    versions = _grouped(db, models.FacilityMemoVersion, "memo_id", ids)
+    images = _grouped(db, image, "memo_id", ids)
+    kept = _referenced_elsewhere(
+        db, [r["id"] for rows in images.values() for r in rows], ids
+    )
+    kept_ids = {
+        memo_id: [r["id"] for r in rows if r["id"] in kept] for memo_id, rows in images.items()
+    }
+    images = {
+        memo_id: [r for r in rows if r["id"] not in kept] for memo_id, rows in images.items()
+    }
+    tag_ids: Dict[int, List[int]] = {}
+    for memo_id, tag_id in db.execute(
+        select(link.memo_id, link.tag_id).where(link.memo_id.in_(ids))
+    ):
+        tag_ids.setdefault(memo_id, []).append(tag_id)
+    payloads = {
+        r["id"]: {
+            "memo": r,
+            "versions": versions.get(r["id"], []),
+            "tag_ids": tag_ids.get(r["id"], []),
+            "images": images.get(r["id"], []),
+            "kept_image_ids": kept_ids.get(r["id"], []),
+        }
+        for r in _rows(db, memo, memo.id.in_(ids))
+    }
+    deltas: Dict[int, Dict[str, int]] = {}
+    for tags in tag_ids.values():
+        for tag_id in tags:
+            deltas.setdefault(tag_id, {"deleted_memos": 0})["deleted_memos"] -= 1
+    tag_usage.adjust(db, deltas)
+    refs = [
+        {"image_id": r["id"], "memo_id": memo_id, "blob_hash": r["blob_hash"]}
+        for memo_id, rows in images.items()
+        for r in rows
+        if r["blob_hash"] is not None
+    ]
+    _insert(db, models.ArchivedBlobRef, refs)
+    if kept:
+        # メモの削除で消えないように紐付けだけ外す
+        db.execute(
+            update(image)
+            .where(image.id.in_([uuid.UUID(i) for i in kept]))
+            .values(memo_id=None)
+        )
+    image_ids = select(image.id).where(image.memo_id.in_(ids))
+    mark = models.NoteImageGcMark
+    db.execute(delete(mark).where(mark.image_id.in_(image_ids)))
+    db.execute(delete(image).where(image.memo_id.in_(ids)))
+    db.execute(delete(models.FacilityMemoLock).where(models.FacilityMemoLock.memo_id.in_(ids)))
+    db.execute(delete(link).where(link.memo_id.in_(ids)))
+    version = models.FacilityMemoVersion
+    db.execute(delete(version).where(version.memo_id.in_(ids)))
+    db.execute(delete(memo).where(memo.id.in_(ids)))
+    return payloads
+
+
+def _restorable_images(db: Session, images: List[dict]) -> List[dict]:
+    """実データが残っている画像だけを返す。
+
+    ``archived_blob_refs`` が無かった頃のアーカイブでは、画像 GC で blob が
+    消えている場合がある。
+    """
+    hashes = {i["blob_hash"] for i in images if i.get("blob_hash")}
+    blob = models.ImageBlob
+    live = (
+        set(db.execute(select(blob.sha256).where(blob.sha256.in_(hashes))).scalars())
+        if hashes
+        else set()
+    )
+    return [i for i in images if not i.get("blob_hash") or i["blob_hash"] in live]
+
+
+def backfill_blob_refs(db: Session) -> int:
+    """既存のメモのアーカイブから ``archived_blob_refs`` を作り、件数を返す。"""
+    archive = models.DeletedRecordArchive
+    ref = models.ArchivedBlobRef
+    total = 0
+    for record_id, data in db.execute(
+        select(archive.record_id, archive.payload).where(archive.kind == MEMO)
+    ).all():
+        images = _restorable_images(db, decode(data).get("images", []))
+        refs = [
+            _load_row(
+                ref, {"image_id": i["id"], "memo_id": record_id, "blob_hash": i["blob_hash"]}
+            )
+            for i in images
+            if i.get("blob_hash")
+        ]
+        if refs:
+            db.execute(pg_insert(ref.__table__).on_conflict_do_nothing(), refs)
+            total += len(refs)
+    db.commit()
+    return total
+
+
+def _restore_memo(db: Session, memo_id: int, payload: dict) -> None:
+    row = payload["memo"]
+    _require(db, models.MedicalFacility, row.get("facility_id"), "Facility is archived")
+    _require(db, models.FacilityMemo, row.get("parent_id"), "Parent memo is archived")
+    _insert(db, models.FacilityMemo, [row])
+    _insert(db, models.FacilityMemoVersion, payload["versions"])
+    _insert(db, models.NoteImage, _restorable_images(db, payload["images"]))
+    kept = [uuid.UUID(i) for i in payload.get("kept_image_ids", [])]
+    if kept:
+        image = models.NoteImage
+        db.execute(
+            update(image)
+            .where(image.id.in_(kept), image.memo_id.is_(None))
+            .values(memo_id=memo_id)
+        )
+    ref = models.ArchivedBlobRef
+    db.execute(delete(ref).where(ref.memo_id == memo_id))
+    live = _existing_ids(db, models.MemoTag, payload["tag_ids"])
+    _insert(db, models.FacilityMemoTagLink, [{"memo_id": memo_id, "tag_id": t} for t in live])
+    for tag_id in set(payload["tag_ids"]) - live:
+        _hand_off(db, TAG, tag_id, "memo_ids", [memo_id])
+    tag_usage.memo_tags_changed(db, [], live, deleted=True)
+
+
+# --- テンプレート -------------------------------------------------------------
+
+
+def _archive_templates(db: Session, ids: List[int]) -> Dict[int, dict]:
+    tpl = models.MemoTemplate
+    link = models.MemoTemplateTagLink
+    versions = _grouped(db, models.MemoTemplateVersion, "template_id", ids)
+    tag_ids: Dict[int, List[int]] = {}
+    for template_id, tag_id in db.execute(
+        select(link.template_id, link.tag_id).where(link.template_id.in_(ids))
+    ):
+        tag_ids.setdefault(template_id, []).append(tag_id)
+    payloads = {
+        r["id"]: {
+            "template": r,
+            "versions": versions.get(r["id"], []),
+            "tag_ids": tag_ids.get(r["id"], []),
+        }
+        for r in _rows(db, tpl, tpl.id.in_(ids))
+    }
+    # 削除済みテンプレートは使用件数に含まれないため件数の調整は不要
+    dependents = (
+        models.MemoTemplateSearch,
+        models.MemoTemplateLock,
+        link,
+        models.MemoTemplateVersion,
+    )
+    for model in dependents:
+        db.execute(delete(model).where(model.template_id.in_(ids)))
+    db.execute(delete(tpl).where(tpl.id.in_(ids)))
+    return payloads
+
+
+def _restore_template(db: Session, template_id: int, payload: dict) -> None:
+    _insert(db, models.MemoTemplate, [payload["template"]])
+    _insert(db, models.MemoTemplateVersion, payload["versions"])
+    live = _existing_ids(db, models.MemoTag, payload["tag_ids"])
+    _insert(
+        db,
+        models.MemoTemplateTagLink,
+        [{"template_id": template_id, "tag_id": t} for t in live],
+    )
+    for tag_id in set(payload["tag_ids"]) - live:
+        _hand_off(db, TAG, tag_id, "template_ids", [template_id])
+    template_search.refresh(db, [template_id])
+
+
+# --- タグ -------------------------------------------------------------------
+
+
+def _archive_tags(db: Session, ids: List[int]) -> Dict[int, dict]:
+    tag = models.MemoTag
+    memo_link = models.FacilityMemoTagLink
+    tpl_link = models.MemoTemplateTagLink
+    memo_ids: Dict[int, List[int]] = {}
+    for tag_id, memo_id in db.execute(
+        select(memo_link.tag_id, memo_link.memo_id).where(memo_link.tag_id.in_(ids))
+    ):
+        memo_ids.setdefault(tag_id, []).append(memo_id)
+    template_ids: Dict[int, List[int]] = {}
+    for tag_id, template_id in db.execute(
+        select(tpl_link.tag_id, tpl_link.template_id).where(tpl_link.tag_id.in_(ids))
+    ):
+        template_ids.setdefault(tag_id, []).append(template_id)
+    payloads = {
+        r["id"]: {
+            "tag": r,
+            "memo_ids": memo_ids.get(r["id"], []),
+            "template_ids": template_ids.get(r["id"], []),
+        }
+        for r in _rows(db, tag, tag.id.in_(ids))
+    }
+    db.execute(delete(memo_link).where(memo_link.tag_id.in_(ids)))
+    db.execute(delete(tpl_link).where(tpl_link.tag_id.in_(ids)))
+    db.execute(delete(models.MemoTagUsage).where(models.MemoTagUsage.tag_id.in_(ids)))
+    db.execute(delete(tag).where(tag.id.in_(ids)))
+    # タグ名はテンプレートの検索用文書に含まれる
+    template_search.refresh(db, {t for tpls in template_ids.values() for t in tpls})
+    return payloads
+
+
+def _restore_tag(db: Session, tag_id: int, payload: dict) -> None:
+    _insert(db, models.MemoTag, [payload["tag"]])
+    memos = _existing_ids(db, models.FacilityMemo, payload["memo_ids"])
+    _insert(
+        db, models.FacilityMemoTagLink, [{"memo_id": m, "tag_id": tag_id} for m in memos]
+    )
+    for memo_id in set(payload["memo_ids"]) - memos:
+        _hand_off(db, MEMO, memo_id, "tag_ids", [tag_id])
+    templates = _existing_ids(db, models.MemoTemplate, payload["template_ids"])
+    _insert(
+        db,
+        models.MemoTemplateTagLink,
+        [{"template_id": t, "tag_id": tag_id} for t in templates],
+    )
+    for template_id in set(payload["template_ids"]) - templates:
+        _hand_off(db, TEMPLATE, template_id, "tag_ids", [tag_id])
+    tag_usage.recount(db, [tag_id])
+    template_search.refresh(db, templates)
+
+
+# --- 医療機関・機能 ----------------------------------------------------------------
+
+
+def _archive_with_entries(db: Session, model, key: str, owner: str, ids: List[int]):
+    entry = models.FacilityFunctionEntry
+    entries = _grouped(db, entry, owner, ids)
+    payloads = {
+        r["id"]: {key: r, "entries": entries.get(r["id"], [])}
+        for r in _rows(db, model, model.id.in_(ids))
+    }
+    db.execute(delete(entry).where(getattr(entry, owner).in_(ids)))
+    return payloads
+
+
+def _archive_facilities(db: Session, ids: List[int]) -> Dict[int, dict]:
+    fac = models.MedicalFacility
+    payloads = _archive_with_entries(db, fac, "facility", "facility_id", ids)
+    phone = models.FacilityPhoneNumber
+    db.execute(delete(phone).where(phone.facility_id.in_(ids)))
+    db.execute(delete(fac).where(fac.id.in_(ids)))
+    return payloads
+
+
+def _archive_functions(db: Session, ids: List[int]) -> Dict[int, dict]:
+    fn = models.Function
+    payloads = _archive_with_entries(db, fn, "function", "function_id", ids)
+    db.execute(delete(fn).where(fn.id.in_(ids)))
+    return payloads
+
+
+def _restore_entries(
+    db: Session, entries: List[dict], other: str, other_model, other_kind: str
+) -> None:
+    """相手側 (医療機関または機能) が残っている機能エントリだけを戻す。"""
+    live = _existing_ids(db, other_model, (e[other] for e in entries))
+    _insert(db, models.FacilityFunctionEntry, [e for e in entries if e[other] in live])
+    moved: Dict[int, List[dict]] = {}
+    for e in entries:
+        if e[other] is not None and e[other] not in live:
+            moved.setdefault(e[other], []).append(e)
+    for other_id, items in moved.items():
+        _hand_off(db, other_kind, other_id, "entries", items)
+
+
+def _restore_facility(db: Session, facility_id: int, payload: dict) -> None:
+    _insert(db, models.MedicalFacility, [payload["facility"]])
+    _restore_entries(db, payload["entries"], "function_id", models.Function, FUNCTION)
+    phone_lookup.sync(db, [db.get(models.MedicalFacility, facility_id)])
+
+
+def _restore_function(db: Session, function_id: int, payload: dict) -> None:
+    _insert(db, models.Function, [payload["function"]])
+    _restore_entries(db, payload["entries"], "facility_id", models.MedicalFacility, FACILITY)
+
+
+# --------------------------------------------------------------------------
+
+
+@dataclass(frozen=True)
+class ArchiveKind:
+    name: str
+    model: type
+    label: str  # 一覧表示に使う列
+    not_found: str  # 見つからない場合の 404 の detail
+    archive: Callable[[Session, List[int]], Dict[int, dict]]
+    restore: Callable[[Session, int, dict], None]
+    # アーカイブできる行の追加条件
+    eligible: Optional[Callable[[], object]] = None
+
+
+MEMO, TEMPLATE, TAG, FACILITY, FUNCTION = "memo", "template", "tag", "facility", "function"
+
+
+def _memo_is_leaf():
+    child = models.FacilityMemo.__table__.alias("child")
+    return ~exists().where(child.c.parent_id == models.FacilityMemo.id)
+
+
+def _facility_has_no_memos():
+    return ~exists().where(models.FacilityMemo.facility_id == models.MedicalFacility.id)
+
+
+# メモを先に処理し、メモが無くなった医療機関を同じ実行で対象にする
+KINDS = {
+    k.name: k
+    for k in (
+        ArchiveKind(
+            MEMO,
+            models.FacilityMemo,
+            "title",
+            "Memo not found",
+            _archive_memos,
+            _restore_memo,
+            _memo_is_leaf,
+        ),
+        ArchiveKind(
+            TEMPLATE,
+            models.MemoTemplate,
+            "name",
+            "Template not found",
+            _archive_templates,
+            _restore_template,
+        ),
+        ArchiveKind(TAG, models.MemoTag, "name", "Tag not found", _archive_tags, _restore_tag),
+        ArchiveKind(
+            FACILITY,
+            models.MedicalFacility,
+            "short_name",
+            "Facility not found",
+            _archive_facilities,
+            _restore_facility,
+            _facility_has_no_memos,
+        ),
+        ArchiveKind(
+            FUNCTION,
+            models.Function,
+            "name",
+            "Function not found",
+            _archive_functions,
+            _restore_function,
+        ),
+    )
+}
+
+
+def archive_deleted(
+    db: Session, kind: ArchiveKind, days: int = ARCHIVE_DAYS, batch_size: int = 200
+) -> int:
+    """削除から ``days`` 日を過ぎた行をアーカイブへ移し、件数を返す。
+
+    ``batch_size`` 件ごとにコミットする。
+    """
+    model = kind.model
+    db.execute(
+        update(model)
+        .where(model.is_deleted == True, model.deleted_at.is_(None))
+        .values(deleted_at=func.now())
+    )
+    db.commit()
+    archive = models.DeletedRecordArchive
+    total = 0
+    while True:
+        query = select(model.id, getattr(model, kind.label), model.deleted_at).where(
+            model.is_deleted == True,
+            model.deleted_at < func.now() - timedelta(days=days),
+        )
+        if kind.eligible is not None:
+            query = query.where(kind.eligible())
+        rows = db.execute(query.order_by(model.id).limit(batch_size)).all()
+        if not rows:
+            break
+        payloads = kind.archive(db, [r[0] for r in rows])
+        db.execute(
+            insert(archive.__table__),
+            [
+                {
+                    "kind": kind.name,
+                    "record_id": record_id,
+                    "label": label,
+                    "deleted_at": deleted_at,
+                    "payload": encode(payloads[record_id]),
+                }
+                for record_id, label, deleted_at in rows
+            ],
+        )
+        db.commit()
+        total += len(rows)
+    return total
+
+
+def restore(db: Session, kind_name: str, record_id: int):
+    """アーカイブから行を戻し、削除済みのままの ORM オブジェクトを返す。
+
+    コミットは呼び出し側。アーカイブにも無ければ 404 を返す。
+    """
+    kind = KINDS[kind_name]
+    archive = models.DeletedRecordArchive
+    row = db.execute(
+        select(archive)
+        .where(archive.kind == kind.name, archive.record_id == record_id)
+        .with_for_update()
+    ).scalar_one_or_none()
+    if row is None:
+        raise HTTPException(status_code=404, detail=kind.not_found)
+    payload = decode(row.payload)
+    db.execute(
+        delete(archive).where(archive.kind == kind.name, archive.record_id == record_id)
+    )
+    kind.restore(db, record_id, payload)
+    db.flush()
+    return db.get(kind.model, record_id)
+
+
+def archived_records(
+    db: Session, kind: Optional[str] = None, skip: int = 0, limit: int = 100
+) -> List[dict]:
+    archive = models.DeletedRecordArchive
+    query = select(
+        archive.kind, archive.record_id, archive.label, archive.deleted_at, archive.archived_at
+    )
+    if kind:
+        query = query.where(archive.kind == kind)
+    query = query.order_by(archive.archived_at.desc(), archive.kind, archive.record_id)
+    return [dict(r._mapping) for r in db.execute(query.offset(skip).limit(limit))]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Archive soft-deleted records.")
+    parser.add_argument("--days", type=int, default=ARCHIVE_DAYS)
+    parser.add_argument("--kind", choices=list(KINDS), action="append")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        for name in args.kind or list(KINDS):
+            count = archive_deleted(db, KINDS[name], args.days, args.batch_size)
+            print(f"{name}: archived {count}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
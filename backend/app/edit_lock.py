@@ -0,0 +1,123 @@
+"""メモ・テンプレートの編集ロック (期限付きのリース)。
+
+ロックの取得は 1 文の ``INSERT ... ON CONFLICT DO UPDATE ... WHERE`` で行い、
+ロックが無い・期限切れ・自分が保持している場合だけ書き込む。他のユーザーが
+期限内のロックを持っている場合は何も更新されず (RETURNING が空)、409 を返す。
+編集中のクライアントは ``heartbeat`` で期限を延ばす。
+"""
+
+import os
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import models
+
+LOCK_TIMEOUT = timedelta(seconds=int(os.getenv("EDIT_LOCK_TIMEOUT", "300")))
+
+
+@dataclass(frozen=True)
+class LockTable:
+    model: type
+    owner: str  # ロック対象を指す列名 (memo_id / template_id)
+    not_found: str  # 対象が存在しない場合の 404 の detail
+
+    @property
+    def table(self):
+        return self.model.__table__
+
+    @property
+    def owner_col(self):
+        return self.table.c[self.owner]
+
+
+MEMO = LockTable(models.FacilityMemoLock, "memo_id", "Memo not found")
+TEMPLATE = LockTable(models.MemoTemplateLock, "template_id", "Template not found")
+
+
+def _active():
+    return func.now() - LOCK_TIMEOUT
+
+
+def lock_dict(row) -> dict:
+    data = dict(row._mapping)
+    locked_at = data.get("locked_at")
+    data["expires_at"] = locked_at + LOCK_TIMEOUT if locked_at else None
+    return data
+
+
+def acquire(db: Session, kind: LockTable, owner_id: int, user: str, ip: Optional[str]) -> dict:
+    t = kind.table
+    stmt = pg_insert(t).values(
+        {kind.owner: owner_id, "locked_by": user, "locked_at": func.now(), "ip_address": ip}
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[kind.owner],
+        set_={
+            "locked_by": stmt.excluded.locked_by,
+            "locked_at": stmt.excluded.locked_at,
+            "ip_address": stmt.excluded.ip_address,
+        },
+        # 自分のロック・期限切れのロックだけを奪う
+        where=or_(
+            t.c.locked_by == stmt.excluded.locked_by,
+            t.c.locked_at.is_(None),
+            t.c.locked_at <= _active(),
+        ),
+    ).returning(*t.c)
+    try:
+        row = db.execute(stmt).first()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=kind.not_found)
+    if row is None:
+        # 取得できなかった場合だけ保持者を読む
+        holder = db.execute(select(t).where(kind.owner_col == owner_id)).first()
+        db.rollback()
+        if holder is None:
+            raise HTTPException(status_code=409, detail="locked")
+        raise HTTPException(
+            status_code=409, detail=f"locked by {holder.locked_by} ({holder.ip_address})"
+        )
+    db.commit()
+    return lock_dict(row)
+
+
+def heartbeat(db: Session, kind: LockTable, owner_id: int, user: str) -> dict:
+    """保持中のロックの期限を延ばす。失っていれば 409 を返す。"""
+    t = kind.table
+    row = db.execute(
+        update(t)
+        .where(kind.owner_col == owner_id, t.c.locked_by == user)
+        .values(locked_at=func.now())
+        .returning(*t.c)
+    ).first()
+    if row is None:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="lock lost")
+    db.commit()
+    return lock_dict(row)
+
+
+def release(db: Session, kind: LockTable, owner_id: int, user: str) -> None:
+    t = kind.table
+    db.execute(delete(t).where(kind.owner_col == owner_id, t.c.locked_by == user))
+    db.commit()
+
+
+def get(db: Session, kind: LockTable, owner_id: int) -> Optional[dict]:
+    row = db.execute(select(kind.table).where(kind.owner_col == owner_id)).first()
+    return lock_dict(row) if row else None
+
+
+def active_locks(db: Session, kind: LockTable, *where) -> List[dict]:
+    """期限内のロックを 1 回の問い合わせで返す (``where`` は対象テーブルとの結合条件)。"""
+    t = kind.table
+    query = select(t).where(t.c.locked_at > _active(), *where).order_by(kind.owner_col)
+    return [lock_dict(row) for row in db.execute(query)]
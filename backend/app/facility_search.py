@@ -0,0 +1,261 @@
+"""医療機関の名称・住所検索。
+
+検索語と対象は ``search_text.normalize`` で正規化して比較する。
+
+入力補完向けに、各項目の前方一致をプロセス内のソート済みインデックス
+(``PrefixIndex``) で引き、足りない分を DB の部分一致で補う。DB 側は
+同じ正規化を SQL 式で表し、その式に pg_trgm の GIN インデックスを張る
+(``python -m backend.app.facility_search --create-index``)。trigram が
+使えない ``MIN_DB_QUERY_LENGTH`` 文字未満の検索語では部分一致を引かない。
+
+プロセス内インデックスは医療機関の登録・更新・削除のたびに該当行だけ
+更新する。ワーカーで実行した CSV 取り込み・同期のジョブは
+``FACILITY_INDEX_CHECK_INTERVAL`` 秒ごとに ``jobs`` を見て検知し、
+開始・終了していれば作り直す。それ以外の他プロセスの更新は
+``FACILITY_INDEX_TTL`` 秒ごとにバックグラウンドで作り直して反映する。
+"""
+
+import argparse
+import bisect
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+from .search_text import contains, literal, normalize, sql_normalize
+
+INDEX_TTL = float(os.getenv("FACILITY_INDEX_TTL", "300"))
+CHECK_INTERVAL = float(os.getenv("FACILITY_INDEX_CHECK_INTERVAL", "5"))
+MIN_DB_QUERY_LENGTH = 3
+# medical_facility を書き換えるジョブ
+FACILITY_JOBS = ("import_facilities_csv", "sync_facilities_csv")
+
+FIELDS = ("short_name", "official_name", "prefecture", "city", "address_detail")
+
+
+def search_expression():
+    """全項目を連結して正規化した SQL 式 (trigram インデックスの対象)。"""
+    fac = models.MedicalFacility
+    joined = None
+    for name in FIELDS:
+        col = func.coalesce(getattr(fac, name), literal(""))
+        joined = col if joined is None else joined.op("||")(literal("|")).op("||")(col)
+    return sql_normalize(joined)
+
+
+def create_index(db: Session) -> None:
+    """pg_trgm 拡張と検索式の GIN インデックスを作成する。"""
+    expr = search_expression().compile(
+        dialect=db.get_bind().dialect, compile_kwargs={"literal_binds": True}
+    )
+    db.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    db.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_medical_facility_search_trgm "
+            f"ON medical_facility USING gin (({expr}) gin_trgm_ops)"
+        )
+    )
+    db.commit()
+
+
+@dataclass
+class SearchHit:
+    id: int
+    short_name: str
+    official_name: Optional[str]
+    prefecture: Optional[str]
+    city: Optional[str]
+    address_detail: Optional[str]
+
+    def to_dict(self) -> dict:
+        return self.__dict__.copy()
+
+
+def _index_keys(hit: SearchHit) -> List[str]:
+    keys = [
+        normalize(hit.short_name),
+        normalize(hit.official_name),
+        normalize(hit.prefecture),
+        normalize(hit.city),
+        normalize(hit.address_detail),
+        # 「福岡県福岡市」「福岡市5-18」のような住所の続け打ち
+        normalize((hit.prefecture or "") + (hit.city or "") + (hit.address_detail or "")),
+        normalize((hit.city or "") + (hit.address_detail or "")),
+    ]
+    return sorted({k for k in keys if k})
+
+
+class PrefixIndex:
+    """正規化したキーのソート済みリストによる前方一致インデックス。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: List[Tuple[str, int]] = []
+        self._hits: Dict[int, SearchHit] = {}
+        self._by_id: Dict[int, List[str]] = {}
+        self.built_at: Optional[float] = None
+        self._rebuilding = False
+        self._rebuild_lock = threading.Lock()
+        self._jobs_stamp = None
+        self._checked_at = 0.0
+
+    def _load(self, db: Session):
+        fac = models.MedicalFacility
+        rows = db.query(fac.id, *(getattr(fac, name) for name in FIELDS)).filter(
+            fac.is_deleted == False
+        )
+        hits = {r.id: SearchHit(*r) for r in rows}
+        by_id = {i: _index_keys(h) for i, h in hits.items()}
+        keys = sorted((k, i) for i, ks in by_id.items() for k in ks)
+        return keys, hits, by_id
+
+    @staticmethod
+    def _facility_jobs_stamp(db: Session):
+        """CSV 取り込み・同期のジョブが最後に開始または終了した時刻。"""
+        job = models.Job
+        return db.execute(
+            select(func.max(func.coalesce(job.finished_at, job.started_at))).where(
+                job.kind.in_(FACILITY_JOBS)
+            )
+        ).scalar()
+
+    def rebuild(self, db: Session) -> None:
+        # 読み込み中に始まったジョブは次の確認で検知できるよう先に記録する
+        stamp = self._facility_jobs_stamp(db)
+        keys, hits, by_id = self._load(db)
+        with self._lock:
+            self._keys, self._hits, self._by_id = keys, hits, by_id
+            self._jobs_stamp = stamp
+            self.built_at = time.monotonic()
+            self._checked_at = self.built_at
+
+    def _rebuild_in_background(self) -> None:
+        db = SessionLocal()
+        try:
+            self.rebuild(db)
+        finally:
+            db.close()
+            self._rebuilding = False
+
+    def _rebuild_if(self, db: Session, stale) -> None:
+        with self._rebuild_lock:
+            # 待っている間に他のスレッドが作り直していれば何もしない
+            if stale():
+                self.rebuild(db)
+
+    def ensure_fresh(self, db: Session) -> None:
+        """未構築なら構築し、CSV のジョブが動いていれば作り直す。
+
+        TTL を過ぎていればバックグラウンドで作り直す。
+        """
+        if self.built_at is None:
+            self._rebuild_if(db, lambda: self.built_at is None)
+            return
+        now = time.monotonic()
+        if now - self._checked_at > CHECK_INTERVAL:
+            self._checked_at = now
+            stamp = self._facility_jobs_stamp(db)
+            if stamp != self._jobs_stamp:
+                self._rebuild_if(db, lambda: self._facility_jobs_stamp(db) != self._jobs_stamp)
+                return
+        if now - self.built_at > INDEX_TTL and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _remove_locked(self, facility_id: int) -> None:
+        for key in self._by_id.pop(facility_id, []):
+            pos = bisect.bisect_left(self._keys, (key, facility_id))
+            if pos < len(self._keys) and self._keys[pos] == (key, facility_id):
+                del self._keys[pos]
+        self._hits.pop(facility_id, None)
+
+    def update(self, fac: models.MedicalFacility) -> None:
+        """登録・更新・削除・復元した医療機関を反映する。"""
+        if self.built_at is None:
+            return
+        with self._lock:
+            self._remove_locked(fac.id)
+            if fac.is_deleted:
+                return
+            hit = SearchHit(fac.id, *(getattr(fac, name) for name in FIELDS))
+            keys = _index_keys(hit)
+            for key in keys:
+                bisect.insort(self._keys, (key, fac.id))
+            self._hits[fac.id] = hit
+            self._by_id[fac.id] = keys
+
+    def search(self, prefix: str, limit: int) -> List[SearchHit]:
+        results: List[SearchHit] = []
+        seen = set()
+        with self._lock:
+            pos = bisect.bisect_left(self._keys, (prefix, 0))
+            while pos < len(self._keys) and len(results) < limit:
+                key, facility_id = self._keys[pos]
+                if not key.startswith(prefix):
+                    break
+                if facility_id not in seen:
+                    seen.add(facility_id)
+                    results.append(self._hits[facility_id])
+                pos += 1
+        return results
+
+
+index = PrefixIndex()
+
+
+def _search_db(db: Session, query: str, limit: int, exclude) -> List[SearchHit]:
+    fac = models.MedicalFacility
+    expr = search_expression()
+    name = sql_normalize(fac.short_name)
+    rows = db.query(fac.id, *(getattr(fac, f) for f in FIELDS)).filter(
+        fac.is_deleted == False, contains(expr, query)
+    )
+    if exclude:
+        rows = rows.filter(fac.id.notin_(exclude))
+    rows = (
+        rows.order_by(
+            (func.strpos(name, query) == 1).desc(),
+            func.length(fac.short_name),
+            fac.id,
+        )
+        .limit(limit)
+    )
+    return [SearchHit(*r) for r in rows]
+
+
+def search(db: Session, query: str, limit: int = 20) -> List[SearchHit]:
+    """前方一致を優先し、足りない分を部分一致で補う。"""
+    normalized = normalize(query)
+    if not normalized:
+        return []
+    index.ensure_fresh(db)
+    hits = index.search(normalized, limit)
+    # 2 文字以下の部分一致は trigram インデックスが効かず全件走査になる
+    if len(hits) < limit and len(normalized) >= MIN_DB_QUERY_LENGTH:
+        hits += _search_db(db, normalized, limit - len(hits), [h.id for h in hits])
+    return hits
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Facility search utilities.")
+    parser.add_argument(
+        "--create-index", action="store_true", help="create the pg_trgm index"
+    )
+    args = parser.parse_args(argv)
+    if args.create_index:
+        db = SessionLocal()
+        try:
+            create_index(db)
+        finally:
+            db.close()
+        print("created ix_medical_facility_search_trgm")
+
+
+if __name__ == "__main__":
+    main()
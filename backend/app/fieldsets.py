@@ -0,0 +1,122 @@
+"""一覧 API の ``fields=`` / ``view=`` による返却項目の絞り込み。
+
+``fields`` はカンマ区切りの項目名、``view`` は定義済みの項目の組
+(``minimal`` / ``summary`` / ``full``) を指定する。両方を指定した場合は
+和集合になり、``id`` は常に含める。絞り込んだ場合は SELECT する列も
+``load_only`` で限定し、関連 (機能・タグ) は要求されたときだけ読み込む。
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import load_only, selectinload
+
+from . import models, serializers
+
+
+@dataclass(frozen=True)
+class FieldSet:
+    model: type
+    fields: Tuple[str, ...]  # 出力順
+    views: Dict[str, Tuple[str, ...]]
+    relations: Dict[str, tuple]  # 関連の項目名 → 読み込みオプション
+    values: Dict[str, Callable]
+
+    def resolve(
+        self, fields: Optional[str], view: Optional[str]
+    ) -> Optional[Tuple[str, ...]]:
+        """出力する項目を返す。絞り込みが無い場合は None。"""
+        if not fields and view in (None, "full"):
+            return None
+        selected = {"id"}
+        if view == "full":
+            selected.update(self.fields)
+        elif view is not None:
+            if view not in self.views:
+                raise HTTPException(status_code=400, detail=f"Unknown view: {view}")
+            selected.update(self.views[view])
+        if fields:
+            requested = {f.strip() for f in fields.split(",") if f.strip()}
+            unknown = requested.difference(self.fields)
+            if unknown:
+                raise HTTPException(
+                    status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+                )
+            selected.update(requested)
+        return tuple(f for f in self.fields if f in selected)
+
+    def load_options(self, selected: Tuple[str, ...]) -> list:
+        columns = [getattr(self.model, f) for f in selected if f not in self.relations]
+        options = [load_only(*columns)]
+        for name in selected:
+            options.extend(self.relations.get(name, ()))
+        return options
+
+    def serialize(self, obj, selected: Tuple[str, ...]) -> dict:
+        return serializers.pick(obj, selected, self.values)
+
+
+FACILITIES = FieldSet(
+    model=models.MedicalFacility,
+    fields=(
+        "short_name", "official_name", "prefecture", "city", "address_detail",
+        "phone_numbers", "emails", "fax", "remarks", "id", "is_deleted", "functions",
+    ),
+    views={
+        "minimal": ("id", "short_name"),
+        "summary": ("id", "short_name", "official_name", "prefecture", "city", "is_deleted"),
+    },
+    relations={
+        "functions": (
+            selectinload(models.MedicalFacility.functions).selectinload(
+                models.FacilityFunctionEntry.function
+            ),
+        ),
+    },
+    values=serializers.FACILITY_VALUES,
+)
+
+FUNCTIONS = FieldSet(
+    model=models.Function,
+    fields=(
+        "id", "name", "description", "memo", "selection_type", "choices",
+        "category_id", "is_deleted",
+    ),
+    views={
+        "minimal": ("id", "name"),
+        "summary": ("id", "name", "selection_type", "choices", "category_id", "is_deleted"),
+    },
+    relations={},
+    values=serializers.FUNCTION_VALUES,
+)
+
+MEMOS = FieldSet(
+    model=models.FacilityMemo,
+    fields=(
+        "id", "facility_id", "parent_id", "title", "content", "content_length",
+        "content_hash", "is_deleted", "sort_order", "updated_at", "tags",
+    ),
+    views={
+        "minimal": ("id", "title"),
+        "summary": (
+            "id", "facility_id", "parent_id", "title", "content_length", "content_hash",
+            "is_deleted", "sort_order", "updated_at", "tags",
+        ),
+    },
+    relations={"tags": (selectinload(models.FacilityMemo.tags),)},
+    values=serializers.MEMO_VALUES,
+)
+
+TEMPLATES = FieldSet(
+    model=models.MemoTemplate,
+    fields=(
+        "id", "name", "title", "content", "is_deleted", "updated_at", "sort_order", "tags",
+    ),
+    views={
+        "minimal": ("id", "name"),
+        "summary": ("id", "name", "title", "is_deleted", "updated_at", "sort_order", "tags"),
+    },
+    relations={"tags": (selectinload(models.MemoTemplate.tags),)},
+    values=serializers.TEMPLATE_VALUES,
+)
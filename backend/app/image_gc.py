@@ -0,0 +1,322 @@
+"""どこからも参照されていない画像 (note_images) の削除。
+
+1. メモ・テンプレートの現在の本文、履歴、アーカイブ済み履歴から
+   画像 ID (UUID) の参照を集める。
+2. 参照されていない画像に印を付け、再び参照された画像の印を外す。
+3. 印を付けてから ``IMAGE_GC_GRACE_DAYS`` 日を過ぎた画像を削除する。
+   削除の直前に、走査の開始後に更新されたメモ・テンプレートの本文を
+   読み直し、その間に参照された画像は削除しない。
+
+いずれも ``batch_size`` 件ずつ短いトランザクションで処理するため、
+テーブルを長時間ロックしない。アップロード直後でまだ本文に
+保存されていない画像を消さないよう、作成から猶予期間内の画像には
+印を付けない。
+
+例::
+
+    python -m backend.app.image_gc --grace-days 7
+"""
+
+import argparse
+import os
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import delete, exists, func, insert, select, text, update
+from sqlalchemy.orm import Session
+
+from . import image_store, models, version_archive
+from .database import SessionLocal
+
+GRACE_DAYS = int(os.getenv("IMAGE_GC_GRACE_DAYS", "7"))
+
+UUID_PATTERN = (
+    "([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})"
+)
+_UUID_RE = re.compile(UUID_PATTERN)
+
+# 本文を持つテーブル (画像参照の走査対象)
+CONTENT_TABLES = (
+    "facility_memos",
+    "facility_memo_versions",
+    "memo_templates",
+    "memo_template_versions",
+)
+
+
+def _scan_table(db: Session, table: str, refs: Set[str], batch_size: int) -> None:
+    """本文中の UUID を PostgreSQL 側で抽出し、id 範囲ごとに取得する。"""
+    last_id = 0
+    while True:
+        upto = db.execute(
+            text(
+                f"SELECT max(id) FROM (SELECT id FROM {table} WHERE id > :last "
+                "ORDER BY id LIMIT :n) s"
+            ),
+            {"last": last_id, "n": batch_size},
+        ).scalar()
+        if upto is None:
+            break
+        rows = db.execute(
+            text(
+                f"SELECT DISTINCT lower((regexp_matches(content, :pattern, 'g'))[1]) "
+                f"FROM {table} WHERE id > :last AND id <= :upto"
+            ),
+            {"pattern": UUID_PATTERN, "last": last_id, "upto": upto},
+        )
+        refs.update(r[0] for r in rows)
+        db.rollback()
+        last_id = upto
+
+
+def _recent_references(db: Session, since: datetime) -> Set[str]:
+    """``since`` 以降に作成・更新されたメモ・テンプレートの本文中の UUID。"""
+    rows = db.execute(
+        text(
+            "SELECT lower((regexp_matches(content, :pattern, 'g'))[1]) "
+            "FROM facility_memos WHERE updated_at >= :since "
+            "UNION "
+            "SELECT lower((regexp_matches(content, :pattern, 'g'))[1]) "
+            "FROM memo_templates WHERE updated_at >= :since"
+        ),
+        {"pattern": UUID_PATTERN, "since": since},
+    )
+    return {r[0] for r in rows}
+
+
+def _scan_archive(db: Session, table: version_archive.VersionTable, refs: Set[str]) -> None:
+    """アーカイブは本文が圧縮されているため展開して走査する。"""
+    rows = db.execute(
+        select(table.archive.content).execution_options(yield_per=1000)
+    ).scalars()
+    for data in rows:
+        content = version_archive.decompress(data)
+        if content:
+            refs.update(m.lower() for m in _UUID_RE.findall(content))
+    db.rollback()
+
+
+def collect_references(db: Session, batch_size: int = 1000) -> Set[str]:
+    refs: Set[str] = set()
+    for table in CONTENT_TABLES:
+        _scan_table(db, table, refs, batch_size)
+    for table in (version_archive.MEMO_VERSIONS, version_archive.TEMPLATE_VERSIONS):
+        _scan_archive(db, table, refs)
+    return refs
+
+
+def _db_now(db: Session) -> datetime:
+    # created_at / marked_at は DB の now() で入るため DB 側の時刻で比較する
+    return db.execute(select(func.localtimestamp())).scalar()
+
+
+def mark(
+    db: Session, refs: Set[str], grace: timedelta, batch_size: int = 500
+) -> Dict[str, int]:
+    """未参照の画像に印を付け、参照が戻った画像の印を外す。"""
+    image = models.NoteImage
+    gc_mark = models.NoteImageGcMark
+    cutoff = _db_now(db) - grace
+    result = {"marked": 0, "unmarked": 0}
+    last_id = None
+    while True:
+        query = (
+            select(image.id, image.created_at, gc_mark.image_id.label("marked"))
+            .outerjoin(gc_mark, gc_mark.image_id == image.id)
+            .order_by(image.id)
+            .limit(batch_size)
+        )
+        if last_id is not None:
+            query = query.where(image.id > last_id)
+        rows = db.execute(query).all()
+        if not rows:
+            break
+        to_mark: List = []
+        to_unmark: List = []
+        for row in rows:
+            referenced = str(row.id) in refs
+            if referenced and row.marked is not None:
+                to_unmark.append(row.id)
+            elif (
+                not referenced
+                and row.marked is None
+                and (row.created_at is None or row.created_at < cutoff)
+            ):
+                to_mark.append(row.id)
+        if to_mark:
+            db.execute(insert(gc_mark), [{"image_id": i} for i in to_mark])
+        if to_unmark:
+            db.execute(delete(gc_mark).where(gc_mark.image_id.in_(to_unmark)))
+        db.commit()
+        result["marked"] += len(to_mark)
+        result["unmarked"] += len(to_unmark)
+        last_id = rows[-1].id
+    return result
+
+
+def _releasable_bytes(db: Session, counts: Counter, batch_size: int = 1000) -> int:
+    """``counts`` の数だけ参照が減ると参照数が 0 になる blob のバイト数 (dry run 用)。"""
+    blob = models.ImageBlob
+    hashes = list(counts)
+    total = 0
+    for start in range(0, len(hashes), batch_size):
+        rows = db.execute(
+            select(blob.sha256, blob.ref_count, blob.size).where(
+                blob.sha256.in_(hashes[start : start + batch_size])
+            )
+        )
+        total += sum(r.size for r in rows if r.ref_count - counts[r.sha256] <= 0)
+    return total
+
+
+def sweep(
+    db: Session,
+    refs: Set[str],
+    grace: timedelta,
+    batch_size: int = 100,
+    dry_run: bool = False,
+    scanned_at: Optional[datetime] = None,
+) -> Dict[str, int]:
+    """印を付けてから猶予期間を過ぎた画像を削除し、削除件数とバイト数を返す。
+
+    ``scanned_at`` は ``refs`` を集め始めた時刻で、それ以降に更新された本文の
+    参照をバッチごとに削除と同じトランザクションで確認する。``dry_run`` の
+    バイト数には、削除すると参照数が 0 になる blob の分も含める。
+    """
+    image = models.NoteImage
+    gc_mark = models.NoteImageGcMark
+    cutoff = _db_now(db) - grace
+    result = {"deleted": 0, "bytes": 0}
+    released: Counter = Counter()
+    last_id = None
+    while True:
+        query = (
+            select(
+                gc_mark.image_id,
+                image.blob_hash,
+                func.octet_length(image.data).label("size"),
+            )
+            .join(image, image.id == gc_mark.image_id)
+            .where(gc_mark.marked_at < cutoff)
+            .order_by(gc_mark.image_id)
+            .limit(batch_size)
+        )
+        if last_id is not None:
+            query = query.where(gc_mark.image_id > last_id)
+        rows = db.execute(query).all()
+        if not rows:
+            break
+        last_id = rows[-1].image_id
+        # 走査後に参照された画像は消さない
+        recent = _recent_references(db, scanned_at) if scanned_at is not None else set()
+        targets = [
+            r for r in rows if str(r.image_id) not in refs and str(r.image_id) not in recent
+        ]
+        if targets and not dry_run:
+            hashes = db.execute(
+                delete(image)
+                .where(image.id.in_([r.image_id for r in targets]))
+                .returning(image.blob_hash)
+            ).scalars().all()
+            result["bytes"] += image_store.release_blobs(db, hashes)
+        elif dry_run:
+            released.update(r.blob_hash for r in targets if r.blob_hash)
+        db.commit()
+        result["deleted"] += len(targets)
+        result["bytes"] += sum(r.size or 0 for r in targets)
+    if released:
+        result["bytes"] += _releasable_bytes(db, released)
+        db.rollback()
+    return result
+
+
+def reconcile_blobs(db: Session, batch_size: int = 500) -> Dict[str, int]:
+    """blob の参照数を実際の参照件数に合わせ、参照の無い blob を削除する。
+
+    メモの物理削除 (ON DELETE CASCADE) などで参照数がずれた分を修復する。
+    アーカイブしたメモの画像 (``archived_blob_refs``) も参照として数える。
+    """
+    blob = models.ImageBlob
+    image = models.NoteImage
+    archived = models.ArchivedBlobRef
+    result = {"blobs_deleted": 0, "blob_bytes": 0}
+    last_hash = None
+    while True:
+        query = select(blob.sha256).order_by(blob.sha256).limit(batch_size)
+        if last_hash is not None:
+            query = query.where(blob.sha256 > last_hash)
+        hashes = db.execute(query).scalars().all()
+        if not hashes:
+            break
+        last_hash = hashes[-1]
+        actual = (
+            select(func.count()).where(image.blob_hash == blob.sha256).scalar_subquery()
+            + select(func.count()).where(archived.blob_hash == blob.sha256).scalar_subquery()
+        )
+        db.execute(
+            update(blob)
+            .where(blob.sha256.in_(hashes), blob.ref_count != actual)
+            .values(ref_count=actual)
+        )
+        # 参照数を合わせた後に同時にアップロードされた画像の参照は残す
+        sizes = db.execute(
+            delete(blob)
+            .where(
+                blob.sha256.in_(hashes),
+                blob.ref_count <= 0,
+                ~exists().where(image.blob_hash == blob.sha256),
+                ~exists().where(archived.blob_hash == blob.sha256),
+            )
+            .returning(blob.size)
+        ).scalars().all()
+        db.commit()
+        result["blobs_deleted"] += len(sizes)
+        result["blob_bytes"] += sum(sizes)
+    return result
+
+
+def run_gc(
+    db: Session,
+    grace_days: int = GRACE_DAYS,
+    batch_size: int = 500,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    grace = timedelta(days=grace_days)
+    scanned_at = _db_now(db)
+    refs = collect_references(db, batch_size * 2)
+    result = {"references": len(refs)}
+    if dry_run:
+        result.update(sweep(db, refs, grace, batch_size, dry_run=True, scanned_at=scanned_at))
+        return result
+    result.update(mark(db, refs, grace, batch_size))
+    result.update(sweep(db, refs, grace, batch_size, scanned_at=scanned_at))
+    reconciled = reconcile_blobs(db, batch_size)
+    result["deleted_blobs"] = reconciled["blobs_deleted"]
+    result["bytes"] += reconciled["blob_bytes"]
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Delete unreferenced note images.")
+    parser.add_argument("--grace-days", type=int, default=GRACE_DAYS)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="report what would be deleted"
+    )
+    args = parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        result = run_gc(db, args.grace_days, args.batch_size, args.dry_run)
+    finally:
+        db.close()
+    print(
+        f"references={result['references']} marked={result.get('marked', 0)} "
+        f"unmarked={result.get('unmarked', 0)} deleted={result['deleted']} "
+        f"reclaimed={result['bytes']} bytes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""画像の実データを SHA-256 で重複排除して保存する。
+
+同じ内容の画像は ``image_blobs`` に 1 件だけ保存し、``note_images`` の
+各行は ``blob_hash`` でそれを参照する。既に同じ内容がある場合は
+参照数を増やすだけで実データは書き込まない。
+"""
+
+import hashlib
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Iterable, List, Tuple
+
+from fastapi import HTTPException, Request
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # pragma: no cover - python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+CHUNK_SIZE = 64 * 1024
+MAX_FILE_BYTES = int(os.getenv("IMAGE_MAX_FILE_BYTES", str(10 * 1024 * 1024)))
+MAX_BATCH_BYTES = int(os.getenv("IMAGE_MAX_BATCH_BYTES", str(50 * 1024 * 1024)))
+MAX_BATCH_FILES = int(os.getenv("IMAGE_MAX_BATCH_FILES", "20"))
+# 画像以外のフォーム項目 (memo_id など) の上限
+MAX_FIELD_BYTES = 1024
+# 境界文字列やパートのヘッダーの分として許容する量
+MULTIPART_OVERHEAD = 1024
+
+
+def read_and_hash(file: BinaryIO) -> Tuple[bytes, str]:
+    """アップロードをチャンクごとに読みながら SHA-256 を計算する (スレッドプールで呼ぶ)。"""
+    digest = hashlib.sha256()
+    chunks = []
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), digest.hexdigest()
+
+
+@dataclass
+class UploadedPart:
+    file_name: str
+    mime_type: str
+    sha256: str
+    data: bytes
+
+
+@dataclass
+class _PartState:
+    headers: Dict[bytes, bytes] = field(default_factory=dict)
+    header_field: bytes = b""
+    header_value: bytes = b""
+    name: str = ""
+    file_name: str = ""
+    is_file: bool = False
+    size: int = 0
+    chunks: List[bytes] = field(default_factory=list)
+    digest: object = None
+
+
+def _too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+async def read_multipart_images(
+    request: Request,
+    max_file_bytes: int = MAX_FILE_BYTES,
+    max_total_bytes: int = MAX_BATCH_BYTES,
+    max_files: int = MAX_BATCH_FILES,
+) -> Tuple[Dict[str, str], List[UploadedPart]]:
+    """multipart/form-data の本文を受信しながら解析する。
+
+    ファイルのパートは受信したチャンクごとに SHA-256 を計算し、
+    ファイルごと・合計の上限を超えた時点で 413 を返して以降を読まない。
+    Content-Length が明らかに上限を超える場合は本文を読む前に断る。
+    ファイル以外の項目は文字列の辞書で返す。
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="multipart/form-data is required")
+    limit = max_total_bytes + MULTIPART_OVERHEAD * (max_files + 1)
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > limit:
+        raise _too_large("Upload is too large")
+
+    fields: Dict[str, str] = {}
+    files: List[UploadedPart] = []
+    part = _PartState()
+    total = 0
+
+    def on_part_begin():
+        nonlocal part
+        part = _PartState()
+
+    def on_header_field(data, start, end):
+        part.header_field += data[start:end]
+
+    def on_header_value(data, start, end):
+        part.header_value += data[start:end]
+
+    def on_header_end():
+        part.headers[part.header_field.lower()] = part.header_value
+        part.header_field = b""
+        part.header_value = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part.headers.get(b"content-disposition", b""))
+        part.name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            if len(files) >= max_files:
+                raise _too_large(f"Too many files (max {max_files})")
+            part.is_file = True
+            part.file_name = options[b"filename"].decode("utf-8", "replace")
+            part.digest = hashlib.sha256()
+
+    def on_part_data(data, start, end):
+        nonlocal total
+        chunk = data[start:end]
+        part.size += len(chunk)
+        if part.is_file:
+            total += len(chunk)
+            if part.size > max_file_bytes:
+                raise _too_large(f"File is too large: {part.file_name}")
+            if total > max_total_bytes:
+                raise _too_large("Upload is too large")
+            part.digest.update(chunk)
+        elif part.size > MAX_FIELD_BYTES:
+            raise _too_large(f"Field is too large: {part.name}")
+        part.chunks.append(chunk)
+
+    def on_part_end():
+        data = b"".join(part.chunks)
+        if not part.is_file:
+            fields[part.name] = data.decode("utf-8", "replace")
+            return
+        if not data and not part.file_name:
+            return  # ファイル未選択の空パート
+        files.append(
+            UploadedPart(
+                file_name=part.file_name,
+                mime_type=(
+                    part.headers.get(b"content-type", b"").decode("latin-1")
+                    or "application/octet-stream"
+                ),
+                sha256=part.digest.hexdigest(),
+                data=data,
+            )
+        )
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        },
+    )
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > limit:
+            raise _too_large("Upload is too large")
+        try:
+            parser.write(chunk)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Malformed multipart body")
+    parser.finalize()
+    return fields, files
+
+
+def acquire_blob(db: Session, sha256: str, data: bytes) -> bool:
+    """blob の参照数を 1 増やす。新たに保存した場合は True を返す。"""
+    blob = models.ImageBlob
+    found = db.execute(
+        update(blob)
+        .where(blob.sha256 == sha256)
+        .values(ref_count=blob.ref_count + 1)
+        .returning(blob.sha256)
+    ).first()
+    if found is not None:
+        return False
+    # 同時に同じ画像がアップロードされた場合も参照数の加算に倒す
+    db.execute(
+        pg_insert(blob)
+        .values(sha256=sha256, data=data, size=len(data), ref_count=1)
+        .on_conflict_do_update(
+            index_elements=[blob.sha256], set_={"ref_count": blob.ref_count + 1}
+        )
+    )
+    return True
+
+
+def release_blobs(db: Session, hashes: Iterable[str]) -> int:
+    """削除した画像が参照していた blob の参照数を減らす。
+
+    参照が無くなった blob は削除し、解放したバイト数を返す。
+    """
+    counts = Counter(h for h in hashes if h)
+    if not counts:
+        return 0
+    blob = models.ImageBlob
+    for sha256, n in counts.items():
+        db.execute(
+            update(blob).where(blob.sha256 == sha256).values(ref_count=blob.ref_count - n)
+        )
+    image = models.NoteImage
+    archived = models.ArchivedBlobRef
+    sizes = db.execute(
+        delete(blob)
+        .where(
+            blob.sha256.in_(list(counts)),
+            blob.ref_count <= 0,
+            ~exists().where(image.blob_hash == blob.sha256),
+            ~exists().where(archived.blob_hash == blob.sha256),
+        )
+        .returning(blob.size)
+    ).scalars()
+    return sum(sizes)
+
+
+def image_data(db: Session, img: models.NoteImage) -> bytes:
+    if img.data is not None:
+        return img.data
+    return db.execute(
+        select(models.ImageBlob.data).where(models.ImageBlob.sha256 == img.blob_hash)
+    ).scalar_one()
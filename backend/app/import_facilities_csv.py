@@ -1,47 +1,392 @@
+"""医療機関の CSV 取り込み・書き出し。
+
+通常は CSV の全行を新規登録する。``--sync`` を付けると、月次の一覧のような
+全件の CSV と既存の医療機関を自然キー (既定は ``FACILITY_SYNC_KEY``) で突き合わせ、
+各行の内容のハッシュを比べて差分だけを反映する。
+
+- CSV にあって DB に無い行は登録し、内容が変わった行は更新する
+  (削除済みの行は復元する)。
+- DB にあって CSV に無い行は削除済みにする (``--keep-missing`` で残す)。
+- 同じキーの行が DB に複数あれば 1 件に寄せ、残りを削除済みにする。
+
+比較と更新の対象は CSV に含まれる列だけで、内容が同じ CSV を再実行しても
+何も書き込まない。
+
+例::
+
+    python -m backend.app.import_facilities_csv facilities.csv --sync --dry-run
+"""
+
+import argparse
 import csv
-import sys
+import hashlib
+import io
+import json
+import os
+from dataclasses import dataclass, fields
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
+from sqlalchemy import func, insert, update
+
+from . import phone_lookup
 from .database import SessionLocal
 from .models import MedicalFacility
+from .search_text import normalize
+
+COLUMNS = (
+    "short_name",
+    "official_name",
+    "prefecture",
+    "city",
+    "address_detail",
+    "phone_numbers",
+    "emails",
+    "fax",
+    "remarks",
+)
+CONTACT_COLUMNS = ("phone_numbers", "emails")
+
+SYNC_KEY = tuple(
+    os.getenv("FACILITY_SYNC_KEY", "short_name,prefecture,city,address_detail").split(",")
+)
+
+
+def _contacts(value: Optional[str]):
+    return [
+        {"value": p.split(":")[0], "comment": p.split(":")[1] if ":" in p else ""}
+        for p in (value or "").split("|") if p
+    ] or None
+
+
+def facility_values(row: dict, columns: Sequence[str] = COLUMNS) -> dict:
+    """CSV の 1 行を ``medical_facility`` の列の値にする。"""
+    values = {}
+    for name in columns:
+        if name in CONTACT_COLUMNS:
+            values[name] = _contacts(row.get(name))
+        elif name == "short_name":
+            values[name] = row.get(name, "")
+        else:
+            values[name] = row.get(name)
+    return values
+
+
+def facility_from_row(row: dict) -> MedicalFacility:
+    return MedicalFacility(**facility_values(row))
+
+
+def import_rows(
+    session,
+    rows: Iterable[dict],
+    batch_size: int = 500,
+    progress: Optional[Callable[[int], None]] = None,
+) -> int:
+    """CSV の行を登録し、登録件数を返す。
+
+    ``batch_size`` 件ごとに書き込んで進捗を通知し、最後に 1 回だけコミットする
+    (途中で失敗した場合は何も登録されない)。
+    """
+    created = 0
+    facilities = []
+
+    def flush():
+        session.add_all(facilities)
+        session.flush()
+        phone_lookup.sync(session, facilities)
+        facilities.clear()
+        if progress:
+            progress(created)
+
+    for row in rows:
+        facilities.append(facility_from_row(row))
+        created += 1
+        if len(facilities) >= batch_size:
+            flush()
+    if facilities:
+        flush()
+    session.commit()
+    return created
+
+
+def import_csv_text(session, text: str, **kwargs) -> int:
+    return import_rows(session, csv.DictReader(io.StringIO(text)), **kwargs)
+
+
+# --- 差分同期 -----------------------------------------------------------------
+
+
+def _canonical(name: str, value):
+    """空文字と None、コメントの有無などの表記の揺れを揃える。"""
+    if name in CONTACT_COLUMNS:
+        contacts = [
+            [c.get("value") or "", c.get("comment") or ""]
+            for c in value or []
+            if isinstance(c, dict) and c.get("value")
+        ]
+        return contacts or None
+    if isinstance(value, str):
+        value = value.strip()
+    return value or None
+
+
+def fingerprint(values: dict, columns: Sequence[str]) -> str:
+    data = [_canonical(name, values.get(name)) for name in columns]
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def natural_key(values: dict, key: Sequence[str]) -> Tuple[str, ...]:
+    return tuple(normalize(values.get(name)) for name in key)
+
+
+@dataclass
+class SyncResult:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    duplicates: int = 0  # 同じキーで重複していた既存行 (削除済みにした件数)
+    unchanged: int = 0
+    skipped: int = 0  # キーが空、または CSV 内で重複していた行
+
+    @property
+    def writes(self) -> int:
+        return self.inserted + self.updated + self.deleted + self.duplicates
+
+    def summary(self) -> str:
+        return ", ".join(f"{f.name}={getattr(self, f.name)}" for f in fields(self))
+
+    def to_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+def sync_rows(
+    session,
+    rows: Iterable[dict],
+    columns: Sequence[str],
+    key: Sequence[str] = SYNC_KEY,
+    delete_missing: bool = True,
+    dry_run: bool = False,
+    batch_size: int = 500,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> SyncResult:
+    """CSV の行と既存の医療機関の差分を反映する (最後に 1 回だけコミット)。
+
+    ``columns`` は CSV に含まれる列で、比較と更新はこの列だけを対象にする。
+    """
+    columns = [c for c in COLUMNS if c in columns]
+    missing = [k for k in key if k not in columns]
+    if missing:
+        raise ValueError(f"key columns not in CSV: {', '.join(missing)}")
+    fac = MedicalFacility
+    result = SyncResult()
+
+    # 既存行のキーとハッシュ (同じキーなら削除されていない行、次に id の小さい行を残す)
+    existing: Dict[Tuple[str, ...], Tuple[int, str, bool]] = {}
+    duplicates: Dict[Tuple[str, ...], List[int]] = {}
+    is_deleted = func.coalesce(fac.is_deleted, False)
+    query = (
+        session.query(fac.id, is_deleted, *(getattr(fac, c) for c in columns))
+        .order_by(is_deleted, fac.id)
+        .yield_per(2000)
+    )
+    for facility_id, deleted, *data in query:
+        values = dict(zip(columns, data))
+        k = natural_key(values, key)
+        if not any(k):
+            continue
+        if k in existing:
+            if not deleted:
+                duplicates.setdefault(k, []).append(facility_id)
+            continue
+        existing[k] = (facility_id, fingerprint(values, columns), deleted)
+
+    inserts: List[dict] = []
+    updates: List[dict] = []
+    seen = set()
+    for row in rows:
+        values = facility_values(row, columns)
+        k = natural_key(values, key)
+        if not any(k) or k in seen:
+            result.skipped += 1
+            continue
+        seen.add(k)
+        match = existing.get(k)
+        if match is None:
+            inserts.append(values)
+            continue
+        facility_id, digest, deleted = match
+        if deleted or digest != fingerprint(values, columns):
+            updates.append({"id": facility_id, **values, "is_deleted": False, "deleted_at": None})
+        else:
+            result.unchanged += 1
+
+    deletes = []
+    duplicate_ids = []
+    for k, ids in duplicates.items():
+        if delete_missing or k in seen:
+            duplicate_ids.extend(ids)
+    if delete_missing:
+        deletes = [i for k, (i, _, deleted) in existing.items() if k not in seen and not deleted]
+    result.inserted = len(inserts)
+    result.updated = len(updates)
+    result.deleted = len(deletes)
+    result.duplicates = len(duplicate_ids)
+    if dry_run or not result.writes:
+        session.rollback()
+        return result
+
+    total = result.writes
+    done = 0
+    changed_ids: List[int] = []
+    for i in range(0, len(inserts), batch_size):
+        batch = inserts[i : i + batch_size]
+        ids = session.execute(insert(fac).values(batch).returning(fac.id)).scalars().all()
+        changed_ids.extend(ids)
+        done += len(batch)
+        if progress:
+            progress(done, total)
+    for i in range(0, len(updates), batch_size):
+        batch = updates[i : i + batch_size]
+        session.execute(update(fac), batch)
+        changed_ids.extend(u["id"] for u in batch)
+        done += len(batch)
+        if progress:
+            progress(done, total)
+    to_delete = deletes + duplicate_ids
+    for i in range(0, len(to_delete), batch_size):
+        batch = to_delete[i : i + batch_size]
+        session.execute(
+            update(fac)
+            .where(fac.id.in_(batch))
+            .values(is_deleted=True, deleted_at=func.now())
+        )
+        done += len(batch)
+        if progress:
+            progress(done, total)
+
+    if "phone_numbers" in columns or "fax" in columns:
+        for i in range(0, len(changed_ids), batch_size):
+            batch = changed_ids[i : i + batch_size]
+            phone_lookup.sync(session, session.query(fac).filter(fac.id.in_(batch)).all())
+    session.commit()
+    return result
+
+
+def sync_csv_text(session, text: str, **kwargs) -> SyncResult:
+    reader = csv.DictReader(io.StringIO(text))
+    return sync_rows(session, reader, reader.fieldnames or [], **kwargs)
+
+
+# --- 書き出し -----------------------------------------------------------------
+
+
+def _contacts_text(contacts) -> str:
+    """``_contacts`` の逆変換 (``番号:コメント`` を ``|`` で連結)。"""
+    parts = []
+    for c in contacts or []:
+        if isinstance(c, dict) and c.get("value"):
+            parts.append(f"{c['value']}:{c['comment']}" if c.get("comment") else c["value"])
+    return "|".join(parts)
+
+
+def export_csv(
+    session,
+    include_deleted: bool = False,
+    batch_size: int = 1000,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """取り込みと同じ形式の CSV を返す。"""
+    query = session.query(MedicalFacility)
+    if not include_deleted:
+        query = query.filter(MedicalFacility.is_deleted == False)
+    total = query.count()
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=COLUMNS)
+    writer.writeheader()
+    done = 0
+    last_id = 0
+    while True:
+        batch = (
+            query.filter(MedicalFacility.id > last_id)
+            .order_by(MedicalFacility.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        for fac in batch:
+            row = {name: getattr(fac, name) or "" for name in COLUMNS}
+            row["phone_numbers"] = _contacts_text(fac.phone_numbers)
+            row["emails"] = _contacts_text(fac.emails)
+            writer.writerow(row)
+        done += len(batch)
+        last_id = batch[-1].id
+        session.expunge_all()
+        if progress:
+            progress(done, total)
+    return out.getvalue()
 
 
 def import_from_csv(csv_path: str) -> None:
     session = SessionLocal()
-    created = 0
     try:
         with open(csv_path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                facility = MedicalFacility(
-                    short_name=row.get("short_name", ""),
-                    official_name=row.get("official_name"),
-                    prefecture=row.get("prefecture"),
-                    city=row.get("city"),
-                    address_detail=row.get("address_detail"),
-                    phone_numbers=[
-                        {"value": p.split(":")[0], "comment": p.split(":")[1] if ":" in p else ""}
-                        for p in row.get("phone_numbers", "").split("|") if p
-                    ] or None,
-                    emails=[
-                        {"value": e.split(":")[0], "comment": e.split(":")[1] if ":" in e else ""}
-                        for e in row.get("emails", "").split("|") if e
-                    ] or None,
-                    fax=row.get("fax"),
-                    remarks=row.get("remarks"),
-                )
-                session.add(facility)
-                created += 1
-        session.commit()
+            created = import_rows(session, csv.DictReader(f))
         print(f"Imported {created} facilities")
     finally:
         session.close()
 
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python import_facilities_csv.py <csv_file>")
-        sys.exit(1)
-    import_from_csv(sys.argv[1])
+def sync_from_csv(
+    csv_path: str,
+    key: Sequence[str] = SYNC_KEY,
+    delete_missing: bool = True,
+    dry_run: bool = False,
+) -> SyncResult:
+    session = SessionLocal()
+    try:
+        with open(csv_path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f)
+            result = sync_rows(
+                session,
+                reader,
+                reader.fieldnames or [],
+                key=key,
+                delete_missing=delete_missing,
+                dry_run=dry_run,
+            )
+    finally:
+        session.close()
+    print(f"{'Would sync' if dry_run else 'Synced'} facilities: {result.summary()}")
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Import facilities from a CSV file.")
+    parser.add_argument("csv_file")
+    parser.add_argument(
+        "--sync", action="store_true", help="apply only the differences to existing rows"
+    )
+    parser.add_argument(
+        "--key",
+        default=",".join(SYNC_KEY),
+        help="comma separated natural key columns for --sync",
+    )
+    parser.add_argument(
+        "--keep-missing",
+        action="store_true",
+        help="do not delete facilities missing from the CSV",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="only print the summary")
+    args = parser.parse_args(argv)
+    if args.sync:
+        sync_from_csv(
+            args.csv_file,
+            key=[k.strip() for k in args.key.split(",") if k.strip()],
+            delete_missing=not args.keep_missing,
+            dry_run=args.dry_run,
+        )
+    else:
+        import_from_csv(args.csv_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,440 @@
+"""バックグラウンドジョブ。
+
+CSV の取り込み・書き出し、機能の選択肢変更の反映、画像 GC、各種の作り直しなど
+時間のかかる処理を ``jobs`` テーブルに積み、別プロセスのワーカーで実行する。
+API は ``enqueue`` で積んだジョブの ID を返し、``GET /jobs/{id}`` で進捗と結果を返す。
+
+ワーカーは ``SELECT ... FOR UPDATE SKIP LOCKED`` でジョブを取り出し、
+プロセスプールで実行する。失敗したジョブは ``max_attempts`` 回まで
+``JOB_RETRY_DELAY`` 秒 × 2^(試行回数-1) 後に再実行する。実行中のジョブは
+ワーカーが定期的に ``heartbeat_at`` を更新し、``JOB_STALE_SECONDS`` 秒
+更新が途絶えたジョブ (ワーカーの異常終了など) は再びキューに戻す。
+
+例::
+
+    python -m backend.app.jobs --workers 2
+"""
+
+import argparse
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal, engine
+
+WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "30"))
+STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "300"))
+# 進捗を書き込む最小間隔 (秒)
+PROGRESS_INTERVAL = 1.0
+
+HANDLERS: Dict[str, Callable] = {}
+
+
+def handler(kind: str):
+    """ジョブの処理を登録する。処理は ``(ctx, payload)`` を受け取り結果の dict を返す。"""
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(
+    db: Session,
+    kind: str,
+    payload: Optional[dict] = None,
+    max_attempts: int = 3,
+    input: Optional[bytes] = None,
+):
+    """ジョブを積む (コミットは呼び出し側)。
+
+    ``input`` はアップロードされたファイルなど、処理側が ``ctx.read_input()`` で読む入力。
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"unknown job kind: {kind}")
+    job = models.Job(
+        kind=kind,
+        payload=payload or {},
+        input=input,
+        status="queued",
+        max_attempts=max_attempts,
+    )
+    db.add(job)
+    db.flush()
+    return job
+
+
+class JobContext:
+    """実行中のジョブから進捗や出力を書き込むためのもの。"""
+
+    def __init__(self, job_id: int, db: Session):
+        self.job_id = job_id
+        self.db = db
+        self._last_progress = 0.0
+
+    def _update(self, **values) -> None:
+        # 処理側のトランザクションとは別の接続で書き込み、すぐに見えるようにする
+        with engine.begin() as conn:
+            conn.execute(
+                update(models.Job).where(models.Job.id == self.job_id).values(**values)
+            )
+
+    def progress(
+        self,
+        done: int,
+        total: Optional[int] = None,
+        message: Optional[str] = None,
+        force: bool = False,
+    ) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        values = {"progress_done": done, "heartbeat_at": func.now()}
+        if total is not None:
+            values["progress_total"] = total
+        if message is not None:
+            values["message"] = message
+        self._update(**values)
+
+    def set_output(self, name: str, media_type: str, data: bytes) -> None:
+        self._update(output=data, output_name=name, output_type=media_type)
+
+    def read_input(self) -> bytes:
+        return self.db.execute(
+            select(models.Job.input).where(models.Job.id == self.job_id)
+        ).scalar_one() or b""
+
+
+def claim(db: Session, worker: str, limit: int) -> List[int]:
+    """実行できるジョブを ``limit`` 件まで取り出し、実行中にする。"""
+    job = models.Job
+    ids = list(
+        db.execute(
+            select(job.id)
+            .where(job.status == "queued", job.run_after <= func.now())
+            .order_by(job.run_after, job.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).scalars()
+    )
+    if ids:
+        db.execute(
+            update(job)
+            .where(job.id.in_(ids))
+            .values(
+                status="running",
+                attempts=job.attempts + 1,
+                worker=worker,
+                started_at=func.now(),
+                heartbeat_at=func.now(),
+                error=None,
+            )
+        )
+    db.commit()
+    return ids
+
+
+def heartbeat(db: Session, ids: List[int]) -> None:
+    if ids:
+        db.execute(
+            update(models.Job).where(models.Job.id.in_(ids)).values(heartbeat_at=func.now())
+        )
+        db.commit()
+
+
+def requeue_stale(db: Session, stale_seconds: float = STALE_SECONDS) -> int:
+    """ハートビートが途絶えた実行中のジョブをキューに戻す (試行回数は消費済み)。"""
+    job = models.Job
+    cutoff = func.now() - timedelta(seconds=stale_seconds)
+    stale = job.status == "running", job.heartbeat_at < cutoff
+    failed = db.execute(
+        update(job)
+        .where(*stale, job.attempts >= job.max_attempts)
+        .values(
+            status="failed", error="worker stopped responding", finished_at=func.now()
+        )
+        .returning(job.id)
+    ).all()
+    requeued = db.execute(
+        update(job)
+        .where(*stale)
+        .values(status="queued", worker=None, run_after=func.now())
+        .returning(job.id)
+    ).all()
+    db.commit()
+    return len(failed) + len(requeued)
+
+
+def run_job(job_id: int) -> str:
+    """ジョブを 1 件実行し、終了後の状態を返す (ワーカープロセスで呼ばれる)。"""
+    job = models.Job
+    db = SessionLocal()
+    try:
+        kind, payload, attempts, max_attempts = db.execute(
+            select(job.kind, job.payload, job.attempts, job.max_attempts).where(
+                job.id == job_id
+            )
+        ).one()
+        try:
+            result = HANDLERS[kind](JobContext(job_id, db), payload or {})
+        except Exception:
+            db.rollback()
+            if attempts < max_attempts:
+                delay = timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+                values = {"status": "queued", "run_after": func.now() + delay}
+            else:
+                values = {"status": "failed", "finished_at": func.now()}
+            values.update(error=traceback.format_exc(limit=5), worker=None)
+        else:
+            values = {
+                "status": "succeeded",
+                "result": result,
+                "finished_at": func.now(),
+                "progress_done": func.coalesce(job.progress_total, job.progress_done),
+            }
+        # 処理側で未コミットの書き込みがあれば、状態の更新と一緒に確定する
+        db.execute(update(job).where(job.id == job_id).values(**values))
+        db.commit()
+        return values["status"]
+    finally:
+        db.close()
+
+
+def _init_worker() -> None:
+    # 親プロセスから引き継いだ接続を使わない
+    engine.dispose(close=False)
+
+
+def serve(workers: int = WORKERS, once: bool = False) -> None:
+    """ジョブを取り出してプロセスプールで実行し続ける。
+
+    ``once`` の場合は積まれているジョブが無くなった時点で終了する。
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    running: Dict[int, object] = {}
+    last_maintenance = 0.0
+    engine.dispose()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        while True:
+            for job_id, future in list(running.items()):
+                if future.done():
+                    del running[job_id]
+                    try:
+                        future.result()
+                    except Exception:
+                        # プロセスごと落ちた場合はハートビートの途絶で再実行される
+                        traceback.print_exc()
+            db = SessionLocal()
+            try:
+                now = time.monotonic()
+                if now - last_maintenance >= min(STALE_SECONDS / 3, 60):
+                    heartbeat(db, list(running))
+                    requeue_stale(db)
+                    last_maintenance = now
+                free = workers - len(running)
+                ids = claim(db, name, free) if free > 0 else []
+            finally:
+                db.close()
+            for job_id in ids:
+                running[job_id] = pool.submit(run_job, job_id)
+            if once and not running and not ids:
+                break
+            if not ids:
+                time.sleep(POLL_INTERVAL)
+
+
+def job_dict(job: models.Job) -> dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "progress_done": job.progress_done,
+        "progress_total": job.progress_total,
+        "message": job.message,
+        "result": job.result,
+        "error": job.error,
+        "has_output": job.output_name is not None,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+# --- ジョブの処理 ----------------------------------------------------------------
+
+
+def _csv_text(ctx: JobContext, payload: dict) -> str:
+    # payload に CSV を入れていた頃に積まれたジョブも処理する
+    if "csv" in payload:
+        return payload["csv"]
+    return ctx.read_input().decode("utf-8-sig")
+
+
+@handler("import_facilities_csv")
+def _import_facilities_csv(ctx: JobContext, payload: dict) -> dict:
+    from . import import_facilities_csv
+
+    created = import_facilities_csv.import_csv_text(
+        ctx.db,
+        _csv_text(ctx, payload),
+        progress=lambda n: ctx.progress(n, message="importing"),
+    )
+    return {"created": created}
+
+
+@handler("sync_facilities_csv")
+def _sync_facilities_csv(ctx: JobContext, payload: dict) -> dict:
+    from . import import_facilities_csv
+
+    kwargs = {"delete_missing": payload.get("delete_missing", True)}
+    if payload.get("key"):
+        kwargs["key"] = payload["key"]
+    result = import_facilities_csv.sync_csv_text(
+        ctx.db, _csv_text(ctx, payload), progress=ctx.progress, **kwargs
+    )
+    return result.to_dict()
+
+
+@handler("export_facilities_csv")
+def _export_facilities_csv(ctx: JobContext, payload: dict) -> dict:
+    from . import import_facilities_csv
+
+    data = import_facilities_csv.export_csv(
+        ctx.db,
+        include_deleted=bool(payload.get("include_deleted")),
+        progress=lambda done, total: ctx.progress(done, total),
+    )
+    ctx.set_output("facilities.csv", "text/csv; charset=utf-8", data.encode("utf-8"))
+    return {"bytes": len(data.encode("utf-8"))}
+
+
+@handler("function_choices")
+def _function_choices(ctx: JobContext, payload: dict) -> dict:
+    """機能の選択肢の変更を施設の機能エントリに反映する。
+
+    複数選択なら選択肢に無くなった値を外し、単一選択なら選択値をクリアする。
+    1000 件ごとにコミットする (再実行しても同じ結果になる)。
+    """
+    db = ctx.db
+    function = db.get(models.Function, payload["function_id"])
+    if function is None:
+        return {"updated": 0}
+    entry = models.FacilityFunctionEntry
+    choices = set(function.choices or [])
+    query = db.query(entry.id, entry.selected_values).filter(
+        entry.function_id == function.id
+    )
+    total = query.count()
+    updated = done = last_id = 0
+    while True:
+        rows = query.filter(entry.id > last_id).order_by(entry.id).limit(1000).all()
+        if not rows:
+            break
+        changes = []
+        for entry_id, values in rows:
+            kept = (
+                [v for v in values or [] if v in choices]
+                if function.selection_type == "multiple"
+                else []
+            )
+            if values is None or kept != values:
+                changes.append({"id": entry_id, "selected_values": kept})
+        if changes:
+            db.bulk_update_mappings(entry, changes)
+        db.commit()
+        updated += len(changes)
+        done += len(rows)
+        last_id = rows[-1][0]
+        ctx.progress(done, total)
+    return {"updated": updated}
+
+
+@handler("image_gc")
+def _image_gc(ctx: JobContext, payload: dict) -> dict:
+    from . import image_gc
+
+    ctx.progress(0, 1, "collecting references", force=True)
+    return image_gc.run_gc(
+        ctx.db,
+        payload.get("grace_days", image_gc.GRACE_DAYS),
+        dry_run=bool(payload.get("dry_run")),
+    )
+
+
+@handler("reindex")
+def _reindex(ctx: JobContext, payload: dict) -> dict:
+    """検索用のテーブルや件数を作り直す (``targets`` で対象を絞れる)。"""
+    from . import phone_lookup, tag_usage, template_search
+
+    steps = {
+        "template_search": template_search.rebuild,
+        "phone_lookup": phone_lookup.rebuild,
+        "tag_usage": tag_usage.reconcile,
+    }
+    targets = payload.get("targets") or list(steps)
+    result = {}
+    for done, name in enumerate(targets):
+        ctx.progress(done, len(targets), name, force=True)
+        result[name] = steps[name](ctx.db)
+    return result
+
+
+@handler("archive")
+def _archive(ctx: JobContext, payload: dict) -> dict:
+    """保存期間を過ぎた履歴と削除済みデータをアーカイブへ移す。"""
+    from . import deleted_archive, version_archive
+
+    result = {}
+    tables = (
+        ("memo_versions", version_archive.MEMO_VERSIONS),
+        ("template_versions", version_archive.TEMPLATE_VERSIONS),
+    )
+    steps = len(tables) + len(deleted_archive.KINDS)
+    for done, (name, table) in enumerate(tables):
+        ctx.progress(done, steps, name, force=True)
+        result[name] = version_archive.archive_versions(ctx.db, table)
+    for done, kind in enumerate(deleted_archive.KINDS.values(), start=len(tables)):
+        ctx.progress(done, steps, kind.name, force=True)
+        result[kind.name] = deleted_archive.archive_deleted(ctx.db, kind)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run background jobs.")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument(
+        "--once", action="store_true", help="exit when the queue is empty"
+    )
+    parser.add_argument(
+        "--enqueue", metavar="KIND", choices=sorted(HANDLERS), help="queue a job and exit"
+    )
+    args = parser.parse_args(argv)
+    if args.enqueue:
+        db = SessionLocal()
+        try:
+            job = enqueue(db, args.enqueue)
+            db.commit()
+            print(f"queued job {job.id}")
+        finally:
+            db.close()
+        return
+    serve(args.workers, args.once)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
+import time
+
+# ワーカーのコールドスタート時間の計測開始（import を含める）
+_import_started = time.perf_counter()
+
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from .database import Base, engine
+from .database import engine
+from . import metrics, warmup
 from .routers import (
     facility,
     function,
@@ -9,13 +17,22 @@ from .routers import (
     memo_template,
     memo_tag,
     note_image,
+    admin,
+    jobs,
 )
+from .routers import metrics as metrics_router
 from fastapi.middleware.cors import CORSMiddleware
 
-# DB初期化（テーブル作成）
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="医療機関情報API")
+# 起動時の処理（スキーマの確認・接続プールとインデックスのウォームアップ）
+# テーブルの作成・移行は python -m backend.app.migrate で事前に 1 回だけ行う
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup.run(time.perf_counter() - _import_started)
+    yield
+
+
+app = FastAPI(title="医療機関情報API", lifespan=lifespan)
 
 # CORS（フロントエンドとの連携を許可）
 app.add_middleware(
@@ -26,6 +43,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ルート別レイテンシ・SQL 実行回数の計測
+metrics.instrument_engine(engine)
+app.middleware("http")(metrics.middleware)
+
 # ルーター登録
 app.include_router(facility.router)
 app.include_router(function.router)
@@ -35,3 +56,6 @@ app.include_router(memo.router)
 app.include_router(memo_template.router)
 app.include_router(memo_tag.router)
 app.include_router(note_image.router)
+app.include_router(admin.router)
+app.include_router(jobs.router)
+app.include_router(metrics_router.router)
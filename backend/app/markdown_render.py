@@ -0,0 +1,142 @@
+"""メモ・テンプレート本文の Markdown を HTML に変換してキャッシュする。
+
+フロントエンド (react-markdown + remark-gfm + remark-breaks + rehype-raw)
+と同じく GFM の表・取り消し線、改行の <br> 化、本文中の生 HTML を扱い、
+出力は nh3 でサニタイズする。変換結果は本文の MD5 をキーにした
+上限付き LRU に保持するため、本文が変わらない限り再変換しない。
+
+markdown-it-py と nh3 はオプション依存で、ワーカーの起動を遅らせないよう
+最初の変換時に読み込む。
+"""
+
+import hashlib
+import os
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .lru import LRUCache
+
+nh3 = None
+MarkdownIt = None
+_imported = False
+
+# 変換ルールを変えたら上げる (ETag に含まれる)
+RENDERER_VERSION = "1"
+CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "1024"))
+
+ALLOWED_TAGS = {
+    "a", "b", "blockquote", "br", "code", "del", "div", "em", "h1", "h2", "h3",
+    "h4", "h5", "h6", "hr", "i", "img", "input", "li", "ol", "p", "pre", "s",
+    "span", "strong", "sub", "sup", "table", "tbody", "td", "th", "thead", "tr",
+    "u", "ul",
+}
+ALLOWED_ATTRIBUTES = {
+    "*": {"style", "class"},
+    "a": {"href", "title"},
+    "img": {"src", "alt", "title", "width", "height", "data-id"},
+    "input": {"type", "checked", "disabled"},
+    "td": {"align"},
+    "th": {"align"},
+}
+ALLOWED_STYLES = {
+    "color", "background-color", "font-size", "font-weight", "font-style",
+    "text-align", "text-decoration", "width", "height", "max-width",
+}
+
+_cache = LRUCache(CACHE_SIZE)
+_md = None
+
+
+def available() -> bool:
+    global nh3, MarkdownIt, _imported
+    if not _imported:
+        try:
+            import nh3 as _nh3
+            from markdown_it import MarkdownIt as _MarkdownIt
+        except ImportError:  # pragma: no cover - optional dependency
+            pass
+        else:
+            nh3, MarkdownIt = _nh3, _MarkdownIt
+        _imported = True
+    return MarkdownIt is not None
+
+
+def content_hash(content: Optional[str]) -> str:
+    """PostgreSQL の md5(text) と同じ値を返す。"""
+    return hashlib.md5((content or "").encode("utf-8")).hexdigest()
+
+
+def etag(digest: str) -> str:
+    return f'"{digest}-{RENDERER_VERSION}"'
+
+
+def etag_matches(header: str, tag: str) -> bool:
+    """If-None-Match (カンマ区切り、弱い比較) に ``tag`` が含まれるか。"""
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == "*" or value == tag:
+            return True
+    return False
+
+
+def _renderer():
+    global _md
+    if _md is None:
+        _md = (
+            MarkdownIt("commonmark", {"html": True, "breaks": True, "linkify": False})
+            .enable("table")
+            .enable("strikethrough")
+        )
+    return _md
+
+
+def render(content: Optional[str], digest: Optional[str] = None) -> str:
+    """サニタイズ済み HTML を返す。同じ本文は 2 回目以降キャッシュから返す。"""
+    digest = digest or content_hash(content)
+    html = _cache.get(digest)
+    if html is not None:
+        return html
+    raw = _renderer().render(content or "")
+    html = nh3.clean(
+        raw,
+        tags=ALLOWED_TAGS,
+        attributes=ALLOWED_ATTRIBUTES,
+        filter_style_properties=ALLOWED_STYLES,
+        url_schemes={"http", "https", "mailto"},
+    )
+    _cache.put(digest, html)
+    return html
+
+
+def html_response(request: Request, db: Session, model, obj_id: int) -> Response:
+    """``model`` (id と content を持つ) の本文を HTML で返す。
+
+    If-None-Match が ETag と一致する場合は本文を読まずに 304 を返す。
+    """
+    if not available():
+        raise HTTPException(status_code=501, detail="Markdown rendering is not available")
+    if request.headers.get("if-none-match"):
+        row = (
+            db.query(func.md5(func.coalesce(model.content, "")))
+            .filter(model.id == obj_id)
+            .first()
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        tag = etag(row[0])
+        if etag_matches(request.headers["if-none-match"], tag):
+            return Response(status_code=304, headers={"ETag": tag, "Cache-Control": "no-cache"})
+    row = db.query(model.content).filter(model.id == obj_id).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    digest = content_hash(row[0])
+    return Response(
+        content=render(row[0], digest),
+        media_type="text/html; charset=utf-8",
+        headers={"ETag": etag(digest), "Cache-Control": "no-cache"},
+    )
@@ -0,0 +1,211 @@
+"""リクエスト単位の計測と Prometheus テキスト形式での出力。
+
+ルートごとのレイテンシ・レスポンスサイズ・実行中リクエスト数に加え、
+SQLAlchemy のエンジンイベントから 1 リクエストあたりの SQL 実行回数と
+DB 時間を集計する。値はワーカープロセスごとに保持される。
+"""
+
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Sequence, Tuple
+
+from fastapi import Request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class RequestStats:
+    """処理中のリクエストに紐づく SQL 集計値。"""
+
+    __slots__ = ("path", "queries", "db_seconds")
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar(
+    "current_request", default=None
+)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, labels: Dict[str, str], value: float) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            # [bucket counts..., sum, count]
+            series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                labels = _labels(key + (("le", _fmt(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_fmt(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(key)} {series[-1]}")
+        return "\n".join(lines)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, kind: str = "counter") -> None:
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.series: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, labels: Dict[str, str], value: float = 1) -> None:
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{_labels(key)} {_fmt(value)}")
+        return "\n".join(lines)
+
+
+def _fmt(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key: Tuple[Tuple[str, str], ...]) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+
+_lock = threading.Lock()
+
+REQUESTS = Counter("http_requests_total", "Total HTTP requests.")
+IN_FLIGHT = Counter("http_requests_in_flight", "HTTP requests being processed.", "gauge")
+LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency.", LATENCY_BUCKETS
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "HTTP response body size.", SIZE_BUCKETS
+)
+DB_QUERIES = Histogram(
+    "http_request_db_queries", "SQL statements executed per request.", QUERY_BUCKETS
+)
+DB_TIME = Histogram(
+    "http_request_db_duration_seconds", "Time spent in SQL per request.", LATENCY_BUCKETS
+)
+DB_QUERIES_UNSCOPED = Counter(
+    "db_queries_outside_request_total", "SQL statements executed outside a request."
+)
+STARTUP = Counter(
+    "app_startup_seconds", "Worker cold start time by phase.", "gauge"
+)
+REGISTRY = (
+    REQUESTS,
+    IN_FLIGHT,
+    LATENCY,
+    RESPONSE_SIZE,
+    DB_QUERIES,
+    DB_TIME,
+    DB_QUERIES_UNSCOPED,
+    STARTUP,
+)
+
+
+def _route_label(request: Request) -> str:
+    route = request.scope.get("route")
+    # 未定義パスはラベルの種類が増え続けないようまとめて扱う
+    return getattr(route, "path", None) or "<unmatched>"
+
+
+async def middleware(request: Request, call_next):
+    """リクエストごとのレイテンシ・サイズ・SQL 集計を記録するミドルウェア。"""
+    method = request.method
+    stats = RequestStats(f"{method} {request.url.path}")
+    token = current_request.set(stats)
+    with _lock:
+        IN_FLIGHT.inc({"method": method})
+    started = time.perf_counter()
+    status = "500"
+    size = None
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        size = response.headers.get("content-length")
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        current_request.reset(token)
+        route = _route_label(request)
+        labels = {"method": method, "route": route}
+        with _lock:
+            IN_FLIGHT.inc({"method": method}, -1)
+            REQUESTS.inc({**labels, "status": status})
+            LATENCY.observe(labels, elapsed)
+            if size is not None:
+                RESPONSE_SIZE.observe(labels, int(size))
+            DB_QUERIES.observe(labels, stats.queries)
+            DB_TIME.observe(labels, stats.db_seconds)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start_time"].pop()
+    stats = current_request.get()
+    if stats is None:
+        with _lock:
+            DB_QUERIES_UNSCOPED.inc({})
+        return
+    stats.queries += 1
+    stats.db_seconds += time.perf_counter() - started
+
+
+def _handle_error(exception_context):
+    # 失敗した SQL の開始時刻が積み残らないようにする
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start_time"):
+        conn.info["query_start_time"].pop()
+
+
+def instrument_engine(engine) -> None:
+    """エンジンに SQL 計測用のイベントを登録する。"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+def record_startup(timings: Dict[str, float]) -> None:
+    """起動の各段階 (import / schema_check / pool / indexes / total) の所要時間を記録する。"""
+    with _lock:
+        STARTUP.series.clear()
+        for phase, seconds in timings.items():
+            STARTUP.inc({"phase": phase}, seconds)
+
+
+def render() -> str:
+    """Prometheus テキスト形式で全メトリクスを返す。"""
+    with _lock:
+        return "\n".join(metric.render() for metric in REGISTRY) + "\n"
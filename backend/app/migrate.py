@@ -0,0 +1,211 @@
+"""スキーマの作成・移行コマンド。
+
+API のワーカーは起動時にテーブルを作成しない。デプロイ時に 1 回だけ次を実行する::
+
+    python -m backend.app.migrate
+
+- 未作成のテーブルとそのインデックスを作成する (``create_all``)。
+- ``MIGRATIONS`` のうち未適用の手順を順に実行し、``schema_migrations`` に記録する。
+  各手順は以前のバージョンで作成したデータベースにも、新しく作成した
+  データベースにも安全に実行できる。
+- 複数のプロセスから同時に実行しても、アドバイザリロックで 1 つずつ実行される。
+
+``--check`` は未適用の手順を表示し、残っていれば終了コード 1 を返す。
+"""
+
+import argparse
+import sys
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from sqlalchemy import select, text
+from sqlalchemy.exc import DBAPIError, ProgrammingError
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import Base, engine
+
+LOCK_KEY = 0x6D656469  # "medi"
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[Session], None]
+
+
+def _sql(*statements: str) -> Callable[[Session], None]:
+    def apply(db: Session) -> None:
+        for statement in statements:
+            db.execute(text(statement))
+        db.commit()
+
+    return apply
+
+
+def _rebuild_phone_lookup(db: Session) -> None:
+    from . import phone_lookup
+
+    phone_lookup.rebuild(db)
+
+
+def _rebuild_template_search(db: Session) -> None:
+    from . import template_search
+
+    template_search.rebuild(db)
+
+
+def _reconcile_tag_usage(db: Session) -> None:
+    from . import tag_usage
+
+    tag_usage.reconcile(db)
+
+
+def _backfill_archived_blob_refs(db: Session) -> None:
+    from . import deleted_archive
+
+    deleted_archive.backfill_blob_refs(db)
+
+
+def _create_trgm_indexes(db: Session) -> None:
+    from . import facility_search, template_search
+
+    try:
+        facility_search.create_index(db)
+        template_search.create_index(db)
+    except DBAPIError as exc:
+        # pg_trgm が使えない環境でも部分一致はインデックス無しで動くため先へ進む
+        db.rollback()
+        print(
+            f"skipped pg_trgm indexes ({exc.orig}); run "
+            "`python -m backend.app.facility_search --create-index` and "
+            "`python -m backend.app.template_search --create-index` once it is available",
+            file=sys.stderr,
+        )
+
+
+MIGRATIONS = (
+    Migration(
+        1,
+        "deleted_at columns",
+        _sql(
+            "ALTER TABLE medical_facility ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+            "ALTER TABLE functions ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+            "ALTER TABLE memo_tags ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+            "ALTER TABLE facility_memos ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+            "ALTER TABLE memo_templates ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+        ),
+    ),
+    Migration(
+        2,
+        "note image blobs",
+        _sql(
+            "ALTER TABLE note_images ALTER COLUMN data DROP NOT NULL",
+            "ALTER TABLE note_images ADD COLUMN IF NOT EXISTS "
+            "blob_hash TEXT REFERENCES image_blobs(sha256)",
+            "CREATE INDEX IF NOT EXISTS ix_note_images_blob_hash ON note_images (blob_hash)",
+        ),
+    ),
+    Migration(
+        3,
+        "timestamp defaults",
+        _sql(
+            "ALTER TABLE facility_memos ALTER COLUMN updated_at SET DEFAULT now()",
+            "ALTER TABLE facility_memo_versions ALTER COLUMN created_at SET DEFAULT now()",
+            "ALTER TABLE facility_memo_locks ALTER COLUMN locked_at SET DEFAULT now()",
+            "ALTER TABLE note_images ALTER COLUMN created_at SET DEFAULT now()",
+            "ALTER TABLE memo_templates ALTER COLUMN updated_at SET DEFAULT now()",
+            "ALTER TABLE memo_template_versions ALTER COLUMN created_at SET DEFAULT now()",
+            "ALTER TABLE memo_template_locks ALTER COLUMN locked_at SET DEFAULT now()",
+            "ALTER TABLE note_image_gc_marks ALTER COLUMN marked_at SET DEFAULT now()",
+            "ALTER TABLE image_blobs ALTER COLUMN created_at SET DEFAULT now()",
+        ),
+    ),
+    Migration(4, "phone lookup table", _rebuild_phone_lookup),
+    Migration(5, "template search documents", _rebuild_template_search),
+    Migration(6, "tag usage counters", _reconcile_tag_usage),
+    Migration(7, "pg_trgm search indexes", _create_trgm_indexes),
+    Migration(8, "archived image blob refs", _backfill_archived_blob_refs),
+    Migration(9, "job input files", _sql("ALTER TABLE jobs ADD COLUMN IF NOT EXISTS input BYTEA")),
+    Migration(
+        10,
+        "version history indexes",
+        _sql(
+            "CREATE INDEX IF NOT EXISTS ix_facility_memo_versions_memo_version "
+            "ON facility_memo_versions (memo_id, version_no)",
+            "CREATE INDEX IF NOT EXISTS ix_memo_template_versions_template_version "
+            "ON memo_template_versions (template_id, version_no)",
+        ),
+    ),
+)
+
+
+def _applied(conn) -> set:
+    table = models.SchemaMigration.__table__
+    try:
+        return set(conn.execute(select(table.c.version)).scalars())
+    except ProgrammingError:
+        # schema_migrations が無い (一度も実行していない)
+        conn.rollback()
+        return set()
+
+
+def pending(conn=None) -> List[Migration]:
+    """未適用の手順を返す (API の起動時の確認用に 1 回の問い合わせで済ませる)。"""
+    if conn is None:
+        with engine.connect() as conn:
+            return pending(conn)
+    applied = _applied(conn)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def migrate() -> List[Migration]:
+    """テーブルを作成して未適用の手順を実行し、実行した手順を返す。"""
+    with engine.connect() as conn:
+        # 同時に起動した他のプロセスの完了を待つ (コミットをまたいで保持する)
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+        conn.commit()
+        try:
+            Base.metadata.create_all(bind=conn)
+            todo = pending(conn)
+            conn.commit()
+            done = []
+            db = Session(bind=conn)
+            try:
+                for migration in todo:
+                    migration.apply(db)
+                    db.add(models.SchemaMigration(version=migration.version, name=migration.name))
+                    db.commit()
+                    done.append(migration)
+            finally:
+                db.close()
+        finally:
+            conn.rollback()
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+            conn.commit()
+    return done
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Create and migrate the database schema.")
+    parser.add_argument(
+        "--check", action="store_true", help="only list pending migrations"
+    )
+    args = parser.parse_args(argv)
+    if args.check:
+        remaining = pending()
+        for m in remaining:
+            print(f"pending: {m.version} {m.name}")
+        if remaining:
+            sys.exit(1)
+        print("Schema is up to date")
+        return
+    done = migrate()
+    for m in done:
+        print(f"applied: {m.version} {m.name}")
+    print(f"Applied {len(done)} migrations")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,12 @@ from sqlalchemy import (
     Boolean,
     JSON,
     TIMESTAMP,
+    Index,
+    func,
 )
 from sqlalchemy.dialects.postgresql import BYTEA, UUID as PG_UUID
 import uuid
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import backref, column_property, deferred, relationship
 from .database import Base
 
 
@@ -43,6 +45,7 @@ class MedicalFacility(Base):
     fax = Column(Text)
     remarks = Column(Text)
     is_deleted = Column(Boolean, default=False)
+    deleted_at = Column(TIMESTAMP)  # 削除日時（削除済みデータのアーカイブ用）
 
     # 関連する機能情報をリレーションで持たせる
     functions = relationship(
@@ -50,6 +53,22 @@ class MedicalFacility(Base):
     )
 
 
+# 電話番号・FAX 番号の逆引き用テーブル（数字のみに正規化した番号）
+class FacilityPhoneNumber(Base):
+    __tablename__ = "facility_phone_numbers"
+
+    digits = Column(Text, primary_key=True)
+    facility_id = Column(
+        Integer,
+        ForeignKey("medical_facility.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    kind = Column(Text, primary_key=True)  # phone / fax
+    value = Column(Text, nullable=False)  # 登録されている表記
+    comment = Column(Text)
+
+
 # 機能マスタテーブル
 class Function(Base):
     __tablename__ = "functions"
@@ -64,6 +83,7 @@ class Function(Base):
     choices = Column(ARRAY(Text))
     category_id = Column(Integer, ForeignKey("function_categories.id"))
     is_deleted = Column(Boolean, default=False)
+    deleted_at = Column(TIMESTAMP)
 
     category = relationship("FunctionCategory", back_populates="functions")
     # 機能エントリ（中間テーブル）側からの逆参照
@@ -97,6 +117,7 @@ class MemoTag(Base):
     remark = Column(Text)
     color = Column(Text)
     is_deleted = Column(Boolean, default=False)
+    deleted_at = Column(TIMESTAMP)
 
     memos = relationship(
         "FacilityMemo",
@@ -110,6 +131,18 @@ class MemoTag(Base):
     )
 
 
+# タグごとの使用件数（紐付けの書き込み時に増減し、tag_usage の reconcile で補正する）
+class MemoTagUsage(Base):
+    __tablename__ = "memo_tag_usage"
+
+    tag_id = Column(
+        Integer, ForeignKey("memo_tags.id", ondelete="CASCADE"), primary_key=True
+    )
+    memos = Column(Integer, nullable=False, default=0)
+    deleted_memos = Column(Integer, nullable=False, default=0)
+    templates = Column(Integer, nullable=False, default=0)
+
+
 class FacilityMemo(Base):
     __tablename__ = "facility_memos"
 
@@ -119,8 +152,16 @@ class FacilityMemo(Base):
     title = Column(Text, nullable=False)
     content = Column(Text)
     is_deleted = Column(Boolean, default=False)
+    deleted_at = Column(TIMESTAMP)
     sort_order = Column(Integer, default=0)
-    updated_at = Column(TIMESTAMP, server_default="now()")
+    # 差分スナップショットの対象を決めるため、更新のたびに進める
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    # 本文を含まない一覧用 (fields / view で要求されたときだけ SELECT する)。
+    # ハッシュは markdown_render.content_hash と同じ値
+    content_length = column_property(
+        func.char_length(func.coalesce(content, "")), deferred=True
+    )
+    content_hash = column_property(func.md5(func.coalesce(content, "")), deferred=True)
 
     facility = relationship("MedicalFacility")
     versions = relationship(
@@ -149,12 +190,14 @@ class FacilityMemo(Base):
 
 class FacilityMemoVersion(Base):
     __tablename__ = "facility_memo_versions"
+    # 履歴一覧のキーセットページングで使う
+    __table_args__ = (Index("ix_facility_memo_versions_memo_version", "memo_id", "version_no"),)
 
     id = Column(Integer, primary_key=True)
     memo_id = Column(Integer, ForeignKey("facility_memos.id", ondelete="CASCADE"))
     version_no = Column(Integer, nullable=False)
     content = Column(Text)
-    created_at = Column(TIMESTAMP, server_default="now()")
+    created_at = Column(TIMESTAMP, server_default=func.now())
     ip_address = Column(Text)
     action = Column(Text)
 
@@ -177,12 +220,23 @@ class FacilityMemoLock(Base):
         Integer, ForeignKey("facility_memos.id", ondelete="CASCADE"), primary_key=True
     )
     locked_by = Column(Text)
-    locked_at = Column(TIMESTAMP, server_default="now()")
+    locked_at = Column(TIMESTAMP, server_default=func.now())
     ip_address = Column(Text)
 
     memo = relationship("FacilityMemo", back_populates="lock")
 
 
+# 画像の実データ（SHA-256 単位で 1 件だけ保存し、参照数を持つ）
+class ImageBlob(Base):
+    __tablename__ = "image_blobs"
+
+    sha256 = Column(Text, primary_key=True)
+    data = Column(BYTEA, nullable=False)
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+
 # 画像データ保存テーブル
 class NoteImage(Base):
     __tablename__ = "note_images"
@@ -191,10 +245,34 @@ class NoteImage(Base):
     memo_id = Column(Integer, ForeignKey("facility_memos.id", ondelete="CASCADE"))
     file_name = Column(Text, nullable=False)
     mime_type = Column(Text, nullable=False)
-    data = Column(BYTEA, nullable=False)
-    created_at = Column(TIMESTAMP, server_default="now()")
+    # 旧形式の画像のみ直接保持する。新規アップロードは blob_hash で image_blobs を参照
+    data = Column(BYTEA)
+    blob_hash = Column(Text, ForeignKey("image_blobs.sha256"), index=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
 
     memo = relationship("FacilityMemo", backref="images")
+    blob = relationship("ImageBlob")
+
+
+# アーカイブしたメモの画像が参照している blob（画像 GC の参照数に含める）
+class ArchivedBlobRef(Base):
+    __tablename__ = "archived_blob_refs"
+
+    image_id = Column(PG_UUID(as_uuid=True), primary_key=True)
+    memo_id = Column(Integer, nullable=False, index=True)
+    blob_hash = Column(Text, ForeignKey("image_blobs.sha256"), nullable=False, index=True)
+
+
+# 本文・履歴のどこからも参照されていない画像の印（画像 GC 用）
+class NoteImageGcMark(Base):
+    __tablename__ = "note_image_gc_marks"
+
+    image_id = Column(
+        PG_UUID(as_uuid=True),
+        ForeignKey("note_images.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    marked_at = Column(TIMESTAMP, server_default=func.now())
 
 
 # テンプレートテーブル
@@ -206,7 +284,8 @@ class MemoTemplate(Base):
     title = Column(Text, nullable=False)
     content = Column(Text)
     is_deleted = Column(Boolean, default=False)
-    updated_at = Column(TIMESTAMP, server_default="now()")
+    deleted_at = Column(TIMESTAMP)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     sort_order = Column(Integer, default=0)
 
     tags = relationship(
@@ -230,12 +309,15 @@ class MemoTemplate(Base):
 
 class MemoTemplateVersion(Base):
     __tablename__ = "memo_template_versions"
+    __table_args__ = (
+        Index("ix_memo_template_versions_template_version", "template_id", "version_no"),
+    )
 
     id = Column(Integer, primary_key=True)
     template_id = Column(Integer, ForeignKey("memo_templates.id", ondelete="CASCADE"))
     version_no = Column(Integer, nullable=False)
     content = Column(Text)
-    created_at = Column(TIMESTAMP, server_default="now()")
+    created_at = Column(TIMESTAMP, server_default=func.now())
     ip_address = Column(Text)
     action = Column(Text)
 
@@ -251,6 +333,19 @@ class MemoTemplateTagLink(Base):
     tag_id = Column(Integer, ForeignKey("memo_tags.id"), primary_key=True)
 
 
+# テンプレート検索用の正規化済み文書（名前・タイトル・タグ名・本文）
+class MemoTemplateSearch(Base):
+    __tablename__ = "memo_template_search"
+
+    template_id = Column(
+        Integer, ForeignKey("memo_templates.id", ondelete="CASCADE"), primary_key=True
+    )
+    name = Column(Text, nullable=False)
+    title = Column(Text, nullable=False)
+    tags = Column(Text, nullable=False)
+    document = Column(Text, nullable=False)
+
+
 class MemoTemplateLock(Base):
     __tablename__ = "memo_template_locks"
 
@@ -258,7 +353,89 @@ class MemoTemplateLock(Base):
         Integer, ForeignKey("memo_templates.id", ondelete="CASCADE"), primary_key=True
     )
     locked_by = Column(Text)
-    locked_at = Column(TIMESTAMP, server_default="now()")
+    locked_at = Column(TIMESTAMP, server_default=func.now())
     ip_address = Column(Text)
 
     template = relationship("MemoTemplate", back_populates="lock")
+
+
+# 保存期間を過ぎたメモ履歴のアーカイブ（created_at の月単位でパーティション分割）
+class FacilityMemoVersionArchive(Base):
+    __tablename__ = "facility_memo_version_archive"
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
+
+    memo_id = Column(Integer, primary_key=True)
+    version_no = Column(Integer, primary_key=True)
+    created_at = Column(TIMESTAMP, primary_key=True)
+    id = Column(Integer, nullable=False)  # 元の facility_memo_versions.id
+    content = Column(BYTEA)  # zlib 圧縮した本文
+    content_length = Column(Integer)
+    ip_address = Column(Text)
+    action = Column(Text)
+
+
+# 保存期間を過ぎたテンプレート履歴のアーカイブ
+class MemoTemplateVersionArchive(Base):
+    __tablename__ = "memo_template_version_archive"
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
+
+    template_id = Column(Integer, primary_key=True)
+    version_no = Column(Integer, primary_key=True)
+    created_at = Column(TIMESTAMP, primary_key=True)
+    id = Column(Integer, nullable=False)  # 元の memo_template_versions.id
+    content = Column(BYTEA)  # zlib 圧縮した本文
+    content_length = Column(Integer)
+    ip_address = Column(Text)
+    action = Column(Text)
+
+
+# 保存期間を過ぎた削除済みデータ（メモ・テンプレート・タグ・医療機関・機能）のアーカイブ。
+# 履歴や紐付けを含めて zlib 圧縮した JSON で保持する
+class DeletedRecordArchive(Base):
+    __tablename__ = "deleted_record_archive"
+
+    kind = Column(Text, primary_key=True)  # memo / template / tag / facility / function
+    record_id = Column(Integer, primary_key=True)
+    label = Column(Text)  # 一覧表示用のタイトル・名前
+    deleted_at = Column(TIMESTAMP)
+    archived_at = Column(TIMESTAMP, server_default=func.now())
+    payload = Column(BYTEA, nullable=False)
+
+
+# バックグラウンドジョブのキュー（python -m backend.app.jobs のワーカーが処理する）
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_run_after", "status", "run_after"),)
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(Text, nullable=False)
+    payload = Column(JSON)
+    # 取り込む CSV などの入力ファイル (payload の JSON には入れない)
+    input = deferred(Column(BYTEA))
+    status = Column(Text, nullable=False, default="queued")  # queued / running / succeeded / failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    progress_done = Column(Integer)
+    progress_total = Column(Integer)
+    message = Column(Text)
+    result = Column(JSON)
+    error = Column(Text)
+    # エクスポートなどの出力ファイル
+    output = Column(BYTEA)
+    output_name = Column(Text)
+    output_type = Column(Text)
+    worker = Column(Text)
+    run_after = Column(TIMESTAMP, server_default=func.now())
+    heartbeat_at = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    started_at = Column(TIMESTAMP)
+    finished_at = Column(TIMESTAMP)
+
+
+# 適用済みのスキーマ移行手順（python -m backend.app.migrate が記録する）
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    name = Column(Text, nullable=False)
+    applied_at = Column(TIMESTAMP, server_default=func.now())
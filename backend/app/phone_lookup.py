@@ -0,0 +1,140 @@
+"""電話番号・FAX 番号からの医療機関の逆引き。
+
+``MedicalFacility.phone_numbers`` (JSON) と ``fax`` は表記揺れ
+(ハイフン・括弧・全角数字など) があるため、数字のみに正規化した番号を
+``facility_phone_numbers`` に保持し、主キーの先頭列 ``digits`` で引く。
+医療機関の登録・更新時と CSV 取り込み時に ``sync`` で更新する。
+
+既存データからの作り直し::
+
+    python -m backend.app.phone_lookup --rebuild
+"""
+
+import argparse
+import re
+import unicodedata
+from typing import Iterable, List, Optional
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+_NON_DIGITS = re.compile(r"\D")
+
+
+def normalize_phone(value: Optional[str]) -> str:
+    """数字だけを残す。国番号 +81 は先頭の 0 に置き換える。"""
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKC", value).strip()
+    digits = _NON_DIGITS.sub("", value)
+    if value.startswith("+81") and digits.startswith("81"):
+        digits = "0" + digits[2:].lstrip("0")
+    return digits
+
+
+def rows_for(facility_id: int, phone_numbers, fax: Optional[str]) -> List[dict]:
+    """``facility_phone_numbers`` に入れる行を返す。"""
+    numbers = [
+        ("phone", p.get("value"), p.get("comment"))
+        for p in (phone_numbers or [])
+        if isinstance(p, dict)
+    ]
+    numbers.append(("fax", fax, None))
+    rows = {}
+    for kind, value, comment in numbers:
+        digits = normalize_phone(value)
+        if digits and (digits, kind) not in rows:
+            rows[(digits, kind)] = {
+                "digits": digits,
+                "facility_id": facility_id,
+                "kind": kind,
+                "value": value,
+                "comment": comment,
+            }
+    return list(rows.values())
+
+
+def sync(db: Session, facilities: Iterable[models.MedicalFacility]) -> None:
+    """医療機関の番号を逆引きテーブルに反映する (コミットは呼び出し側)。"""
+    facilities = list(facilities)
+    if not facilities:
+        return
+    table = models.FacilityPhoneNumber
+    db.execute(delete(table).where(table.facility_id.in_([f.id for f in facilities])))
+    rows = [r for f in facilities for r in rows_for(f.id, f.phone_numbers, f.fax)]
+    if rows:
+        db.execute(insert(table), rows)
+
+
+def lookup(db: Session, phone: str, include_deleted: bool = False) -> List[dict]:
+    digits = normalize_phone(phone)
+    if not digits:
+        return []
+    table = models.FacilityPhoneNumber
+    fac = models.MedicalFacility
+    query = (
+        select(
+            table.facility_id,
+            fac.short_name,
+            fac.official_name,
+            table.kind,
+            table.value,
+            table.comment,
+            fac.is_deleted,
+        )
+        .join(fac, fac.id == table.facility_id)
+        .where(table.digits == digits)
+        .order_by(table.facility_id, table.kind)
+    )
+    if not include_deleted:
+        query = query.where(fac.is_deleted == False)
+    return [dict(r._mapping) for r in db.execute(query)]
+
+
+def rebuild(db: Session, batch_size: int = 1000) -> int:
+    """全医療機関の番号を作り直し、登録した番号の件数を返す。"""
+    fac = models.MedicalFacility
+    total = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(fac.id, fac.phone_numbers, fac.fax)
+            .where(fac.id > last_id)
+            .order_by(fac.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        table = models.FacilityPhoneNumber
+        ids = [r.id for r in rows]
+        db.execute(delete(table).where(table.facility_id.in_(ids)))
+        numbers = [n for r in rows for n in rows_for(r.id, r.phone_numbers, r.fax)]
+        if numbers:
+            db.execute(insert(table), numbers)
+        db.commit()
+        total += len(numbers)
+        last_id = ids[-1]
+    return total
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Phone number lookup utilities.")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="rebuild facility_phone_numbers"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+    if args.rebuild:
+        db = SessionLocal()
+        try:
+            total = rebuild(db, args.batch_size)
+        finally:
+            db.close()
+        print(f"indexed {total} numbers")
+
+
+if __name__ == "__main__":
+    main()
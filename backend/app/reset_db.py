@@ -1,11 +1,11 @@
 from .database import Base, engine
-from . import models  # ensure models are registered with Base
+from . import migrate, models  # ensure models are registered with Base
 
 
 def reset_db():
     """Drop all tables and recreate them."""
     Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    migrate.migrate()
     print("Database reset completed.")
 
 
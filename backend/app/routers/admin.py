@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from .. import database, deleted_archive, schemas, slow_query
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+def get_db():
+    db = database.SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@router.get("/slow-queries", response_model=List[schemas.SlowQueryStat])
+def read_slow_queries(
+    limit: int = Query(20, ge=1, le=500),
+    order_by: str = Query(
+        "total_seconds", pattern="^(total_seconds|max_seconds|count)$"
+    ),
+):
+    """閾値を超えた SQL を合計時間などの降順で返す。"""
+    return slow_query.top_queries(limit, order_by)
+
+
+@router.delete("/slow-queries", response_model=dict)
+def clear_slow_queries():
+    slow_query.reset()
+    return {"message": "cleared"}
+
+
+@router.get("/archive", response_model=List[schemas.ArchivedRecord])
+def read_archived_records(
+    kind: Optional[str] = Query(
+        None, pattern="^(memo|template|tag|facility|function)$"
+    ),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+):
+    """アーカイブ済みの削除データを新しい順に返す (復元は各 API の /restore)。"""
+    return deleted_archive.archived_records(db, kind, skip, limit)
@@ -1,7 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from .. import database, schemas, models
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
+from typing import List, Optional
+from .. import (
+    database,
+    deleted_archive,
+    facility_search,
+    fieldsets,
+    models,
+    phone_lookup,
+    schemas,
+    serializers,
+)
+from ..responses import FastJSONResponse
 
 # /facilities で始まるAPIルート
 router = APIRouter(prefix="/facilities", tags=["facilities"])
@@ -24,32 +35,70 @@ def read_facilities(
     skip: int = 0,
     limit: int | None = None,
     include_deleted: bool = False,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     db: Session = Depends(get_db),
 ):
     """
     医療機関情報の一覧を取得するAPI。
     ページネーションとして skip / limit を指定可能。
+    fields / view で返却項目を絞り込める。
     """
+    selected = fieldsets.FACILITIES.resolve(fields, view)
     query = db.query(models.MedicalFacility)
+    if selected is not None:
+        query = query.options(*fieldsets.FACILITIES.load_options(selected))
+    else:
+        query = query.options(
+            selectinload(models.MedicalFacility.functions).selectinload(
+                models.FacilityFunctionEntry.function
+            )
+        )
     if not include_deleted:
         query = query.filter(models.MedicalFacility.is_deleted == False)
     query = query.offset(skip)
     if limit is not None:
         query = query.limit(limit)
     facilities = query.all()
+    if selected is not None:
+        return FastJSONResponse(
+            [fieldsets.FACILITIES.serialize(fac, selected) for fac in facilities]
+        )
 
     # 削除済み機能を除外したリストを作成
-    results: List[schemas.MedicalFacility] = []
-    for fac in facilities:
-        fac_data = schemas.MedicalFacility.from_orm(fac)
-        fac_data.functions = [
-            schemas.FacilityFunctionEntryBase.from_orm(entry)
-            for entry in fac.functions
-            if entry.function and not entry.function.is_deleted
-        ]
-        results.append(fac_data)
+    # 件数が多いため Pydantic での検証を経由せず直接シリアライズする
+    results = [
+        serializers.facility_dict(fac, serializers.active_entries(fac))
+        for fac in facilities
+    ]
+    return FastJSONResponse(results)
 
-    return results
+# 医療機関の名称・住所検索（GET /facilities/search）
+@router.get("/search", response_model=List[schemas.FacilitySearchResult])
+def search_facilities(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+):
+    """
+    入力補完用の検索API。
+    全角・半角、カタカナ・ひらがなの違いを無視し、前方一致を優先して返す。
+    """
+    hits = facility_search.search(db, q, limit)
+    return FastJSONResponse([h.to_dict() for h in hits])
+
+# 電話番号・FAX 番号から医療機関を逆引き（GET /facilities/lookup）
+@router.get("/lookup", response_model=List[schemas.PhoneLookupResult])
+def lookup_facilities(
+    phone: str = Query(..., min_length=1, max_length=50),
+    include_deleted: bool = False,
+    db: Session = Depends(get_db),
+):
+    """
+    着信番号などから医療機関を探すAPI。
+    ハイフンや括弧、全角数字の違いは無視する。
+    """
+    return FastJSONResponse(phone_lookup.lookup(db, phone, include_deleted))
 
 # 医療機関を新規登録（POST /facilities）
 @router.post("", response_model=schemas.MedicalFacility)
@@ -60,8 +109,11 @@ def create_facility(facility: schemas.MedicalFacilityBase, db: Session = Depends
     """
     db_facility = models.MedicalFacility(**facility.dict())
     db.add(db_facility)
+    db.flush()
+    phone_lookup.sync(db, [db_facility])
     db.commit()
     db.refresh(db_facility)  # 保存後の最新情報を返す
+    facility_search.index.update(db_facility)
     return db_facility
 
 # 医療機関を更新する（PUT /facilities/{facility_id}）
@@ -78,11 +130,15 @@ def update_facility(facility_id: int, update_data: schemas.MedicalFacilityUpdate
         raise HTTPException(status_code=404, detail="Facility not found")
 
     # 送られてきた項目だけ更新する
-    for key, value in update_data.dict(exclude_unset=True).items():
+    changes = update_data.dict(exclude_unset=True)
+    for key, value in changes.items():
         setattr(db_facility, key, value)
+    if "phone_numbers" in changes or "fax" in changes:
+        phone_lookup.sync(db, [db_facility])
 
     db.commit()
     db.refresh(db_facility)
+    facility_search.index.update(db_facility)
     return db_facility
 
 # 医療機関を削除する（DELETE /facilities/{facility_id}）
@@ -97,8 +153,11 @@ def delete_facility(facility_id: int, db: Session = Depends(get_db)):
     if not db_facility:
         raise HTTPException(status_code=404, detail="Facility not found")
 
+    if not db_facility.is_deleted:
+        db_facility.deleted_at = func.now()
     db_facility.is_deleted = True
     db.commit()
+    facility_search.index.update(db_facility)
     return {"message": "Facility deleted successfully"}
 
 
@@ -113,8 +172,11 @@ def restore_facility(facility_id: int, db: Session = Depends(get_db)):
         .first()
     )
     if not db_facility:
-        raise HTTPException(status_code=404, detail="Facility not found")
+        # 保存期間を過ぎてアーカイブ済みなら戻してから復元する
+        db_facility = deleted_archive.restore(db, deleted_archive.FACILITY, facility_id)
     db_facility.is_deleted = False
+    db_facility.deleted_at = None
     db.commit()
     db.refresh(db_facility)
+    facility_search.index.update(db_facility)
     return db_facility
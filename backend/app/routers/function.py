@@ -1,7 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import List
-from .. import database, schemas, models
+from typing import List, Optional
+from .. import database, deleted_archive, fieldsets, jobs, schemas, models, serializers
+from ..responses import FastJSONResponse
 
 # /functions で始まるAPIルート
 router = APIRouter(prefix="/functions", tags=["functions"])
@@ -22,13 +24,20 @@ def read_functions(
     skip: int = 0,
     limit: int = 100,
     include_deleted: bool = False,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     db: Session = Depends(get_db),
 ):
+    selected = fieldsets.FUNCTIONS.resolve(fields, view)
     query = db.query(models.Function)
+    if selected is not None:
+        query = query.options(*fieldsets.FUNCTIONS.load_options(selected))
     if not include_deleted:
         query = query.filter(models.Function.is_deleted == False)
     functions = query.offset(skip).limit(limit).all()
-    return functions
+    if selected is not None:
+        return FastJSONResponse([fieldsets.FUNCTIONS.serialize(f, selected) for f in functions])
+    return FastJSONResponse([serializers.function_dict(f) for f in functions])
 
 # 機能マスタ新規作成（POST /functions）
 @router.post("", response_model=schemas.FunctionBase)
@@ -43,7 +52,12 @@ def create_function(function: schemas.FunctionCreate, db: Session = Depends(get_
 
 # 機能マスタ更新（PUT /functions/{function_id}）
 @router.put("/{function_id}", response_model=schemas.FunctionBase)
-def update_function(function_id: int, update_data: schemas.FunctionUpdate, db: Session = Depends(get_db)):
+def update_function(
+    function_id: int,
+    update_data: schemas.FunctionUpdate,
+    response: Response,
+    db: Session = Depends(get_db),
+):
     """
     機能マスタ情報を更新するAPI。
     部分更新対応。対象がなければ404。
@@ -60,25 +74,13 @@ def update_function(function_id: int, update_data: schemas.FunctionUpdate, db: S
     for key, value in update_data.dict(exclude_unset=True).items():
         setattr(db_function, key, value)
 
+    # selection_type 変更や choices 更新時は関連エントリの上書きをジョブで行う
+    if update_data.selection_type is not None or update_data.choices is not None:
+        job = jobs.enqueue(db, "function_choices", {"function_id": function_id})
+        response.headers["X-Job-Id"] = str(job.id)
+
     db.commit()
     db.refresh(db_function)
-
-    # selection_type 変更や choices 更新時は関連エントリを上書き
-    if update_data.selection_type is not None or update_data.choices is not None:
-        entries = (
-            db.query(models.FacilityFunctionEntry)
-            .filter(models.FacilityFunctionEntry.function_id == function_id)
-            .all()
-        )
-        for e in entries:
-            if db_function.selection_type == "multiple":
-                choices = db_function.choices or []
-                e.selected_values = [
-                    v for v in (e.selected_values or []) if v in choices
-                ]
-            else:
-                e.selected_values = []
-        db.commit()
     return db_function
 
 
@@ -97,6 +99,8 @@ def delete_function(function_id: int, db: Session = Depends(get_db)):
     if not db_function:
         raise HTTPException(status_code=404, detail="Function not found")
     
+    if not db_function.is_deleted:
+        db_function.deleted_at = func.now()
     db_function.is_deleted = True
     db.commit()
     return {"message": "Function deleted successfully"}
@@ -110,8 +114,9 @@ def restore_function(function_id: int, db: Session = Depends(get_db)):
         .first()
     )
     if not db_function:
-        raise HTTPException(status_code=404, detail="Function not found")
+        db_function = deleted_archive.restore(db, deleted_archive.FUNCTION, function_id)
     db_function.is_deleted = False
+    db_function.deleted_at = None
     db.commit()
     db.refresh(db_function)
     return db_function
@@ -0,0 +1,112 @@
+import csv
+import io
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Response, UploadFile
+from sqlalchemy.orm import Session
+from .. import database, import_facilities_csv, jobs, models, schemas
+from ..responses import FastJSONResponse
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+
+def get_db():
+    db = database.SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _get_job(db: Session, job_id: int) -> models.Job:
+    job = db.get(models.Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def _enqueue(
+    db: Session, kind: str, payload: dict, max_attempts: int = 3, input: Optional[bytes] = None
+):
+    job = jobs.enqueue(db, kind, payload, max_attempts, input)
+    db.commit()
+    db.refresh(job)
+    return FastJSONResponse(jobs.job_dict(job))
+
+
+@router.get("", response_model=List[schemas.JobStatus])
+def list_jobs(
+    status: Optional[str] = Query(None, pattern="^(queued|running|succeeded|failed)$"),
+    kind: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db),
+):
+    query = db.query(models.Job)
+    if status:
+        query = query.filter(models.Job.status == status)
+    if kind:
+        query = query.filter(models.Job.kind == kind)
+    rows = query.order_by(models.Job.id.desc()).limit(limit).all()
+    return FastJSONResponse([jobs.job_dict(j) for j in rows])
+
+
+@router.post("", response_model=schemas.JobStatus)
+def create_job(job: schemas.JobCreate, db: Session = Depends(get_db)):
+    """ジョブを積む。処理は ``python -m backend.app.jobs`` のワーカーが行う。"""
+    if job.kind not in jobs.HANDLERS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind: {job.kind}")
+    return _enqueue(db, job.kind, job.payload or {}, job.max_attempts)
+
+
+@router.post("/import-facilities", response_model=schemas.JobStatus)
+def import_facilities(
+    file: UploadFile = File(...),
+    mode: str = Query("append", pattern="^(append|sync)$"),
+    key: Optional[str] = None,
+    delete_missing: bool = True,
+    db: Session = Depends(get_db),
+):
+    """医療機関の CSV を受け取り、取り込みジョブを積む。
+
+    mode=sync では既存の医療機関と突き合わせて差分だけを反映する
+    (key はカンマ区切りの自然キーの列名)。CSV はジョブの ``input`` に保存する。
+    """
+    data = file.file.read()
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV must be UTF-8")
+    if mode == "append":
+        return _enqueue(db, "import_facilities_csv", {}, input=data)
+    keys = [k.strip() for k in key.split(",") if k.strip()] if key else None
+    header = next(csv.reader(io.StringIO(text)), [])
+    missing = [k for k in keys or import_facilities_csv.SYNC_KEY if k not in header]
+    if missing:
+        raise HTTPException(
+            status_code=400, detail=f"Key columns not in CSV: {', '.join(missing)}"
+        )
+    payload = {"delete_missing": delete_missing, "key": keys}
+    return _enqueue(db, "sync_facilities_csv", payload, input=data)
+
+
+@router.post("/export-facilities", response_model=schemas.JobStatus)
+def export_facilities(include_deleted: bool = False, db: Session = Depends(get_db)):
+    """医療機関の CSV 書き出しジョブを積む。結果は /jobs/{id}/output で取得する。"""
+    return _enqueue(db, "export_facilities_csv", {"include_deleted": include_deleted})
+
+
+@router.get("/{job_id}", response_model=schemas.JobStatus)
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    return FastJSONResponse(jobs.job_dict(_get_job(db, job_id)))
+
+
+@router.get("/{job_id}/output", response_class=Response)
+def get_job_output(job_id: int, db: Session = Depends(get_db)):
+    job = _get_job(db, job_id)
+    if job.output_name is None:
+        raise HTTPException(status_code=404, detail="Job has no output")
+    return Response(
+        content=job.output,
+        media_type=job.output_type,
+        headers={"Content-Disposition": f'attachment; filename="{job.output_name}"'},
+    )
@@ -1,11 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, selectinload
 from typing import List, Optional
-from datetime import datetime, timedelta, timezone
-from .. import database, schemas, models
+from datetime import datetime
+from .. import (
+    database,
+    deleted_archive,
+    edit_lock,
+    fieldsets,
+    markdown_render,
+    models,
+    schemas,
+    serializers,
+    tag_index,
+    tag_usage,
+    version_archive,
+    version_diff,
+)
+from ..responses import FastJSONResponse
 
 router = APIRouter(prefix="/memos", tags=["memos"])
 
+MAX_CONTENT_IDS = 200  # GET /memos/contents で一度に指定できる件数
+
 
 def get_db():
     db = database.SessionLocal()
@@ -17,24 +35,154 @@ def get_db():
 
 @router.get("/facility/{facility_id}", response_model=List[schemas.FacilityMemoBase])
 def read_memos(
-    facility_id: int, include_deleted: bool = False, db: Session = Depends(get_db)
+    facility_id: int,
+    include_deleted: bool = False,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
+    tag: Optional[List[int]] = Query(None),
+    mode: str = Query("and", pattern="^(and|or)$"),
+    db: Session = Depends(get_db),
+):
+    return _list_memos(
+        db,
+        models.FacilityMemo.facility_id == facility_id,
+        include_deleted,
+        fields,
+        view,
+        tag,
+        mode,
+    )
+
+
+@router.get("/general", response_model=List[schemas.FacilityMemoBase])
+def read_general_memos(
+    include_deleted: bool = False,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
+    tag: Optional[List[int]] = Query(None),
+    mode: str = Query("and", pattern="^(and|or)$"),
+    db: Session = Depends(get_db),
 ):
-    query = db.query(models.FacilityMemo).filter(
-        models.FacilityMemo.facility_id == facility_id
+    return _list_memos(
+        db,
+        models.FacilityMemo.facility_id.is_(None),
+        include_deleted,
+        fields,
+        view,
+        tag,
+        mode,
     )
+
+
+def _list_memos(
+    db: Session, condition, include_deleted: bool, fields, view, tag=None, mode="and"
+):
+    """メモ一覧。``tag`` を指定した場合は mode (and / or) で絞り込む。"""
+    selected = fieldsets.MEMOS.resolve(fields, view)
+    query = db.query(models.FacilityMemo).filter(condition)
     if not include_deleted:
         query = query.filter(models.FacilityMemo.is_deleted == False)
+    if tag:
+        query = tag_index.filter_query(db, query, tag, mode)
+    if selected is not None:
+        query = query.options(*fieldsets.MEMOS.load_options(selected))
+    else:
+        query = query.options(selectinload(models.FacilityMemo.tags))
     memos = query.order_by(models.FacilityMemo.sort_order.asc()).all()
-    return memos
+    if selected is not None:
+        return FastJSONResponse([fieldsets.MEMOS.serialize(m, selected) for m in memos])
+    return FastJSONResponse([serializers.memo_dict(m) for m in memos])
 
 
-@router.get("/general", response_model=List[schemas.FacilityMemoBase])
-def read_general_memos(include_deleted: bool = False, db: Session = Depends(get_db)):
-    query = db.query(models.FacilityMemo).filter(models.FacilityMemo.facility_id.is_(None))
+@router.get("/facility/{facility_id}/bootstrap", response_model=schemas.MemoBootstrap)
+def bootstrap_memos(
+    facility_id: int,
+    selected: Optional[int] = None,
+    include_deleted: bool = False,
+    db: Session = Depends(get_db),
+):
+    """メモ画面の初期表示に必要なデータ (医療機関・一覧・タグ・ロック・選択中の本文) を返す。"""
+    fac_fields = fieldsets.FACILITIES.resolve(None, "summary")
+    facility = (
+        db.query(models.MedicalFacility)
+        .options(*fieldsets.FACILITIES.load_options(fac_fields))
+        .filter(models.MedicalFacility.id == facility_id)
+        .first()
+    )
+    if not facility:
+        raise HTTPException(status_code=404, detail="Facility not found")
+    return _bootstrap(
+        db,
+        models.FacilityMemo.facility_id == facility_id,
+        fieldsets.FACILITIES.serialize(facility, fac_fields),
+        selected,
+        include_deleted,
+    )
+
+
+@router.get("/general/bootstrap", response_model=schemas.MemoBootstrap)
+def bootstrap_general_memos(
+    selected: Optional[int] = None,
+    include_deleted: bool = False,
+    db: Session = Depends(get_db),
+):
+    return _bootstrap(
+        db, models.FacilityMemo.facility_id.is_(None), None, selected, include_deleted
+    )
+
+
+def _bootstrap(db: Session, condition, facility, selected, include_deleted: bool):
+    """一覧は本文を含まない ``view=summary`` で返し、本文は ``selected`` の 1 件だけ読む。"""
+    fields = fieldsets.MEMOS.resolve(None, "summary")
+    query = db.query(models.FacilityMemo).filter(condition)
     if not include_deleted:
         query = query.filter(models.FacilityMemo.is_deleted == False)
-    memos = query.order_by(models.FacilityMemo.sort_order.asc()).all()
-    return memos
+    memos = (
+        query.options(*fieldsets.MEMOS.load_options(fields))
+        .order_by(models.FacilityMemo.sort_order.asc())
+        .all()
+    )
+    current = None
+    if selected is not None and any(m.id == selected for m in memos):
+        row = (
+            db.query(
+                models.FacilityMemo.id,
+                models.FacilityMemo.content,
+                models.FacilityMemo.content_hash,
+            )
+            .filter(models.FacilityMemo.id == selected)
+            .first()
+        )
+        current = {"id": row.id, "content": row.content, "content_hash": row.content_hash}
+    return FastJSONResponse(
+        {
+            "facility": facility,
+            "memos": [fieldsets.MEMOS.serialize(m, fields) for m in memos],
+            "tags": tag_usage.tags_with_usage(db),
+            "locks": _active_locks(db, condition),
+            "selected": current,
+        }
+    )
+
+
+@router.get("/contents", response_model=List[schemas.FacilityMemoContent])
+def read_memo_contents(ids: List[int] = Query(...), db: Session = Depends(get_db)):
+    """一覧 (view=summary) で省いた本文を id を指定してまとめて返す。存在しない id は含めない。"""
+    if len(ids) > MAX_CONTENT_IDS:
+        raise HTTPException(status_code=400, detail=f"Too many ids (max {MAX_CONTENT_IDS})")
+    rows = (
+        db.query(
+            models.FacilityMemo.id,
+            models.FacilityMemo.content,
+            models.FacilityMemo.content_hash,
+        )
+        .filter(models.FacilityMemo.id.in_(set(ids)))
+        .order_by(models.FacilityMemo.id)
+        .all()
+    )
+    return FastJSONResponse(
+        [{"id": r.id, "content": r.content, "content_hash": r.content_hash} for r in rows]
+    )
 
 
 @router.post("/facility/{facility_id}", response_model=schemas.FacilityMemoBase)
@@ -63,8 +211,10 @@ def create_memo(
     db.refresh(db_memo)
     for tag_id in memo.tag_ids or []:
         db.add(models.FacilityMemoTagLink(memo_id=db_memo.id, tag_id=tag_id))
+    tag_usage.memo_tags_changed(db, [], memo.tag_ids or [])
     db.commit()
     db.refresh(db_memo)
+    tag_index.index.set_tags(db_memo.id, memo.tag_ids or [])
 
     # record initial version
     client_ip = request.headers.get("X-Forwarded-For") or request.client.host
@@ -106,8 +256,10 @@ def create_general_memo(
     db.refresh(db_memo)
     for tag_id in memo.tag_ids or []:
         db.add(models.FacilityMemoTagLink(memo_id=db_memo.id, tag_id=tag_id))
+    tag_usage.memo_tags_changed(db, [], memo.tag_ids or [])
     db.commit()
     db.refresh(db_memo)
+    tag_index.index.set_tags(db_memo.id, memo.tag_ids or [])
     client_ip = request.headers.get("X-Forwarded-For") or request.client.host
     db.add(
         models.FacilityMemoVersion(
@@ -132,6 +284,12 @@ def get_memo(memo_id: int, db: Session = Depends(get_db)):
     return db_memo
 
 
+@router.get("/{memo_id}/html", response_class=Response)
+def get_memo_html(memo_id: int, request: Request, db: Session = Depends(get_db)):
+    """本文を HTML に変換して返す。ETag による条件付き取得に対応。"""
+    return markdown_render.html_response(request, db, models.FacilityMemo, memo_id)
+
+
 @router.put("/{memo_id}", response_model=schemas.FacilityMemoBase)
 def update_memo(
     memo_id: int,
@@ -171,6 +329,8 @@ def update_memo(
     if update.parent_id is not None:
         db_memo.parent_id = update.parent_id
     if update.tag_ids is not None:
+        old_tags = tag_usage.memo_tag_ids(db, memo_id)
+        tag_usage.memo_tags_changed(db, old_tags, update.tag_ids, bool(db_memo.is_deleted))
         db.query(models.FacilityMemoTagLink).filter(
             models.FacilityMemoTagLink.memo_id == memo_id
         ).delete()
@@ -178,6 +338,8 @@ def update_memo(
             db.add(models.FacilityMemoTagLink(memo_id=memo_id, tag_id=tid))
     db.commit()
     db.refresh(db_memo)
+    if update.tag_ids is not None:
+        tag_index.index.set_tags(memo_id, update.tag_ids)
     return db_memo
 
 
@@ -188,6 +350,9 @@ def delete_memo(memo_id: int, request: Request, db: Session = Depends(get_db)):
     )
     if not db_memo:
         raise HTTPException(status_code=404, detail="Memo not found")
+    if not db_memo.is_deleted:
+        tag_usage.memo_deleted_changed(db, tag_usage.memo_tag_ids(db, memo_id), True)
+        db_memo.deleted_at = func.now()
     db_memo.is_deleted = True
     latest_version = (
         db.query(models.FacilityMemoVersion)
@@ -219,9 +384,13 @@ def restore_memo(memo_id: int, request: Request, db: Session = Depends(get_db)):
         )
         .first()
     )
-    if not db_memo:
-        raise HTTPException(status_code=404, detail="Memo not found")
+    # 保存期間を過ぎてアーカイブ済みなら戻してから復元する
+    archived = db_memo is None
+    if archived:
+        db_memo = deleted_archive.restore(db, deleted_archive.MEMO, memo_id)
+    tag_usage.memo_deleted_changed(db, tag_usage.memo_tag_ids(db, memo_id), False)
     db_memo.is_deleted = False
+    db_memo.deleted_at = None
     latest_version = (
         db.query(models.FacilityMemoVersion)
         .filter(models.FacilityMemoVersion.memo_id == memo_id)
@@ -241,6 +410,8 @@ def restore_memo(memo_id: int, request: Request, db: Session = Depends(get_db)):
     )
     db.commit()
     db.refresh(db_memo)
+    if archived:
+        tag_index.index.set_tags(memo_id, tag_usage.memo_tag_ids(db, memo_id))
     return db_memo
 
 
@@ -250,6 +421,7 @@ def get_versions(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
     ip_address: Optional[str] = None,
+    include_archived: bool = False,
     db: Session = Depends(get_db),
 ):
     query = db.query(models.FacilityMemoVersion).filter(
@@ -262,9 +434,92 @@ def get_versions(
     if ip_address:
         query = query.filter(models.FacilityMemoVersion.ip_address == ip_address)
     versions = query.order_by(models.FacilityMemoVersion.version_no.desc()).all()
+    if include_archived:
+        # 保存期間を過ぎた履歴はアーカイブから取得して後ろに連結する
+        versions += version_archive.archived_versions(
+            db, version_archive.MEMO_VERSIONS, memo_id, start_date, end_date, ip_address
+        )
     return versions
 
 
+@router.get(
+    "/{memo_id}/versions/summary",
+    response_model=List[schemas.FacilityMemoVersionSummary],
+)
+def get_version_summaries(
+    memo_id: int,
+    before: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=500),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    ip_address: Optional[str] = None,
+    include_archived: bool = False,
+    db: Session = Depends(get_db),
+):
+    """本文を含まない履歴一覧。次ページは最後の version_no を before に指定する。"""
+    return version_archive.version_summaries(
+        db,
+        version_archive.MEMO_VERSIONS,
+        memo_id,
+        before,
+        limit,
+        start_date,
+        end_date,
+        ip_address,
+        include_archived,
+    )
+
+
+@router.get("/{memo_id}/versions/diff", response_model=schemas.VersionDiff)
+async def get_version_diff(
+    memo_id: int,
+    from_no: int = Query(..., alias="from"),
+    to_no: int = Query(..., alias="to"),
+    mode: str = Query("line", pattern="^(line|char)$"),
+    full: bool = False,
+    db: Session = Depends(get_db),
+):
+    """2 つの版の差分を返す。full=true で変更のない区間の本文も含める。"""
+    key = ("memo", memo_id, from_no, to_no)
+    ops = version_diff.cached(key, mode, full)
+    if ops is None:
+
+        def load():
+            return [
+                version_archive.find_version_content(
+                    db, version_archive.MEMO_VERSIONS, memo_id, no
+                )
+                for no in (from_no, to_no)
+            ]
+
+        old, new = await run_in_threadpool(load)
+        if old is None or new is None:
+            raise HTTPException(status_code=404, detail="Version not found")
+        ops = await version_diff.diff(key, old["content"], new["content"], mode, full)
+    return {"from_version": from_no, "to_version": to_no, "mode": mode, "ops": ops}
+
+
+@router.get(
+    "/{memo_id}/versions/{version_no}", response_model=schemas.FacilityMemoVersionBase
+)
+def get_version(memo_id: int, version_no: int, db: Session = Depends(get_db)):
+    version = (
+        db.query(models.FacilityMemoVersion)
+        .filter(
+            models.FacilityMemoVersion.memo_id == memo_id,
+            models.FacilityMemoVersion.version_no == version_no,
+        )
+        .first()
+    )
+    if not version:
+        version = version_archive.find_archived_version(
+            db, version_archive.MEMO_VERSIONS, memo_id, version_no
+        )
+    if not version:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return version
+
+
 @router.post(
     "/{memo_id}/versions/{version_no}/restore", response_model=schemas.FacilityMemoBase
 )
@@ -284,8 +539,13 @@ def restore_version(
         )
         .first()
     )
+    if not version:
+        version = version_archive.find_archived_version(
+            db, version_archive.MEMO_VERSIONS, memo_id, version_no
+        )
     if not version:
         raise HTTPException(status_code=404, detail="Version not found")
+    version_content = version["content"] if isinstance(version, dict) else version.content
     latest = (
         db.query(models.FacilityMemoVersion)
         .filter(models.FacilityMemoVersion.memo_id == memo_id)
@@ -303,69 +563,52 @@ def restore_version(
             action="restore",
         )
     )
-    memo.content = version.content
+    memo.content = version_content
     db.commit()
     db.refresh(memo)
     return memo
 
 
-LOCK_TIMEOUT = timedelta(minutes=5)
+@router.get("/facility/{facility_id}/locks", response_model=List[schemas.FacilityMemoLockBase])
+def read_facility_locks(facility_id: int, db: Session = Depends(get_db)):
+    """医療機関のメモのうち編集中 (期限内のロックがある) のものを返す。"""
+    return FastJSONResponse(
+        _active_locks(db, models.FacilityMemo.facility_id == facility_id)
+    )
+
+
+@router.get("/general/locks", response_model=List[schemas.FacilityMemoLockBase])
+def read_general_locks(db: Session = Depends(get_db)):
+    return FastJSONResponse(_active_locks(db, models.FacilityMemo.facility_id.is_(None)))
+
+
+def _active_locks(db: Session, condition) -> list:
+    memo_ids = select(models.FacilityMemo.id).where(condition)
+    return edit_lock.active_locks(
+        db, edit_lock.MEMO, models.FacilityMemoLock.memo_id.in_(memo_ids)
+    )
 
 
 @router.get("/{memo_id}/lock", response_model=Optional[schemas.FacilityMemoLockBase])
 def get_lock(memo_id: int, db: Session = Depends(get_db)):
-    return (
-        db.query(models.FacilityMemoLock)
-        .filter(models.FacilityMemoLock.memo_id == memo_id)
-        .first()
-    )
+    return edit_lock.get(db, edit_lock.MEMO, memo_id)
 
 
 @router.post("/{memo_id}/lock", response_model=schemas.FacilityMemoLockBase)
 def lock_memo(memo_id: int, user: str, request: Request, db: Session = Depends(get_db)):
-    now = datetime.now(timezone.utc)
     client_ip = request.headers.get("X-Forwarded-For") or request.client.host
-    lock = (
-        db.query(models.FacilityMemoLock)
-        .filter(models.FacilityMemoLock.memo_id == memo_id)
-        .first()
-    )
-    if (
-        lock
-        and lock.locked_by != user
-        and lock.locked_at
-        and lock.locked_at > now - LOCK_TIMEOUT
-    ):
-        raise HTTPException(
-            status_code=409, detail=f"locked by {lock.locked_by} ({lock.ip_address})"
-        )
-    if not lock:
-        lock = models.FacilityMemoLock(
-            memo_id=memo_id,
-            locked_by=user,
-            locked_at=now,
-            ip_address=client_ip,
-        )
-        db.add(lock)
-    else:
-        lock.locked_by = user
-        lock.locked_at = now
-        lock.ip_address = client_ip
-    db.commit()
-    db.refresh(lock)
-    return lock
+    return edit_lock.acquire(db, edit_lock.MEMO, memo_id, user, client_ip)
+
+
+# 編集中のロックの期限を延ばす（ロックを失っていれば 409）
+@router.post("/{memo_id}/lock/heartbeat", response_model=schemas.FacilityMemoLockBase)
+def heartbeat_memo_lock(memo_id: int, user: str, db: Session = Depends(get_db)):
+    return edit_lock.heartbeat(db, edit_lock.MEMO, memo_id, user)
 
 
 @router.delete("/{memo_id}/lock", response_model=dict)
 def unlock_memo(memo_id: int, user: str, db: Session = Depends(get_db)):
-    lock = (
-        db.query(models.FacilityMemoLock)
-        .filter(models.FacilityMemoLock.memo_id == memo_id)
-        .first()
-    )
-    if lock and lock.locked_by == user:
-        db.delete(lock)
-        db.commit()
+    edit_lock.release(db, edit_lock.MEMO, memo_id, user)
     return {"message": "unlocked"}
 
 
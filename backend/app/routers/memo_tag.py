@@ -1,7 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from typing import List
-from .. import database, schemas, models
+from .. import (
+    database,
+    deleted_archive,
+    models,
+    schemas,
+    tag_index,
+    tag_usage,
+    template_search,
+)
+from ..responses import FastJSONResponse
 
 router = APIRouter(prefix="/memo-tags", tags=["memo-tags"])
 
@@ -14,12 +24,9 @@ def get_db():
         db.close()
 
 
-@router.get("", response_model=List[schemas.MemoTagBase])
+@router.get("", response_model=List[schemas.MemoTagWithUsage])
 def read_tags(include_deleted: bool = False, db: Session = Depends(get_db)):
-    query = db.query(models.MemoTag)
-    if not include_deleted:
-        query = query.filter(models.MemoTag.is_deleted == False)
-    return query.order_by(models.MemoTag.name, models.MemoTag.id).all()
+    return FastJSONResponse(tag_usage.tags_with_usage(db, include_deleted))
 
 
 @router.post("", response_model=schemas.MemoTagBase)
@@ -38,6 +45,9 @@ def update_tag(tag_id: int, tag: schemas.MemoTagCreate, db: Session = Depends(ge
         raise HTTPException(status_code=404, detail="Tag not found")
     for key, value in tag.dict(exclude_unset=True).items():
         setattr(db_tag, key, value)
+    # タグ名はテンプレートの検索用文書に含まれる
+    db.flush()
+    template_search.refresh_for_tag(db, tag_id)
     db.commit()
     db.refresh(db_tag)
     return db_tag
@@ -50,6 +60,8 @@ def delete_tag(tag_id: int, db: Session = Depends(get_db)):
     db_tag = db.query(models.MemoTag).filter(models.MemoTag.id == tag_id).first()
     if not db_tag:
         raise HTTPException(status_code=404, detail="Tag not found")
+    if not db_tag.is_deleted:
+        db_tag.deleted_at = func.now()
     db_tag.is_deleted = True
     db.commit()
     return {"message": "deleted"}
@@ -58,9 +70,14 @@ def delete_tag(tag_id: int, db: Session = Depends(get_db)):
 @router.put("/{tag_id}/restore", response_model=schemas.MemoTagBase)
 def restore_tag(tag_id: int, db: Session = Depends(get_db)):
     db_tag = db.query(models.MemoTag).filter(models.MemoTag.id == tag_id, models.MemoTag.is_deleted == True).first()
-    if not db_tag:
-        raise HTTPException(status_code=404, detail="Tag not found")
+    # アーカイブ済みなら紐付けごと戻す
+    archived = db_tag is None
+    if archived:
+        db_tag = deleted_archive.restore(db, deleted_archive.TAG, tag_id)
     db_tag.is_deleted = False
+    db_tag.deleted_at = None
     db.commit()
     db.refresh(db_tag)
+    if archived:
+        tag_index.index.invalidate()
     return db_tag
@@ -1,8 +1,24 @@
 from typing import List, Optional
-from datetime import datetime, timedelta, timezone
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-from .. import database, models, schemas
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
+from .. import (
+    database,
+    deleted_archive,
+    edit_lock,
+    fieldsets,
+    markdown_render,
+    models,
+    schemas,
+    serializers,
+    tag_index,
+    tag_usage,
+    template_search,
+    version_archive,
+    version_diff,
+)
+from ..responses import FastJSONResponse
 
 router = APIRouter(prefix="/memo-templates", tags=["memo-templates"])
 
@@ -19,24 +35,45 @@ def get_db():
 def list_templates(
     include_deleted: bool = False,
     search: Optional[str] = None,
-    tag: Optional[List[int]] = None,
+    tag: Optional[List[int]] = Query(None),
+    mode: str = Query("and", pattern="^(and|or)$"),
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     db: Session = Depends(get_db),
 ):
+    selected = fieldsets.TEMPLATES.resolve(fields, view)
     query = db.query(models.MemoTemplate)
+    if selected is not None:
+        query = query.options(*fieldsets.TEMPLATES.load_options(selected))
+    else:
+        query = query.options(selectinload(models.MemoTemplate.tags))
     if not include_deleted:
         query = query.filter(models.MemoTemplate.is_deleted == False)
+    score = None
     if search:
-        ilike = f"%{search}%"
+        # 検索語がある場合は一致した項目による順位順
+        query, score = template_search.apply(query, search)
+    if tag:
+        link = models.MemoTemplateTagLink
         query = query.filter(
-            models.MemoTemplate.title.ilike(ilike)
-            | models.MemoTemplate.name.ilike(ilike)
-            | models.MemoTemplate.content.ilike(ilike)
+            tag_index.tag_condition(
+                models.MemoTemplate.id, link.template_id, link.tag_id, tag, mode
+            )
         )
-    if tag:
-        query = query.join(models.MemoTemplateTagLink).filter(
-            models.MemoTemplateTagLink.tag_id.in_(tag)
+    if score is not None:
+        query = query.order_by(score.desc())
+    templates = query.order_by(models.MemoTemplate.sort_order.asc()).all()
+    if selected is not None:
+        return FastJSONResponse(
+            [fieldsets.TEMPLATES.serialize(t, selected) for t in templates]
         )
-    return query.order_by(models.MemoTemplate.sort_order.asc()).all()
+    return FastJSONResponse([serializers.template_dict(t) for t in templates])
+
+
+# 編集中 (期限内のロックがある) のテンプレートの一覧
+@router.get("/locks", response_model=List[schemas.MemoTemplateLockBase])
+def read_template_locks(db: Session = Depends(get_db)):
+    return FastJSONResponse(edit_lock.active_locks(db, edit_lock.TEMPLATE))
 
 
 @router.post("", response_model=schemas.MemoTemplateBase)
@@ -58,6 +95,9 @@ def create_template(
     db.refresh(obj)
     for tag_id in tpl.tag_ids or []:
         db.add(models.MemoTemplateTagLink(template_id=obj.id, tag_id=tag_id))
+    tag_usage.template_tags_changed(db, [], tpl.tag_ids or [])
+    db.flush()
+    template_search.refresh(db, [obj.id])
     db.commit()
     db.refresh(obj)
     ip = request.headers.get("X-Forwarded-For") or request.client.host
@@ -74,6 +114,12 @@ def create_template(
     return obj
 
 
+@router.get("/{tpl_id}/html", response_class=Response)
+def get_template_html(tpl_id: int, request: Request, db: Session = Depends(get_db)):
+    """本文を HTML に変換して返す。ETag による条件付き取得に対応。"""
+    return markdown_render.html_response(request, db, models.MemoTemplate, tpl_id)
+
+
 @router.put("/{tpl_id}", response_model=schemas.MemoTemplateBase)
 def update_template(
     tpl_id: int,
@@ -110,11 +156,15 @@ def update_template(
     if update.sort_order is not None:
         obj.sort_order = update.sort_order
     if update.tag_ids is not None:
+        old_tags = tag_usage.template_tag_ids(db, tpl_id)
+        tag_usage.template_tags_changed(db, old_tags, update.tag_ids, bool(obj.is_deleted))
         db.query(models.MemoTemplateTagLink).filter(
             models.MemoTemplateTagLink.template_id == tpl_id
         ).delete()
         for tid in update.tag_ids:
             db.add(models.MemoTemplateTagLink(template_id=tpl_id, tag_id=tid))
+    db.flush()
+    template_search.refresh(db, [tpl_id])
     db.commit()
     db.refresh(obj)
     return obj
@@ -125,6 +175,9 @@ def delete_template(tpl_id: int, request: Request, db: Session = Depends(get_db)
     obj = db.query(models.MemoTemplate).filter(models.MemoTemplate.id == tpl_id).first()
     if not obj:
         raise HTTPException(status_code=404, detail="Template not found")
+    if not obj.is_deleted:
+        tag_usage.template_deleted_changed(db, tag_usage.template_tag_ids(db, tpl_id), True)
+        obj.deleted_at = func.now()
     obj.is_deleted = True
     last = (
         db.query(models.MemoTemplateVersion)
@@ -155,8 +208,10 @@ def restore_template(tpl_id: int, request: Request, db: Session = Depends(get_db
         .first()
     )
     if not obj:
-        raise HTTPException(status_code=404, detail="Template not found")
+        obj = deleted_archive.restore(db, deleted_archive.TEMPLATE, tpl_id)
+    tag_usage.template_deleted_changed(db, tag_usage.template_tag_ids(db, tpl_id), False)
     obj.is_deleted = False
+    obj.deleted_at = None
     last = (
         db.query(models.MemoTemplateVersion)
         .filter(models.MemoTemplateVersion.template_id == tpl_id)
@@ -182,14 +237,90 @@ def restore_template(tpl_id: int, request: Request, db: Session = Depends(get_db
 @router.get("/{tpl_id}/versions", response_model=List[schemas.MemoTemplateVersionBase])
 def get_versions(
     tpl_id: int,
+    include_archived: bool = False,
     db: Session = Depends(get_db),
 ):
-    return (
+    versions = (
         db.query(models.MemoTemplateVersion)
         .filter(models.MemoTemplateVersion.template_id == tpl_id)
         .order_by(models.MemoTemplateVersion.version_no.desc())
         .all()
     )
+    if include_archived:
+        versions += version_archive.archived_versions(
+            db, version_archive.TEMPLATE_VERSIONS, tpl_id
+        )
+    return versions
+
+
+@router.get(
+    "/{tpl_id}/versions/summary",
+    response_model=List[schemas.MemoTemplateVersionSummary],
+)
+def get_version_summaries(
+    tpl_id: int,
+    before: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=500),
+    include_archived: bool = False,
+    db: Session = Depends(get_db),
+):
+    """本文を含まない履歴一覧。次ページは最後の version_no を before に指定する。"""
+    return version_archive.version_summaries(
+        db,
+        version_archive.TEMPLATE_VERSIONS,
+        tpl_id,
+        before,
+        limit,
+        include_archived=include_archived,
+    )
+
+
+@router.get("/{tpl_id}/versions/diff", response_model=schemas.VersionDiff)
+async def get_version_diff(
+    tpl_id: int,
+    from_no: int = Query(..., alias="from"),
+    to_no: int = Query(..., alias="to"),
+    mode: str = Query("line", pattern="^(line|char)$"),
+    full: bool = False,
+    db: Session = Depends(get_db),
+):
+    """2 つの版の差分を返す。full=true で変更のない区間の本文も含める。"""
+    key = ("template", tpl_id, from_no, to_no)
+    ops = version_diff.cached(key, mode, full)
+    if ops is None:
+
+        def load():
+            return [
+                version_archive.find_version_content(
+                    db, version_archive.TEMPLATE_VERSIONS, tpl_id, no
+                )
+                for no in (from_no, to_no)
+            ]
+
+        old, new = await run_in_threadpool(load)
+        if old is None or new is None:
+            raise HTTPException(status_code=404, detail="Version not found")
+        ops = await version_diff.diff(key, old["content"], new["content"], mode, full)
+    return {"from_version": from_no, "to_version": to_no, "mode": mode, "ops": ops}
+
+
+@router.get("/{tpl_id}/versions/{version_no}", response_model=schemas.MemoTemplateVersionBase)
+def get_version(tpl_id: int, version_no: int, db: Session = Depends(get_db)):
+    ver = (
+        db.query(models.MemoTemplateVersion)
+        .filter(
+            models.MemoTemplateVersion.template_id == tpl_id,
+            models.MemoTemplateVersion.version_no == version_no,
+        )
+        .first()
+    )
+    if not ver:
+        ver = version_archive.find_archived_version(
+            db, version_archive.TEMPLATE_VERSIONS, tpl_id, version_no
+        )
+    if not ver:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return ver
 
 
 @router.post("/{tpl_id}/versions/{version_no}/restore", response_model=schemas.MemoTemplateBase)
@@ -210,8 +341,13 @@ def restore_version(
         )
         .first()
     )
+    if not ver:
+        ver = version_archive.find_archived_version(
+            db, version_archive.TEMPLATE_VERSIONS, tpl_id, version_no
+        )
     if not ver:
         raise HTTPException(status_code=404, detail="Version not found")
+    ver_content = ver["content"] if isinstance(ver, dict) else ver.content
     last = (
         db.query(models.MemoTemplateVersion)
         .filter(models.MemoTemplateVersion.template_id == tpl_id)
@@ -229,62 +365,33 @@ def restore_version(
             action="restore",
         )
     )
-    obj.content = ver.content
+    obj.content = ver_content
+    db.flush()
+    template_search.refresh(db, [tpl_id])
     db.commit()
     db.refresh(obj)
     return obj
 
 
-LOCK_TIMEOUT = timedelta(minutes=5)
-
-
 @router.get("/{tpl_id}/lock", response_model=Optional[schemas.MemoTemplateLockBase])
 def get_lock(tpl_id: int, db: Session = Depends(get_db)):
-    return (
-        db.query(models.MemoTemplateLock)
-        .filter(models.MemoTemplateLock.template_id == tpl_id)
-        .first()
-    )
+    return edit_lock.get(db, edit_lock.TEMPLATE, tpl_id)
 
 
 @router.post("/{tpl_id}/lock", response_model=schemas.MemoTemplateLockBase)
 def lock_template(tpl_id: int, user: str, request: Request, db: Session = Depends(get_db)):
-    now = datetime.now(timezone.utc)
     ip = request.headers.get("X-Forwarded-For") or request.client.host
-    lock = (
-        db.query(models.MemoTemplateLock)
-        .filter(models.MemoTemplateLock.template_id == tpl_id)
-        .first()
-    )
-    if lock and lock.locked_by != user and lock.locked_at and lock.locked_at > now - LOCK_TIMEOUT:
-        raise HTTPException(status_code=409, detail=f"locked by {lock.locked_by} ({lock.ip_address})")
-    if not lock:
-        lock = models.MemoTemplateLock(
-            template_id=tpl_id,
-            locked_by=user,
-            locked_at=now,
-            ip_address=ip,
-        )
-        db.add(lock)
-    else:
-        lock.locked_by = user
-        lock.locked_at = now
-        lock.ip_address = ip
-    db.commit()
-    db.refresh(lock)
-    return lock
+    return edit_lock.acquire(db, edit_lock.TEMPLATE, tpl_id, user, ip)
+
+
+@router.post("/{tpl_id}/lock/heartbeat", response_model=schemas.MemoTemplateLockBase)
+def heartbeat_template_lock(tpl_id: int, user: str, db: Session = Depends(get_db)):
+    return edit_lock.heartbeat(db, edit_lock.TEMPLATE, tpl_id, user)
 
 
 @router.delete("/{tpl_id}/lock", response_model=dict)
 def unlock_template(tpl_id: int, user: str, db: Session = Depends(get_db)):
-    lock = (
-        db.query(models.MemoTemplateLock)
-        .filter(models.MemoTemplateLock.template_id == tpl_id)
-        .first()
-    )
-    if lock and lock.locked_by == user:
-        db.delete(lock)
-        db.commit()
+    edit_lock.release(db, edit_lock.TEMPLATE, tpl_id, user)
     return {"message": "unlocked"}
 
 
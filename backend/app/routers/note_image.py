@@ -1,3 +1,5 @@
+from typing import List
+
 from fastapi import (
     APIRouter,
     Depends,
@@ -5,10 +7,12 @@ from fastapi import (
     File,
     Form,
     HTTPException,
+    Request,
     Response,
 )
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from .. import database, models, schemas
+from .. import database, image_store, models, schemas
 
 router = APIRouter(prefix="/images", tags=["images"])
 
@@ -27,12 +31,19 @@ async def upload_image(
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
 ):
-    data = await file.read()
+    # 読み込み・ハッシュ計算・DB への書き込みはイベントループの外で行う
+    return await run_in_threadpool(_save_image, db, memo_id, file)
+
+
+def _save_image(db: Session, memo_id: int, file: UploadFile) -> schemas.NoteImageBase:
+    data, sha256 = image_store.read_and_hash(file.file)
+    # 同じ内容の画像が既にあれば実データは書き込まず参照だけ増やす
+    image_store.acquire_blob(db, sha256, data)
     img = models.NoteImage(
         memo_id=memo_id,
         file_name=file.filename,
         mime_type=file.content_type or "application/octet-stream",
-        data=data,
+        blob_hash=sha256,
     )
     db.add(img)
     db.commit()
@@ -40,10 +51,49 @@ async def upload_image(
     return schemas.NoteImageBase.from_orm(img)
 
 
+def _save_batch(
+    db: Session, memo_id: int, parts: List[image_store.UploadedPart]
+) -> List[schemas.NoteImageBase]:
+    if not db.query(models.FacilityMemo.id).filter(models.FacilityMemo.id == memo_id).first():
+        raise HTTPException(status_code=404, detail="Memo not found")
+    images = []
+    for part in parts:
+        image_store.acquire_blob(db, part.sha256, part.data)
+        images.append(
+            models.NoteImage(
+                memo_id=memo_id,
+                file_name=part.file_name,
+                mime_type=part.mime_type,
+                blob_hash=part.sha256,
+            )
+        )
+    db.add_all(images)
+    db.commit()
+    ids = [img.id for img in images]
+    saved = {
+        img.id: img
+        for img in db.query(models.NoteImage).filter(models.NoteImage.id.in_(ids))
+    }
+    return [schemas.NoteImageBase.from_orm(saved[i]) for i in ids]
+
+
+@router.post("/batch", response_model=List[schemas.NoteImageBase])
+async def upload_images(request: Request, db: Session = Depends(get_db)):
+    """複数の画像 (``files``) をまとめて登録し、送信順に id を返す。"""
+    fields, parts = await image_store.read_multipart_images(request)
+    memo_id = fields.get("memo_id", "")
+    if not memo_id.isdigit():
+        raise HTTPException(status_code=422, detail="memo_id is required")
+    if not parts:
+        raise HTTPException(status_code=422, detail="No files uploaded")
+    # 全件を 1 トランザクションで保存する
+    return await run_in_threadpool(_save_batch, db, int(memo_id), parts)
+
+
 @router.get("/{image_id}")
 def get_image(image_id: str, db: Session = Depends(get_db)):
     img = db.query(models.NoteImage).filter(models.NoteImage.id == image_id).first()
     if not img:
         raise HTTPException(status_code=404, detail="Image not found")
-    return Response(content=img.data, media_type=img.mime_type)
+    return Response(content=image_store.image_data(db, img), media_type=img.mime_type)
 
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, validator
-from typing import Optional, List
+from typing import Any, Optional, List
 from datetime import datetime
 from uuid import UUID
 
@@ -90,6 +90,25 @@ class MedicalFacility(MedicalFacilityBase):
         from_attributes = True
 
 
+class FacilitySearchResult(BaseModel):
+    id: int
+    short_name: str
+    official_name: Optional[str]
+    prefecture: Optional[str]
+    city: Optional[str]
+    address_detail: Optional[str]
+
+
+class PhoneLookupResult(BaseModel):
+    facility_id: int
+    short_name: str
+    official_name: Optional[str]
+    kind: str
+    value: str
+    comment: Optional[str]
+    is_deleted: bool
+
+
 class MedicalFacilityUpdate(BaseModel):
     short_name: Optional[str] = None
     official_name: Optional[str] = None
@@ -192,6 +211,12 @@ class MemoTagCreate(BaseModel):
         return v
 
 
+class MemoTagWithUsage(MemoTagBase):
+    memo_count: int = 0
+    deleted_memo_count: int = 0
+    template_count: int = 0
+
+
 class FacilityMemoBase(BaseModel):
     id: int
     facility_id: Optional[int]
@@ -244,16 +269,61 @@ class FacilityMemoVersionBase(BaseModel):
         from_attributes = True
 
 
+class FacilityMemoVersionSummary(BaseModel):
+    """履歴一覧用。本文を含まず文字数のみ返す"""
+
+    id: int
+    memo_id: int
+    version_no: int
+    created_at: Optional[datetime]
+    ip_address: Optional[str]
+    action: Optional[str]
+    content_length: Optional[int]
+
+    class Config:
+        from_attributes = True
+
+
+class DiffOp(BaseModel):
+    op: str  # equal / delete / insert
+    count: int
+    text: Optional[str] = None
+
+
+class VersionDiff(BaseModel):
+    from_version: int
+    to_version: int
+    mode: str
+    ops: List[DiffOp]
+
+
 class FacilityMemoLockBase(BaseModel):
     memo_id: int
     locked_by: Optional[str]
     locked_at: Optional[datetime]
     ip_address: Optional[str]
+    expires_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
 
 
+class FacilityMemoContent(BaseModel):
+    id: int
+    content: Optional[str]
+    content_hash: Optional[str] = None
+
+
+class MemoBootstrap(BaseModel):
+    """メモ画面の初期表示用。一覧 (memos) は本文を含まない"""
+
+    facility: Optional[dict] = None
+    memos: List[dict]
+    tags: List[MemoTagWithUsage]
+    locks: List[FacilityMemoLockBase]
+    selected: Optional[FacilityMemoContent] = None
+
+
 class MemoOrderItem(BaseModel):
     id: int
     sort_order: int
@@ -336,11 +406,27 @@ class MemoTemplateVersionBase(BaseModel):
         from_attributes = True
 
 
+class MemoTemplateVersionSummary(BaseModel):
+    """履歴一覧用。本文を含まず文字数のみ返す"""
+
+    id: int
+    template_id: int
+    version_no: int
+    created_at: Optional[datetime]
+    ip_address: Optional[str]
+    action: Optional[str]
+    content_length: Optional[int]
+
+    class Config:
+        from_attributes = True
+
+
 class MemoTemplateLockBase(BaseModel):
     template_id: int
     locked_by: Optional[str]
     locked_at: Optional[datetime]
     ip_address: Optional[str]
+    expires_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -353,3 +439,47 @@ class MemoTemplateOrderItem(BaseModel):
 
 class MemoTemplateOrderUpdate(BaseModel):
     orders: List[MemoTemplateOrderItem]
+
+
+class SlowQueryStat(BaseModel):
+    statement: str
+    count: int
+    total_seconds: float
+    max_seconds: float
+    last_seconds: float
+    last_parameters: Optional[Any]
+    last_call_site: Optional[str]
+    last_route: Optional[str]
+    last_seen: Optional[datetime]
+    explain: Optional[str]
+
+
+class ArchivedRecord(BaseModel):
+    kind: str
+    record_id: int
+    label: Optional[str]
+    deleted_at: Optional[datetime]
+    archived_at: Optional[datetime]
+
+
+class JobCreate(BaseModel):
+    kind: str
+    payload: Optional[dict] = None
+    max_attempts: int = 3
+
+
+class JobStatus(BaseModel):
+    id: int
+    kind: str
+    status: str
+    attempts: int
+    max_attempts: int
+    progress_done: Optional[int]
+    progress_total: Optional[int]
+    message: Optional[str]
+    result: Optional[Any]
+    error: Optional[str]
+    has_output: bool
+    created_at: Optional[datetime]
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
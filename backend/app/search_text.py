@@ -0,0 +1,43 @@
+"""検索用の文字列正規化 (Python と SQL で同じ結果になる)。
+
+- NFKC 正規化 (全角英数字・半角カナを揃える)
+- 英字の小文字化
+- カタカナをひらがなに変換
+- 空白の除去
+"""
+
+import unicodedata
+from typing import Optional
+
+from sqlalchemy import func, literal_column
+
+_KATAKANA = "".join(chr(c) for c in range(0x30A1, 0x30F7))
+_HIRAGANA = "".join(chr(c) for c in range(0x3041, 0x3097))
+_KANA_TABLE = str.maketrans(_KATAKANA, _HIRAGANA)
+
+
+def normalize(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKC", value).lower().translate(_KANA_TABLE)
+    return value.replace(" ", "")
+
+
+def literal(value: str):
+    # 式インデックスと一致させるため、定数はバインド変数にせず SQL に埋め込む
+    return literal_column(f"'{value}'")
+
+
+def sql_normalize(expr):
+    """``normalize`` と同じ変換をする SQL 式 (IMMUTABLE な関数のみ使用)。"""
+    expr = func.normalize(expr, literal_column("NFKC"))
+    expr = func.translate(func.lower(expr), literal(_KATAKANA), literal(_HIRAGANA))
+    return func.replace(expr, literal(" "), literal(""))
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def contains(expr, value: str):
+    return expr.like(f"%{escape_like(value)}%", escape="\\")
@@ -0,0 +1,516 @@
+"""ステージング・性能試験用のダミーデータ一括投入コマンド。
+
+空のデータベース (``--reset``) に同じ ``--seed`` と ``--now`` で投入すれば、
+並列数によらず id を含めて毎回同じデータが生成される。
+医療機関はチャンク単位に分割し、複数プロセスで並列に投入する。id は医療機関
+ごとに上限件数分の範囲を先に割り当て、投入順に依存しないようにする。
+各テーブルへの書き込みは複数行 INSERT でまとめて行う。
+
+例::
+
+    python -m backend.app.seed_db --facilities 5000 --workers 8 --seed 42
+"""
+
+import argparse
+import random
+import struct
+import sys
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+
+from .database import Base, engine
+from . import migrate, models, phone_lookup, tag_usage, template_search
+
+# --now を省略した場合の基準日時 (日時の値も実行日に依存しないようにする)
+DEFAULT_NOW = datetime(2025, 1, 1)
+
+PREFECTURES = {
+    "東京都": ["新宿区", "渋谷区", "世田谷区", "八王子市"],
+    "神奈川県": ["横浜市", "川崎市", "相模原市"],
+    "大阪府": ["大阪市", "堺市", "豊中市"],
+    "愛知県": ["名古屋市", "豊田市"],
+    "福岡県": ["福岡市", "北九州市"],
+}
+FACILITY_KINDS = ["クリニック", "病院", "診療所", "医院", "歯科"]
+FACILITY_NAMES = ["さくら", "あおば", "みどり", "ひまわり", "つばさ", "はるか", "かえで", "こもれび"]
+MEMO_TITLES = ["受付手順", "連絡先", "注意事項", "設定情報", "トラブル対応", "訪問記録", "契約内容"]
+TAG_NAMES = ["重要", "連絡", "設定", "障害", "定期", "請求", "要確認", "完了"]
+TAG_COLORS = ["#ef4444", "#f97316", "#eab308", "#22c55e", "#3b82f6", "#8b5cf6"]
+USERS = ["yamada", "suzuki", "tanaka", "sato", "ito"]
+PARAGRAPHS = [
+    "受付で診察券を確認してから案内すること。",
+    "- 電話は午前中に折り返す\n- 担当者不在時は伝言を残す",
+    "## 設定\nレセコンの出力先は共有フォルダを指定する。",
+    "| 項目 | 内容 |\n| --- | --- |\n| 曜日 | 月・水・金 |",
+    "夜間は救急外来の窓口を利用する。",
+    "**注意**: 月末は請求業務のため対応が遅れることがある。",
+]
+
+
+def _png(rng: random.Random, size: int = 16) -> bytes:
+    """単色の小さな PNG を生成する。"""
+    color = bytes(rng.randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + color * size for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _phone(rng: random.Random) -> str:
+    return f"0{rng.randint(3, 99)}-{rng.randint(100, 9999)}-{rng.randint(1000, 9999)}"
+
+
+def _ip(rng: random.Random) -> str:
+    return f"192.168.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def _content(rng: random.Random, image_ids: Sequence[uuid.UUID]) -> str:
+    parts = rng.sample(PARAGRAPHS, rng.randint(1, len(PARAGRAPHS)))
+    for image_id in image_ids:
+        parts.insert(
+            rng.randint(0, len(parts)),
+            f'<img data-id="{image_id}" alt="seed.png" src="/images/{image_id}" />',
+        )
+    return "\n\n".join(parts)
+
+
+def _insert_returning_ids(conn, table, rows: List[dict], batch_size: int) -> List[int]:
+    """複数行 INSERT を行い採番された id を投入順に返す。"""
+    ids: List[int] = []
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i : i + batch_size]
+        result = conn.execute(insert(table).values(batch).returning(table.c.id))
+        ids.extend(r[0] for r in result)
+    return ids
+
+
+def _insert_rows(conn, table, rows: List[dict], batch_size: int) -> None:
+    for i in range(0, len(rows), batch_size):
+        conn.execute(insert(table).values(rows[i : i + batch_size]))
+
+
+# 医療機関 1 件 (ブロック 0 は共通メモ) あたりに割り当てる id の数
+def _id_blocks(opts: dict) -> Dict[str, int]:
+    memos = max(opts["memos_per_facility"] * 2, 1)
+    return {
+        "facilities": 1,
+        "memos": memos,
+        "versions": memos * opts["versions_per_memo"] * 2,
+        "entries": max(opts["functions_count"], 1),
+    }
+
+
+ID_TABLES = {
+    "facilities": models.MedicalFacility.__table__,
+    "memos": models.FacilityMemo.__table__,
+    "versions": models.FacilityMemoVersion.__table__,
+    "entries": models.FacilityFunctionEntry.__table__,
+}
+
+
+def _id_ranges(opts: dict, first_block: int, blocks: int) -> Dict[str, Iterator[int]]:
+    """ブロック ``first_block`` から ``blocks`` 個分の id を払い出すイテレータ。"""
+    ranges = {}
+    for key, size in _id_blocks(opts).items():
+        start = opts["id_base"][key] + first_block * size
+        ranges[key] = iter(range(start, start + blocks * size))
+    return ranges
+
+
+def _advance_sequences(conn) -> None:
+    """id を指定して投入したテーブルの採番を最大値の次に進める。"""
+    for table in ID_TABLES.values():
+        conn.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {table.name}"
+            ),
+            {"table": table.name},
+        )
+
+
+def _version_rows(
+    rng: random.Random, owner_key: str, owner_id: int, count: int, now: datetime
+) -> List[dict]:
+    rows = []
+    created = now - timedelta(days=rng.randint(count, 720))
+    for no in range(1, count + 1):
+        rows.append(
+            {
+                owner_key: owner_id,
+                "version_no": no,
+                "content": "\n\n".join(rng.sample(PARAGRAPHS, rng.randint(1, 3))),
+                "created_at": created,
+                "ip_address": _ip(rng),
+                "action": "create" if no == 1 else "edit",
+            }
+        )
+        created += timedelta(minutes=rng.randint(5, 60 * 24 * 7))
+        if created > now:
+            created = now
+    return rows
+
+
+def _seed_memos(
+    conn,
+    rng: random.Random,
+    facility_id: Optional[int],
+    opts: dict,
+    now: datetime,
+    counts: Dict[str, int],
+    ids: Dict[str, Iterator[int]],
+) -> None:
+    """1 施設分 (または共通メモ) のメモと付随データを投入する。"""
+    bs = opts["batch_size"]
+    memo_rows: List[dict] = []
+    memo_images: List[List[uuid.UUID]] = []
+    for order in range(1, rng.randint(0, opts["memos_per_facility"] * 2) + 1):
+        image_ids = [
+            uuid.UUID(int=rng.getrandbits(128), version=4)
+            for _ in range(rng.randint(0, opts["images_per_memo"]))
+        ]
+        memo_images.append(image_ids)
+        memo_rows.append(
+            {
+                "id": next(ids["memos"]),
+                "facility_id": facility_id,
+                "parent_id": None,
+                "title": f"{rng.choice(MEMO_TITLES)} {order}",
+                "content": _content(rng, image_ids),
+                "is_deleted": rng.random() < 0.05,
+                "sort_order": order,
+                "updated_at": now - timedelta(days=rng.randint(0, 365)),
+            }
+        )
+    if not memo_rows:
+        return
+    _insert_rows(conn, models.FacilityMemo.__table__, memo_rows, bs)
+    memo_ids = [row["id"] for row in memo_rows]
+    counts["memos"] += len(memo_ids)
+
+    version_rows: List[dict] = []
+    link_rows: List[dict] = []
+    lock_rows: List[dict] = []
+    image_rows: List[dict] = []
+    for memo_id, image_ids in zip(memo_ids, memo_images):
+        versions = _version_rows(
+            rng,
+            "memo_id",
+            memo_id,
+            rng.randint(1, opts["versions_per_memo"] * 2),
+            now,
+        )
+        for row in versions:
+            row["id"] = next(ids["versions"])
+        version_rows.extend(versions)
+        for tag_id in rng.sample(opts["tag_ids"], rng.randint(0, min(3, len(opts["tag_ids"])))):
+            link_rows.append({"memo_id": memo_id, "tag_id": tag_id})
+        if rng.random() < opts["lock_ratio"]:
+            lock_rows.append(
+                {
+                    "memo_id": memo_id,
+                    "locked_by": rng.choice(USERS),
+                    "locked_at": now - timedelta(minutes=rng.randint(0, 30)),
+                    "ip_address": _ip(rng),
+                }
+            )
+        for image_id in image_ids:
+            image_rows.append(
+                {
+                    "id": image_id,
+                    "memo_id": memo_id,
+                    "file_name": "seed.png",
+                    "mime_type": "image/png",
+                    "data": _png(rng),
+                    "created_at": now,
+                }
+            )
+    _insert_rows(conn, models.FacilityMemoVersion.__table__, version_rows, bs)
+    _insert_rows(conn, models.FacilityMemoTagLink.__table__, link_rows, bs)
+    _insert_rows(conn, models.FacilityMemoLock.__table__, lock_rows, bs)
+    _insert_rows(conn, models.NoteImage.__table__, image_rows, bs)
+    counts["versions"] += len(version_rows)
+    counts["tag_links"] += len(link_rows)
+    counts["locks"] += len(lock_rows)
+    counts["images"] += len(image_rows)
+
+
+def _seed_chunk(args) -> Dict[str, int]:
+    """ワーカープロセスで 1 チャンク分の医療機関を投入する。"""
+    chunk_no, start, count, opts = args
+    rng = random.Random(f"{opts['seed']}:{chunk_no}")
+    ids = _id_ranges(opts, start + 1, count)
+    now = opts["now"]
+    bs = opts["batch_size"]
+    counts = {k: 0 for k in ("facilities", "entries", "memos", "versions", "tag_links", "locks", "images")}
+
+    facility_rows = []
+    for _ in range(count):
+        prefecture = rng.choice(list(PREFECTURES))
+        name = f"{rng.choice(FACILITY_NAMES)}{rng.choice(FACILITY_KINDS)}"
+        facility_rows.append(
+            {
+                "id": next(ids["facilities"]),
+                "short_name": name,
+                "official_name": f"医療法人{name}",
+                "prefecture": prefecture,
+                "city": rng.choice(PREFECTURES[prefecture]),
+                "address_detail": f"{rng.randint(1, 9)}-{rng.randint(1, 30)}-{rng.randint(1, 20)}",
+                "phone_numbers": [
+                    {"value": _phone(rng), "comment": ""} for _ in range(rng.randint(1, 3))
+                ],
+                "emails": None,
+                "fax": _phone(rng) if rng.random() < 0.7 else None,
+                "remarks": rng.choice(["", "駅から徒歩5分", "夜間診療あり", "駐車場あり"]),
+                "is_deleted": rng.random() < 0.02,
+            }
+        )
+
+    with engine.begin() as conn:
+        _insert_rows(conn, models.MedicalFacility.__table__, facility_rows, bs)
+        facility_ids = [row["id"] for row in facility_rows]
+        counts["facilities"] = len(facility_ids)
+        phone_rows = [
+            n
+            for facility_id, row in zip(facility_ids, facility_rows)
+            for n in phone_lookup.rows_for(facility_id, row["phone_numbers"], row["fax"])
+        ]
+        _insert_rows(conn, models.FacilityPhoneNumber.__table__, phone_rows, bs)
+
+        entry_rows = []
+        for facility_id in facility_ids:
+            for function_id, choices in rng.sample(
+                opts["functions"], rng.randint(0, len(opts["functions"]))
+            ):
+                entry_rows.append(
+                    {
+                        "id": next(ids["entries"]),
+                        "facility_id": facility_id,
+                        "function_id": function_id,
+                        "selected_values": rng.sample(choices, rng.randint(0, len(choices))),
+                        "remarks": None,
+                    }
+                )
+        _insert_rows(conn, models.FacilityFunctionEntry.__table__, entry_rows, bs)
+        counts["entries"] = len(entry_rows)
+
+        for facility_id in facility_ids:
+            _seed_memos(conn, rng, facility_id, opts, now, counts, ids)
+    return counts
+
+
+def _seed_masters(conn, rng: random.Random, opts: dict, now: datetime) -> Dict[str, int]:
+    """タグ・機能マスタ・テンプレートなど全施設で共有するデータを投入する。"""
+    bs = opts["batch_size"]
+    tag_ids = _insert_returning_ids(
+        conn,
+        models.MemoTag.__table__,
+        [
+            {
+                "name": f"{TAG_NAMES[i % len(TAG_NAMES)]}{i // len(TAG_NAMES) or ''}",
+                "remark": None,
+                "color": rng.choice(TAG_COLORS),
+                "is_deleted": False,
+            }
+            for i in range(opts["tags"])
+        ],
+        bs,
+    )
+    category_ids = _insert_returning_ids(
+        conn,
+        models.FunctionCategory.__table__,
+        [
+            {"name": name, "description": None, "is_deleted": False}
+            for name in ("基本機能", "設備", "サービス")
+        ],
+        bs,
+    )
+    function_rows = []
+    for i in range(opts["functions_count"]):
+        choices = [f"選択肢{j}" for j in range(1, rng.randint(2, 5))]
+        function_rows.append(
+            {
+                "name": f"機能{i + 1}",
+                "description": None,
+                "memo": None,
+                "selection_type": "multiple",
+                "choices": choices,
+                "category_id": rng.choice(category_ids),
+                "is_deleted": False,
+            }
+        )
+    function_ids = _insert_returning_ids(conn, models.Function.__table__, function_rows, bs)
+
+    template_rows = [
+        {
+            "name": f"テンプレート{i + 1}",
+            "title": rng.choice(MEMO_TITLES),
+            "content": "\n\n".join(rng.sample(PARAGRAPHS, rng.randint(1, 4))),
+            "is_deleted": rng.random() < 0.05,
+            "sort_order": i + 1,
+            "updated_at": now - timedelta(days=rng.randint(0, 365)),
+        }
+        for i in range(opts["templates"])
+    ]
+    template_ids = _insert_returning_ids(conn, models.MemoTemplate.__table__, template_rows, bs)
+    version_rows: List[dict] = []
+    link_rows: List[dict] = []
+    for template_id in template_ids:
+        version_rows.extend(
+            _version_rows(
+                rng, "template_id", template_id, rng.randint(1, opts["versions_per_memo"]), now
+            )
+        )
+        for tag_id in rng.sample(tag_ids, rng.randint(0, min(3, len(tag_ids)))):
+            link_rows.append({"template_id": template_id, "tag_id": tag_id})
+    _insert_rows(conn, models.MemoTemplateVersion.__table__, version_rows, bs)
+    _insert_rows(conn, models.MemoTemplateTagLink.__table__, link_rows, bs)
+    template_search.refresh(conn, template_ids)
+
+    opts["tag_ids"] = tag_ids
+    opts["functions"] = [
+        (fid, row["choices"]) for fid, row in zip(function_ids, function_rows)
+    ]
+    return {
+        "tags": len(tag_ids),
+        "functions": len(function_ids),
+        "templates": len(template_ids),
+        "template_versions": len(version_rows),
+        "template_tag_links": len(link_rows),
+    }
+
+
+def seed_db(
+    facilities: int = 1000,
+    memos_per_facility: int = 5,
+    versions_per_memo: int = 5,
+    images_per_memo: int = 1,
+    tags: int = 20,
+    templates: int = 50,
+    functions_count: int = 20,
+    lock_ratio: float = 0.02,
+    workers: int = 4,
+    chunk_size: int = 200,
+    batch_size: int = 1000,
+    seed: int = 0,
+    reset: bool = False,
+    now: Optional[datetime] = None,
+) -> Dict[str, int]:
+    """ダミーデータを投入し、テーブルごとの投入件数を返す。"""
+    started = time.perf_counter()
+    if reset:
+        Base.metadata.drop_all(bind=engine)
+    migrate.migrate()
+
+    now = (now or DEFAULT_NOW).replace(microsecond=0)
+    rng = random.Random(f"{seed}:master")
+    opts = {
+        "memos_per_facility": memos_per_facility,
+        "versions_per_memo": max(versions_per_memo, 1),
+        "images_per_memo": images_per_memo,
+        "tags": tags,
+        "templates": templates,
+        "functions_count": functions_count,
+        "lock_ratio": lock_ratio,
+        "batch_size": batch_size,
+        "seed": seed,
+        "now": now,
+    }
+    with engine.begin() as conn:
+        opts["id_base"] = {
+            key: conn.execute(text(f"SELECT coalesce(max(id), 0) + 1 FROM {table.name}")).scalar()
+            for key, table in ID_TABLES.items()
+        }
+        counts = _seed_masters(conn, rng, opts, now)
+        general = {k: 0 for k in ("memos", "versions", "tag_links", "locks", "images")}
+        _seed_memos(conn, rng, None, opts, now, general, _id_ranges(opts, 0, 1))
+    for key, value in general.items():
+        counts[key] = counts.get(key, 0) + value
+
+    tasks = [
+        (no, start, min(chunk_size, facilities - start), opts)
+        for no, start in enumerate(range(0, facilities, chunk_size))
+    ]
+    # 親プロセスの接続をフォーク先に持ち込まないよう、プールを空にしておく
+    engine.dispose()
+    if workers > 1 and len(tasks) > 1:
+        with Pool(processes=workers) as pool:
+            results = pool.map(_seed_chunk, tasks)
+    else:
+        results = [_seed_chunk(task) for task in tasks]
+    for result in results:
+        for key, value in result.items():
+            counts[key] = counts.get(key, 0) + value
+    with engine.begin() as conn:
+        _advance_sequences(conn)
+    # 紐付けは直接 INSERT しているため、タグの使用件数はまとめて数える
+    with Session(engine) as db:
+        tag_usage.reconcile(db)
+
+    elapsed = time.perf_counter() - started
+    summary = ", ".join(f"{k}={v}" for k, v in counts.items())
+    print(f"Seeded in {elapsed:.1f}s: {summary}")
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Seed the database with dummy data.")
+    parser.add_argument("--facilities", type=int, default=1000)
+    parser.add_argument("--memos-per-facility", type=int, default=5, help="average memos per facility")
+    parser.add_argument("--versions-per-memo", type=int, default=5, help="average versions per memo")
+    parser.add_argument("--images-per-memo", type=int, default=1, help="max images per memo")
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--templates", type=int, default=50)
+    parser.add_argument("--functions", type=int, default=20)
+    parser.add_argument("--lock-ratio", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=200, help="facilities per worker task")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per INSERT statement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="drop all tables before seeding")
+    parser.add_argument(
+        "--now",
+        type=datetime.fromisoformat,
+        default=DEFAULT_NOW,
+        help="base date for generated timestamps (ISO format, default %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    if args.facilities < 0 or args.workers < 1 or args.chunk_size < 1 or args.batch_size < 1:
+        parser.print_usage()
+        sys.exit(1)
+    seed_db(
+        facilities=args.facilities,
+        memos_per_facility=args.memos_per_facility,
+        versions_per_memo=args.versions_per_memo,
+        images_per_memo=args.images_per_memo,
+        tags=args.tags,
+        templates=args.templates,
+        functions_count=args.functions,
+        lock_ratio=args.lock_ratio,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        seed=args.seed,
+        reset=args.reset,
+        now=args.now,
+    )
+
+
+if __name__ == "__main__":
+    main()
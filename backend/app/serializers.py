@@ -0,0 +1,143 @@
+"""ORM オブジェクトから API レスポンス用の dict を直接組み立てる関数群。
+
+一覧系エンドポイントでは Pydantic モデルを経由せずにこれらを使い、
+``responses.FastJSONResponse`` で返す。出力形式は ``schemas`` の
+対応するモデルと同じに保つこと。
+"""
+
+from typing import Callable, Dict, List, Optional
+
+from . import models
+
+
+def _contacts(values) -> Optional[List[dict]]:
+    if values is None:
+        return None
+    return [{"value": v.get("value"), "comment": v.get("comment")} for v in values]
+
+
+def function_dict(f: models.Function) -> dict:
+    """``schemas.FunctionBase`` と同じ形式。"""
+    return {
+        "id": f.id,
+        "name": f.name,
+        "description": f.description,
+        "memo": f.memo,
+        "selection_type": f.selection_type,
+        "choices": list(f.choices or []),
+        "category_id": f.category_id,
+        "is_deleted": bool(f.is_deleted),
+    }
+
+
+def entry_dict(e: models.FacilityFunctionEntry) -> dict:
+    """``schemas.FacilityFunctionEntryBase`` と同じ形式。"""
+    return {
+        "id": e.id,
+        "selected_values": e.selected_values,
+        "remarks": e.remarks,
+        "function": function_dict(e.function),
+    }
+
+
+def facility_dict(fac: models.MedicalFacility, entries=None) -> dict:
+    """``schemas.MedicalFacility`` と同じ形式。
+
+    ``entries`` を省略した場合は ``fac.functions`` をすべて出力する。
+    """
+    return {
+        "short_name": fac.short_name,
+        "official_name": fac.official_name,
+        "prefecture": fac.prefecture,
+        "city": fac.city,
+        "address_detail": fac.address_detail,
+        "phone_numbers": _contacts(fac.phone_numbers),
+        "emails": _contacts(fac.emails),
+        "fax": fac.fax,
+        "remarks": fac.remarks,
+        "id": fac.id,
+        "is_deleted": bool(fac.is_deleted),
+        "functions": [
+            entry_dict(e) for e in (fac.functions if entries is None else entries)
+        ],
+    }
+
+
+def tag_dict(t: models.MemoTag) -> dict:
+    """``schemas.MemoTagBase`` と同じ形式。"""
+    return {
+        "id": t.id,
+        "name": t.name,
+        "remark": t.remark,
+        "color": t.color,
+        "is_deleted": bool(t.is_deleted),
+    }
+
+
+def tag_usage_dict(t: models.MemoTag, usage: Optional[models.MemoTagUsage]) -> dict:
+    """``schemas.MemoTagWithUsage`` と同じ形式。"""
+    result = tag_dict(t)
+    result["memo_count"] = usage.memos if usage else 0
+    result["deleted_memo_count"] = usage.deleted_memos if usage else 0
+    result["template_count"] = usage.templates if usage else 0
+    return result
+
+
+def memo_dict(m: models.FacilityMemo) -> dict:
+    """``schemas.FacilityMemoBase`` と同じ形式。"""
+    return {
+        "id": m.id,
+        "facility_id": m.facility_id,
+        "parent_id": m.parent_id,
+        "title": m.title,
+        "content": m.content,
+        "is_deleted": bool(m.is_deleted),
+        "sort_order": m.sort_order,
+        "updated_at": m.updated_at,
+        "tags": [tag_dict(t) for t in m.tags],
+    }
+
+
+def template_dict(t: models.MemoTemplate) -> dict:
+    """``schemas.MemoTemplateBase`` と同じ形式。"""
+    return {
+        "id": t.id,
+        "name": t.name,
+        "title": t.title,
+        "content": t.content,
+        "is_deleted": bool(t.is_deleted),
+        "updated_at": t.updated_at,
+        "sort_order": t.sort_order,
+        "tags": [tag_dict(tag) for tag in t.tags],
+    }
+
+
+def active_entries(fac: models.MedicalFacility) -> list:
+    """削除済みの機能を除いた機能エントリ。"""
+    return [e for e in fac.functions if e.function and not e.function.is_deleted]
+
+
+def pick(obj, fields, values: Dict[str, Callable]) -> dict:
+    """``fields`` の項目だけを出力する。
+
+    ``values`` に変換関数がある項目はそれを使い、それ以外は属性をそのまま返す。
+    """
+    return {k: values[k](obj) if k in values else getattr(obj, k) for k in fields}
+
+
+# fieldsets で項目を絞り込んだときの、列の値をそのまま返さない項目
+FACILITY_VALUES: Dict[str, Callable] = {
+    "phone_numbers": lambda f: _contacts(f.phone_numbers),
+    "emails": lambda f: _contacts(f.emails),
+    "is_deleted": lambda f: bool(f.is_deleted),
+    "functions": lambda f: [entry_dict(e) for e in active_entries(f)],
+}
+FUNCTION_VALUES: Dict[str, Callable] = {
+    "choices": lambda f: list(f.choices or []),
+    "is_deleted": lambda f: bool(f.is_deleted),
+}
+MEMO_VALUES: Dict[str, Callable] = {
+    "is_deleted": lambda m: bool(m.is_deleted),
+    "tags": lambda m: [tag_dict(t) for t in m.tags],
+}
+TEMPLATE_VALUES = MEMO_VALUES
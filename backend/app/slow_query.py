@@ -0,0 +1,206 @@
+"""閾値を超えた SQL の記録と EXPLAIN の取得。
+
+``SLOW_QUERY_THRESHOLD_MS`` を超えた SQL を、バインド値・呼び出し元・
+リクエスト元のルートとともに記録する。``SLOW_QUERY_EXPLAIN_RATE`` に
+0 より大きい値を指定すると、その割合で SELECT 文の
+``EXPLAIN (ANALYZE, BUFFERS)`` 結果も保存する。ANALYZE は文を実際に
+実行するため、副作用の無い読み取り (``_EXPLAIN_FUNCTIONS`` 以外の関数を呼ばず、
+FOR UPDATE などの行ロックを取らない SELECT) だけを対象にする。
+"""
+
+import logging
+import os
+import random
+import re
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+from .metrics import current_request
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD_SECONDS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200")) / 1000
+EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0"))
+MAX_ENTRIES = int(os.getenv("SLOW_QUERY_MAX_ENTRIES", "500"))
+MAX_PARAM_LENGTH = 200
+MAX_LOG_LENGTH = 500
+
+_THIS_FILE = os.path.abspath(__file__)
+_APP_DIR = os.path.dirname(_THIS_FILE)
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_CALL = re.compile(r"\b([a-z_][a-z0-9_.]*)\s*\(", re.IGNORECASE)
+_LOCKING = re.compile(r"\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)\b|\bINTO\b", re.I)
+# EXPLAIN ANALYZE で実行してよい (副作用の無い) 関数と、括弧が続く SQL の構文
+_EXPLAIN_FUNCTIONS = frozenset(
+    """
+    count sum min max avg coalesce nullif greatest least lower upper length
+    char_length octet_length md5 substr substring strpos position replace translate
+    trim btrim ltrim rtrim concat regexp_matches regexp_replace array_agg string_agg
+    unnest array_length row_number rank dense_rank now localtimestamp date_trunc
+    extract cast encode sha256 jsonb_array_elements json_array_elements
+    select in exists any all values over filter as on using and or not from where
+    join lateral with tuple
+    """.split()
+)
+
+_lock = threading.Lock()
+_entries: Dict[str, dict] = {}
+
+
+def _normalize(statement: str) -> str:
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def _call_site() -> Optional[str]:
+    """SQL を発行したアプリケーション側のコード位置を返す。"""
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(_APP_DIR) and filename != _THIS_FILE:
+            return f"{os.path.relpath(frame.filename, _APP_DIR)}:{frame.lineno} ({frame.name})"
+    return None
+
+
+def _truncate(value) -> str:
+    text = repr(value)
+    if len(text) > MAX_PARAM_LENGTH:
+        return text[:MAX_PARAM_LENGTH] + "..."
+    return text
+
+
+def _format_params(parameters):
+    if isinstance(parameters, dict):
+        return {k: _truncate(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_truncate(v) for v in parameters]
+    return _truncate(parameters)
+
+
+def _explainable(statement: str) -> bool:
+    """EXPLAIN ANALYZE で再実行しても副作用の無い読み取りの SELECT か。"""
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return False
+    body = _STRING_LITERAL.sub("''", statement)
+    if _LOCKING.search(body):
+        return False
+    return all(
+        name.lower().rsplit(".", 1)[-1] in _EXPLAIN_FUNCTIONS for name in _CALL.findall(body)
+    )
+
+
+def _explain(cursor, statement: str, parameters) -> Optional[str]:
+    """同じトランザクション内で EXPLAIN ANALYZE を実行する。
+
+    SAVEPOINT で囲み、失敗しても元のトランザクションを壊さない。
+    """
+    raw = cursor.connection.cursor()
+    try:
+        raw.execute("SAVEPOINT slow_query_explain")
+        try:
+            raw.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+            plan = "\n".join(row[0] for row in raw.fetchall())
+        except Exception:
+            raw.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            logger.warning("EXPLAIN failed for slow query", exc_info=True)
+            return None
+        raw.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    except Exception:
+        logger.warning("EXPLAIN could not be captured", exc_info=True)
+        return None
+    finally:
+        raw.close()
+
+
+def _record(statement: str, parameters, elapsed: float, plan: Optional[str]) -> None:
+    key = _normalize(statement)
+    stats = current_request.get()
+    route = stats.path if stats is not None else None
+    call_site = _call_site()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            if len(_entries) >= MAX_ENTRIES:
+                # 合計時間が最も小さいものを捨てて上限を保つ
+                del _entries[min(_entries, key=lambda k: _entries[k]["total_seconds"])]
+            entry = _entries[key] = {
+                "statement": key,
+                "count": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "last_seconds": 0.0,
+                "last_parameters": None,
+                "last_call_site": None,
+                "last_route": None,
+                "last_seen": None,
+                "explain": None,
+            }
+        entry["count"] += 1
+        entry["total_seconds"] += elapsed
+        entry["max_seconds"] = max(entry["max_seconds"], elapsed)
+        entry["last_seconds"] = elapsed
+        entry["last_parameters"] = _format_params(parameters)
+        entry["last_call_site"] = call_site
+        entry["last_route"] = route
+        entry["last_seen"] = datetime.now(timezone.utc)
+        if plan is not None:
+            entry["explain"] = plan
+    logger.warning(
+        "slow query %.1fms route=%s at=%s: %s",
+        elapsed * 1000,
+        route,
+        call_site,
+        key if len(key) <= MAX_LOG_LENGTH else key[:MAX_LOG_LENGTH] + "...",
+    )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["slow_query_start"].pop()
+    if elapsed < THRESHOLD_SECONDS:
+        return
+    plan = None
+    if (
+        EXPLAIN_RATE > 0
+        and not executemany
+        and _explainable(statement)
+        and conn.dialect.name == "postgresql"
+        and random.random() < EXPLAIN_RATE
+    ):
+        plan = _explain(cursor, statement, parameters)
+    _record(statement, parameters, elapsed, plan)
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("slow_query_start"):
+        conn.info["slow_query_start"].pop()
+
+
+def instrument_engine(engine) -> None:
+    """エンジンにスロークエリ記録用のイベントを登録する。"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+def top_queries(limit: int = 20, order_by: str = "total_seconds") -> List[dict]:
+    """記録済みのスロークエリを指定項目の降順で返す。"""
+    with _lock:
+        entries = [dict(e) for e in _entries.values()]
+    entries.sort(key=lambda e: e[order_by], reverse=True)
+    return entries[:limit]
+
+
+def reset() -> None:
+    with _lock:
+        _entries.clear()
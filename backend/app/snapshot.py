@@ -0,0 +1,582 @@
+"""アプリケーション単位のスナップショット (バックアップ・リストア)。
+
+pg_dump の代わりに、各テーブルを複数プロセスで並列に読み出し、
+列指向の圧縮ファイルへ書き出す。
+
+- テーブルごとに ``tables/<テーブル名>.json.gz`` を作る。1 行が最大
+  ``SNAPSHOT_CHUNK_ROWS`` 行分のデータで、列ごとの配列にした JSON
+  (同じ列の値が並ぶためよく圧縮される)。
+- 画像の実データは ``blobs/`` に SHA-256 ごとのファイルとして書き出し、
+  表にはハッシュだけを持つ。元になるスナップショットに既にある画像は書き出さない。
+- ``--since`` で前回のスナップショットを指定すると差分スナップショットになる。
+  ``INCREMENTAL`` のテーブルは前回以降に更新・追加された行だけを書き出し、
+  それ以外の (小さい) テーブルは毎回全件を書き出す。削除された行は
+  リストア時に最新の ``keys/`` の主キー一覧に無い行として書き込まずに読み飛ばす。
+- 全テーブルを pg_export_snapshot で同じ時点のデータとして読む。
+
+リストアは外部キーの依存順に、同じ段のテーブルを並列に書き込む。
+差分スナップショットを指定した場合は、元の全件スナップショットから順に当てる。
+
+例::
+
+    python -m backend.app.snapshot backup /backup/0501
+    python -m backend.app.snapshot backup /backup/0502 --since /backup/0501
+    python -m backend.app.snapshot restore /backup/0502 --truncate
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import re
+import uuid
+from datetime import datetime
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import (
+    TIMESTAMP,
+    Integer,
+    LargeBinary,
+    bindparam,
+    func,
+    insert,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID, insert as pg_insert
+
+from . import models, version_archive
+from .database import engine
+
+FORMAT = 1
+WORKERS = int(os.getenv("SNAPSHOT_WORKERS", "4"))
+CHUNK_ROWS = int(os.getenv("SNAPSHOT_CHUNK_ROWS", "5000"))
+BLOB_CHUNK_ROWS = 100  # 画像を含むテーブルはメモリを抑えるため小さく区切る
+
+# 差分スナップショットで変更分だけを書き出すテーブルと、更新日時の列。
+# None は行が書き換えられないテーブル (新しい主キーの行だけを書き出す)
+INCREMENTAL = {
+    "facility_memos": "updated_at",
+    "memo_templates": "updated_at",
+    "facility_memo_versions": "created_at",
+    "memo_template_versions": "created_at",
+    "facility_memo_version_archive": None,
+    "memo_template_version_archive": None,
+}
+# 画像の実データの列と、その SHA-256 を持つ列 (None なら DB で計算する)
+BLOB_COLUMNS = {
+    "image_blobs": ("data", "sha256"),
+    "note_images": ("data", None),
+}
+# ジョブのキューと復元先のスキーマの移行状態は対象外
+EXCLUDED = {"jobs", "schema_migrations"}
+
+_VERSION_ARCHIVES = {
+    t.archive.__tablename__: t
+    for t in (version_archive.MEMO_VERSIONS, version_archive.TEMPLATE_VERSIONS)
+}
+
+
+def tables():
+    return [t for t in models.Base.metadata.sorted_tables if t.name not in EXCLUDED]
+
+
+def _table(name: str):
+    return models.Base.metadata.tables[name]
+
+
+# --- ファイル形式 ---------------------------------------------------------------
+
+
+def _dumper(col) -> Optional[Callable]:
+    if isinstance(col.type, TIMESTAMP):
+        return datetime.isoformat
+    if isinstance(col.type, PG_UUID):
+        return str
+    if isinstance(col.type, LargeBinary):
+        return lambda v: base64.b64encode(bytes(v)).decode("ascii")
+    return None
+
+
+def _loader(col) -> Optional[Callable]:
+    if isinstance(col.type, TIMESTAMP):
+        return datetime.fromisoformat
+    if isinstance(col.type, PG_UUID):
+        return uuid.UUID
+    if isinstance(col.type, LargeBinary):
+        return base64.b64decode
+    return None
+
+
+def _columnar(names: Sequence[str], rows, dumpers: Sequence[Optional[Callable]]) -> Dict[str, list]:
+    data = {}
+    for i, name in enumerate(names):
+        values = [r[i] for r in rows]
+        dump = dumpers[i]
+        if dump is not None:
+            values = [None if v is None else dump(v) for v in values]
+        data[name] = values
+    return data
+
+
+def _path(directory: str, kind: str, table_name: str) -> str:
+    return os.path.join(directory, kind, f"{table_name}.json.gz")
+
+
+class _ChunkWriter:
+    """列ごとの配列にしたチャンクを 1 行ずつ gzip へ書き出す。"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.rows = 0
+
+    def write(self, columns: Dict[str, list]) -> None:
+        self.rows += len(next(iter(columns.values()), []))
+        self.file.write(json.dumps(columns, ensure_ascii=False, separators=(",", ":")))
+        self.file.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+
+def _read_chunks(path: str) -> Iterator[Dict[str, list]]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _blob_path(directory: str, digest: str) -> str:
+    return os.path.join(directory, "blobs", digest[:2], digest)
+
+
+def _find_blob(dirs: Sequence[str], digest: str) -> Optional[str]:
+    for directory in dirs:
+        path = _blob_path(directory, digest)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _manifest(directory: str) -> dict:
+    path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{directory} is not a complete snapshot")
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _chain(directory: str) -> List[Tuple[str, dict]]:
+    """全件スナップショットから指定のスナップショットまでを古い順に返す。"""
+    chain = []
+    while directory:
+        manifest = _manifest(directory)
+        chain.append((directory, manifest))
+        base = manifest.get("base")
+        directory = os.path.normpath(os.path.join(directory, base)) if base else None
+    return chain[::-1]
+
+
+# --- バックアップ ---------------------------------------------------------------
+
+
+def _init_worker() -> None:
+    # 親プロセスから引き継いだ接続を使わない
+    engine.dispose(close=False)
+
+
+def _pk_in(pk, keys: List[tuple]):
+    if len(pk) == 1:
+        return pk[0].in_([k[0] for k in keys])
+    return tuple_(*pk).in_(keys)
+
+
+def _data_columns(table) -> list:
+    """画像の列はハッシュに置き換えて読む。"""
+    blob = BLOB_COLUMNS.get(table.name)
+    columns = []
+    for col in table.columns:
+        if blob and col.name == blob[0]:
+            digest = table.c[blob[1]] if blob[1] else func.encode(func.sha256(col), "hex")
+            columns.append(digest.label(col.name))
+        else:
+            columns.append(col)
+    return columns
+
+
+def _save_blobs(conn, table, names: List[str], rows, dirs: Sequence[str]) -> int:
+    """まだどのスナップショットにも無い画像を書き出し、件数を返す。"""
+    idx = names.index(BLOB_COLUMNS[table.name][0])
+    pk = list(table.primary_key.columns)
+    pk_idx = [names.index(c.name) for c in pk]
+    missing: Dict[tuple, str] = {}
+    digests = set()
+    for r in rows:
+        digest = r[idx]
+        if digest and digest not in digests and _find_blob(dirs, digest) is None:
+            digests.add(digest)
+            missing[tuple(r[i] for i in pk_idx)] = digest
+    keys = list(missing)
+    for i in range(0, len(keys), BLOB_CHUNK_ROWS):
+        batch = keys[i : i + BLOB_CHUNK_ROWS]
+        query = select(*pk, table.c[BLOB_COLUMNS[table.name][0]]).where(_pk_in(pk, batch))
+        for *key, data in conn.execute(query):
+            path = _blob_path(dirs[0], missing[tuple(key)])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+    return len(keys)
+
+
+def _read_keys(directory: str, table) -> Set[tuple]:
+    names = [c.name for c in table.primary_key.columns]
+    keys = set()
+    for chunk in _read_chunks(_path(directory, "keys", table.name)):
+        keys.update(zip(*(chunk[n] for n in names)))
+    return keys
+
+
+def _backup_table(task) -> dict:
+    name, directory, snapshot_id, blob_dirs, base, watermark = task
+    table = _table(name)
+    pk = list(table.primary_key.columns)
+    pk_names = [c.name for c in pk]
+    pk_dumpers = [_dumper(c) for c in pk]
+    columns = _data_columns(table)
+    names = [c.name for c in columns]
+    blob = BLOB_COLUMNS.get(name)
+    dumpers = [None if blob and n == blob[0] else _dumper(c) for n, c in zip(names, table.columns)]
+    chunk_rows = BLOB_CHUNK_ROWS if blob else CHUNK_ROWS
+    incremental = base is not None and name in INCREMENTAL
+    blobs = 0
+
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+        with conn.begin():
+            # 親プロセスと同じ時点のデータを読む
+            conn.execute(text(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'"))
+            stream = {"stream_results": True}
+            with _ChunkWriter(_path(directory, "tables", name)) as data_out, _ChunkWriter(
+                _path(directory, "keys", name)
+            ) as keys_out:
+
+                def write(rows):
+                    nonlocal blobs
+                    if blob:
+                        blobs += _save_blobs(conn, table, names, rows, blob_dirs)
+                    data_out.write(_columnar(names, rows, dumpers))
+
+                if not incremental:
+                    result = conn.execute(select(*columns), execution_options=stream)
+                    pk_idx = [names.index(n) for n in pk_names]
+                    for rows in result.partitions(chunk_rows):
+                        keys = [[r[i] for i in pk_idx] for r in rows]
+                        keys_out.write(_columnar(pk_names, keys, pk_dumpers))
+                        write(rows)
+                else:
+                    # 主キーと更新の有無だけを読み、書き出す行を決めてから取り出す
+                    base_keys = _read_keys(base, table)
+                    change = INCREMENTAL[name]
+                    probe = list(pk)
+                    if change:
+                        probe.append(func.coalesce(table.c[change] >= watermark, False))
+                    pending: List[tuple] = []
+
+                    def flush(keys):
+                        query = select(*columns).where(_pk_in(pk, keys))
+                        write(conn.execute(query).all())
+
+                    result = conn.execute(select(*probe), execution_options=stream)
+                    for rows in result.partitions(CHUNK_ROWS):
+                        keys_out.write(_columnar(pk_names, rows, pk_dumpers))
+                        for r in rows:
+                            key = tuple(r[: len(pk)])
+                            dumped = tuple(d(v) if d else v for d, v in zip(pk_dumpers, key))
+                            if (change and r[-1]) or dumped not in base_keys:
+                                pending.append(key)
+                        while len(pending) >= chunk_rows:
+                            flush(pending[:chunk_rows])
+                            del pending[:chunk_rows]
+                    if pending:
+                        flush(pending)
+
+    return {
+        "table": name,
+        "mode": "incremental" if incremental else "full",
+        "rows": data_out.rows,
+        "keys": keys_out.rows,
+        "blobs": blobs,
+    }
+
+
+def backup(directory: str, since: Optional[str] = None, workers: int = WORKERS) -> dict:
+    """スナップショットを作成し、マニフェストを返す。
+
+    ``since`` を指定すると、そのスナップショットからの差分スナップショットにする。
+    """
+    if os.path.exists(os.path.join(directory, "manifest.json")):
+        raise FileExistsError(f"{directory} already contains a snapshot")
+    chain = _chain(since) if since else []
+    blob_dirs = [directory] + [d for d, _ in reversed(chain)]
+    base_manifest = chain[-1][1] if chain else None
+    watermark = (
+        datetime.fromisoformat(base_manifest["watermark"]) if base_manifest else None
+    )
+    os.makedirs(directory, exist_ok=True)
+
+    # 接続を子プロセスへ引き継がない
+    engine.dispose()
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+        with conn.begin():
+            snapshot_id = conn.execute(text("SELECT pg_export_snapshot()")).scalar()
+            if not re.fullmatch(r"[0-9A-Fa-f-]+", snapshot_id):
+                raise RuntimeError(f"unexpected snapshot id: {snapshot_id}")
+            # 次の差分の基準。読み出し時点で実行中だったトランザクションの更新を
+            # 取りこぼさないよう、その開始時刻から少し遡る
+            created_at, next_watermark = conn.execute(
+                text(
+                    "SELECT now()::timestamp, min(xact_start)::timestamp - interval '1 minute' "
+                    "FROM pg_stat_activity WHERE datname = current_database()"
+                )
+            ).one()
+            tasks = [
+                (
+                    t.name,
+                    directory,
+                    snapshot_id,
+                    blob_dirs,
+                    since if base_manifest and t.name in base_manifest["tables"] else None,
+                    watermark,
+                )
+                for t in tables()
+            ]
+            if workers > 1 and len(tasks) > 1:
+                with Pool(processes=workers, initializer=_init_worker) as pool:
+                    results = list(pool.imap_unordered(_backup_table, tasks))
+            else:
+                results = [_backup_table(t) for t in tasks]
+
+    manifest = {
+        "format": FORMAT,
+        "created_at": created_at.isoformat(),
+        "watermark": next_watermark.isoformat(),
+        "base": os.path.relpath(since, directory) if since else None,
+        "tables": {
+            r["table"]: {k: r[k] for k in ("mode", "rows", "keys", "blobs")}
+            for r in sorted(results, key=lambda r: r["table"])
+        },
+    }
+    # マニフェストは最後に書き、途中で失敗したスナップショットと区別する
+    with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# --- リストア -------------------------------------------------------------------
+
+
+def _load_chunk(table, chunk: Dict[str, list], blob_dirs: Sequence[str]) -> List[dict]:
+    blob = BLOB_COLUMNS.get(table.name)
+    names = [n for n in chunk if n in table.c]
+    columns = []
+    for name in names:
+        values = chunk[name]
+        if blob and name == blob[0]:
+            values = [None if v is None else _read_blob(blob_dirs, v) for v in values]
+        else:
+            load = _loader(table.c[name])
+            if load is not None:
+                values = [None if v is None else load(v) for v in values]
+        columns.append(values)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def _read_blob(dirs: Sequence[str], digest: str) -> bytes:
+    path = _find_blob(dirs, digest)
+    if path is None:
+        raise FileNotFoundError(f"image blob {digest} is missing from the snapshot")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _upsert(table):
+    stmt = pg_insert(table)
+    pk = [c.name for c in table.primary_key.columns]
+    values = {c.name: stmt.excluded[c.name] for c in table.columns if not c.primary_key}
+    if not values:
+        return stmt.on_conflict_do_nothing(index_elements=pk)
+    return stmt.on_conflict_do_update(index_elements=pk, set_=values)
+
+
+def _restore_table(task) -> dict:
+    name, dirs, modes = task
+    table = _table(name)
+    start = max(i for i, mode in enumerate(modes) if mode == "full")
+    blob_dirs = dirs[::-1]
+    pk = list(table.primary_key.columns)
+    # 自己参照の列 (メモの親など) は全行を入れた後で設定する
+    self_refs = [fk.parent.name for fk in table.foreign_keys if fk.column.table is table]
+    pk_names = [c.name for c in pk]
+    # 差分を当てる場合は、最新の時点で残っている行だけを書き込む
+    # (後で削除すると、削除された親を参照する子の書き込みが外部キー違反になる)
+    latest = _read_keys(dirs[-1], table) if start < len(dirs) - 1 else None
+    skipped: Set[tuple] = set()
+    deferred: Dict[object, dict] = {}
+    rows = 0
+    with engine.begin() as conn:
+        for i in range(start, len(dirs)):
+            stmt = insert(table) if i == start else _upsert(table)
+            for chunk in _read_chunks(_path(dirs[i], "tables", name)):
+                if latest is not None:
+                    keys = list(zip(*(chunk[n] for n in pk_names)))
+                    keep = [j for j, key in enumerate(keys) if key in latest]
+                    if len(keep) < len(keys):
+                        skipped.update(k for k in keys if k not in latest)
+                        chunk = {n: [v[j] for j in keep] for n, v in chunk.items()}
+                values = _load_chunk(table, chunk, blob_dirs)
+                if not values:
+                    continue
+                if self_refs:
+                    for row in values:
+                        deferred[row[pk[0].name]] = {c: row.get(c) for c in self_refs}
+                        row.update({c: None for c in self_refs})
+                if name in _VERSION_ARCHIVES:
+                    version_archive.ensure_partitions(
+                        conn,
+                        _VERSION_ARCHIVES[name],
+                        (r["created_at"].date().replace(day=1) for r in values),
+                    )
+                conn.execute(stmt, values)
+                rows += len(values)
+        if deferred:
+            params = [
+                {"_key": key, **{f"_{c}": v for c, v in refs.items()}}
+                for key, refs in deferred.items()
+                if any(v is not None for v in refs.values())
+            ]
+            if params:
+                conn.execute(
+                    update(table)
+                    .where(pk[0] == bindparam("_key"))
+                    .values({c: bindparam(f"_{c}") for c in self_refs}),
+                    params,
+                )
+    return {"table": name, "rows": rows, "deleted": len(skipped)}
+
+
+def _levels(names: Set[str]) -> List[List[str]]:
+    """外部キーの依存順に、並列に書き込めるテーブルの段に分ける。"""
+    level: Dict[str, int] = {}
+    for table in tables():
+        if table.name not in names:
+            continue
+        parents = [
+            fk.column.table.name
+            for fk in table.foreign_keys
+            if fk.column.table is not table and fk.column.table.name in names
+        ]
+        level[table.name] = 1 + max((level[p] for p in parents), default=-1)
+    levels: List[List[str]] = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for name, n in level.items():
+        levels[n].append(name)
+    return levels
+
+
+def restore(directory: str, workers: int = WORKERS, truncate: bool = False) -> List[dict]:
+    """スナップショットを復元する。
+
+    対象のテーブルが空でない場合は ``truncate=True`` のときだけ全件削除してから書き込む。
+    """
+    chain = _chain(directory)
+    dirs = [d for d, _ in chain]
+    latest = chain[-1][1]["tables"]
+    names = {t.name for t in tables() if t.name in latest}
+    # 全件スナップショットから順に当てる (途中でテーブルが増えた場合はそこから)
+    modes = {
+        name: [m["tables"].get(name, {}).get("mode") for _, m in chain] for name in names
+    }
+    for name in list(names):
+        if "full" not in modes[name]:
+            names.discard(name)
+
+    engine.dispose()
+    with engine.begin() as conn:
+        prep = conn.dialect.identifier_preparer
+        targets = [prep.format_table(_table(n)) for n in sorted(names)]
+        if truncate:
+            conn.execute(text(f"TRUNCATE {', '.join(targets)} RESTART IDENTITY CASCADE"))
+        else:
+            for name, target in zip(sorted(names), targets):
+                if conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {target})")).scalar():
+                    raise RuntimeError(f"{name} is not empty (use --truncate to replace it)")
+
+    results: List[dict] = []
+    levels = _levels(names)
+    pool = Pool(processes=workers, initializer=_init_worker) if workers > 1 else None
+    try:
+        for names_in_level in levels:
+            tasks = [(n, dirs, modes[n]) for n in names_in_level]
+            if pool is not None and len(tasks) > 1:
+                results.extend(pool.imap_unordered(_restore_table, tasks))
+            else:
+                results.extend(_restore_table(t) for t in tasks)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # 採番を復元した id の続きから始める
+    with engine.begin() as conn:
+        for name in names:
+            pk = list(_table(name).primary_key.columns)
+            if len(pk) == 1 and isinstance(pk[0].type, Integer) and not pk[0].foreign_keys:
+                target = conn.dialect.identifier_preparer.format_table(_table(name))
+                column = conn.dialect.identifier_preparer.quote(pk[0].name)
+                conn.execute(
+                    text(
+                        f"SELECT setval(pg_get_serial_sequence(:table, :column), "
+                        f"coalesce(max({column}), 0) + 1, false) FROM {target}"
+                    ),
+                    {"table": name, "column": pk[0].name},
+                )
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Back up or restore the database as a snapshot.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("backup", help="write a snapshot to DIR")
+    b.add_argument("directory")
+    b.add_argument("--since", help="base snapshot for an incremental snapshot")
+    b.add_argument("--workers", type=int, default=WORKERS)
+    r = sub.add_parser("restore", help="restore the snapshot in DIR")
+    r.add_argument("directory")
+    r.add_argument("--workers", type=int, default=WORKERS)
+    r.add_argument(
+        "--truncate", action="store_true", help="empty the tables before restoring"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "backup":
+        manifest = backup(args.directory, since=args.since, workers=args.workers)
+        for name, info in manifest["tables"].items():
+            print(f"{name}: {info['mode']} rows={info['rows']} blobs={info['blobs']}")
+        kind = "incremental" if manifest["base"] else "full"
+        print(f"Wrote {kind} snapshot to {args.directory}")
+    else:
+        results = restore(args.directory, workers=args.workers, truncate=args.truncate)
+        for r in sorted(results, key=lambda r: r["table"]):
+            print(f"{r['table']}: rows={r['rows']} deleted={r['deleted']}")
+        print(f"Restored {sum(r['rows'] for r in results)} rows from {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""メモのタグ絞り込み用のプロセス内インデックス。
+
+タグごとに、付いているメモ ID の集合を持つ。AND は小さい集合から順に
+積集合を、OR は和集合を取り、一致した ID を SQL の条件にして一覧を引く。
+一致件数が ``MEMO_TAG_INDEX_MAX_IDS`` を超える (絞り込みが効かない) 場合は
+SQL の EXISTS で絞り込む。
+
+``facility_memo_tag_links`` を書き換えたら ``index.set_tags`` で反映する。
+他プロセスでの書き換えは ``MEMO_TAG_INDEX_TTL`` 秒ごとにバックグラウンドで
+再構築して取り込む (再構築中は前のインデックスで応答する)。
+他プロセスの変更がすぐに見えないため、``WEB_CONCURRENCY`` が 2 以上の
+(複数ワーカーの) 場合は既定で無効になり SQL で絞り込む。
+``MEMO_TAG_INDEX=1`` / ``0`` で明示的に切り替えられる。
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import and_, exists, select
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+ENABLED = os.getenv("MEMO_TAG_INDEX", "1" if _WORKERS <= 1 else "0") != "0"
+INDEX_TTL = float(os.getenv("MEMO_TAG_INDEX_TTL", "60"))
+# これを超える件数に一致した場合は ID の一覧を送らず SQL で絞り込む
+MAX_IDS = int(os.getenv("MEMO_TAG_INDEX_MAX_IDS", "1000"))
+
+
+class TagBitmapIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memos: Dict[int, Set[int]] = {}
+        self._memo_tags: Dict[int, Set[int]] = {}
+        self.built_at: Optional[float] = None
+        self._rebuilding = False
+        # 再構築の読み込み中に set_tags された分 (入れ替え後に当て直す)
+        self._pending: Optional[Dict[int, Set[int]]] = None
+
+    def rebuild(self, db: Session) -> None:
+        link = models.FacilityMemoTagLink
+        with self._lock:
+            self._pending = {}
+        memos: Dict[int, Set[int]] = {}
+        memo_tags: Dict[int, Set[int]] = {}
+        try:
+            for memo_id, tag_id in db.execute(select(link.memo_id, link.tag_id)):
+                memos.setdefault(tag_id, set()).add(memo_id)
+                memo_tags.setdefault(memo_id, set()).add(tag_id)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            self._memos, self._memo_tags = memos, memo_tags
+            for memo_id, tag_ids in (self._pending or {}).items():
+                self._apply(memo_id, tag_ids)
+            self._pending = None
+            self.built_at = time.monotonic()
+
+    def _rebuild_in_background(self) -> None:
+        db = SessionLocal()
+        try:
+            self.rebuild(db)
+        finally:
+            db.close()
+            self._rebuilding = False
+
+    def ensure_fresh(self, db: Session) -> None:
+        """未構築なら構築し、TTL を過ぎていればバックグラウンドで作り直す。"""
+        if self.built_at is None:
+            self.rebuild(db)
+        elif time.monotonic() - self.built_at > INDEX_TTL and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def invalidate(self) -> None:
+        """多数のメモの紐付けが変わったときに、次の利用時に作り直させる。"""
+        with self._lock:
+            self.built_at = None
+
+    def set_tags(self, memo_id: int, tag_ids: Iterable[int]) -> None:
+        """メモのタグを ``tag_ids`` に置き換える。"""
+        new = set(tag_ids)
+        with self._lock:
+            if self._pending is not None:
+                self._pending[memo_id] = new
+            if self.built_at is not None:
+                self._apply(memo_id, new)
+
+    def _apply(self, memo_id: int, new: Set[int]) -> None:
+        old = self._memo_tags.get(memo_id, set())
+        for tag_id in old - new:
+            self._memos.get(tag_id, set()).discard(memo_id)
+        for tag_id in new - old:
+            self._memos.setdefault(tag_id, set()).add(memo_id)
+        if new:
+            self._memo_tags[memo_id] = new
+        else:
+            self._memo_tags.pop(memo_id, None)
+
+    def match(self, tag_ids: List[int], mode: str) -> Set[int]:
+        """タグ条件を満たすメモ ID の集合を返す。"""
+        empty: Set[int] = set()
+        with self._lock:
+            sets = sorted((self._memos.get(t, empty) for t in set(tag_ids)), key=len)
+            if mode == "and":
+                return set(sets[0]).intersection(*sets[1:])
+            return set().union(*sets)
+
+
+index = TagBitmapIndex()
+
+
+def tag_condition(id_col, link_owner_col, link_tag_col, tag_ids: List[int], mode: str):
+    """タグの紐付けテーブルを使った AND / OR の絞り込み条件 (重複行を生まない)。"""
+    tag_ids = list(set(tag_ids))
+    if mode == "or":
+        return exists().where(link_owner_col == id_col, link_tag_col.in_(tag_ids))
+    # 紐付けの主キー (owner, tag) でタグごとに 1 回ずつ引く
+    return and_(
+        *(exists().where(link_owner_col == id_col, link_tag_col == t) for t in tag_ids)
+    )
+
+
+def sql_condition(tag_ids: List[int], mode: str):
+    """インデックスを使わない場合の絞り込み条件。"""
+    link = models.FacilityMemoTagLink
+    return tag_condition(models.FacilityMemo.id, link.memo_id, link.tag_id, tag_ids, mode)
+
+
+def filter_query(db: Session, query, tag_ids: List[int], mode: str):
+    """メモ一覧のクエリにタグ条件を加える。
+
+    インデックスが有効で一致した ID が ``MAX_IDS`` 件以下なら、その ID に絞り込む。
+    それ以外は SQL の EXISTS で絞り込む。
+    """
+    if ENABLED:
+        index.ensure_fresh(db)
+        matched = index.match(tag_ids, mode)
+        if len(matched) <= MAX_IDS:
+            return query.filter(models.FacilityMemo.id.in_(sorted(matched)))
+    return query.filter(sql_condition(tag_ids, mode))
@@ -0,0 +1,173 @@
+"""タグごとの使用件数 (削除されていないメモ、削除済みメモ、テンプレート)。
+
+件数は ``memo_tag_usage`` に保持し、メモ・テンプレートのタグの付け外しや
+削除・復元のたびに差分だけを加減する。加減は呼び出し側のトランザクション内で
+行い、コミットは呼び出し側に任せる。件数がずれた場合 (直接の SQL 操作など) は
+``reconcile`` で紐付けテーブルから数え直す。削除済みテンプレートは数えない。
+
+例::
+
+    python -m backend.app.tag_usage --reconcile
+"""
+
+import argparse
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models, serializers
+from .database import SessionLocal
+
+COLUMNS = ("memos", "deleted_memos", "templates")
+
+
+def adjust(db, deltas: Dict[int, Dict[str, int]]) -> None:
+    """``{tag_id: {列名: 増減}}`` を加算する。"""
+    usage = models.MemoTagUsage
+    # 行ロックの順序を揃えてデッドロックを避ける
+    rows = [
+        {"tag_id": tag_id, **{c: delta.get(c, 0) for c in COLUMNS}}
+        for tag_id, delta in sorted(deltas.items())
+        if any(delta.values())
+    ]
+    if not rows:
+        return
+    stmt = pg_insert(usage).values(rows)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[usage.tag_id],
+            set_={c: getattr(usage, c) + stmt.excluded[c] for c in COLUMNS},
+        )
+    )
+
+
+def _link_deltas(old: Iterable[int], new: Iterable[int], column: str) -> Dict[int, Dict[str, int]]:
+    old, new = set(old), set(new)
+    deltas = {t: {column: 1} for t in new - old}
+    deltas.update({t: {column: -1} for t in old - new})
+    return deltas
+
+
+def memo_tag_ids(db: Session, memo_id: int) -> List[int]:
+    link = models.FacilityMemoTagLink
+    return list(db.execute(select(link.tag_id).where(link.memo_id == memo_id)).scalars())
+
+
+def template_tag_ids(db: Session, template_id: int) -> List[int]:
+    link = models.MemoTemplateTagLink
+    return list(
+        db.execute(select(link.tag_id).where(link.template_id == template_id)).scalars()
+    )
+
+
+def memo_tags_changed(db, old: Iterable[int], new: Iterable[int], deleted: bool = False) -> None:
+    adjust(db, _link_deltas(old, new, "deleted_memos" if deleted else "memos"))
+
+
+def memo_deleted_changed(db, tag_ids: Iterable[int], deleted: bool) -> None:
+    """メモの削除・復元で、そのタグの件数を live と deleted の間で移す。"""
+    src, dst = ("memos", "deleted_memos") if deleted else ("deleted_memos", "memos")
+    adjust(db, {t: {src: -1, dst: 1} for t in set(tag_ids)})
+
+
+def template_tags_changed(
+    db, old: Iterable[int], new: Iterable[int], deleted: bool = False
+) -> None:
+    if not deleted:
+        adjust(db, _link_deltas(old, new, "templates"))
+
+
+def template_deleted_changed(db, tag_ids: Iterable[int], deleted: bool) -> None:
+    adjust(db, {t: {"templates": -1 if deleted else 1} for t in set(tag_ids)})
+
+
+def _upsert_counts(tag_ids: Optional[Iterable[int]] = None):
+    """紐付けテーブルから数えた件数で ``memo_tag_usage`` を更新する文。"""
+    usage = models.MemoTagUsage
+    tag = models.MemoTag
+    memo = models.FacilityMemo
+    memo_link = models.FacilityMemoTagLink
+    tpl = models.MemoTemplate
+    tpl_link = models.MemoTemplateTagLink
+    is_deleted = func.coalesce(memo.is_deleted, False)
+    memo_counts = (
+        select(
+            memo_link.tag_id,
+            func.count().filter(~is_deleted).label("memos"),
+            func.count().filter(is_deleted).label("deleted_memos"),
+        )
+        .join(memo, memo.id == memo_link.memo_id)
+        .group_by(memo_link.tag_id)
+    )
+    tpl_counts = (
+        select(tpl_link.tag_id, func.count().label("templates"))
+        .join(tpl, tpl.id == tpl_link.template_id)
+        .where(func.coalesce(tpl.is_deleted, False) == False)
+        .group_by(tpl_link.tag_id)
+    )
+    actual = select(tag.id)
+    if tag_ids is not None:
+        tag_ids = list(tag_ids)
+        memo_counts = memo_counts.where(memo_link.tag_id.in_(tag_ids))
+        tpl_counts = tpl_counts.where(tpl_link.tag_id.in_(tag_ids))
+        actual = actual.where(tag.id.in_(tag_ids))
+    memo_counts = memo_counts.subquery()
+    tpl_counts = tpl_counts.subquery()
+    actual = (
+        actual.add_columns(
+            func.coalesce(memo_counts.c.memos, 0),
+            func.coalesce(memo_counts.c.deleted_memos, 0),
+            func.coalesce(tpl_counts.c.templates, 0),
+        )
+        .outerjoin(memo_counts, memo_counts.c.tag_id == tag.id)
+        .outerjoin(tpl_counts, tpl_counts.c.tag_id == tag.id)
+    )
+    stmt = pg_insert(usage).from_select(["tag_id", *COLUMNS], actual)
+    return stmt.on_conflict_do_update(
+        index_elements=[usage.tag_id],
+        set_={c: stmt.excluded[c] for c in COLUMNS},
+        where=or_(*(getattr(usage, c) != stmt.excluded[c] for c in COLUMNS)),
+    ).returning(usage.tag_id)
+
+
+def recount(db, tag_ids: Iterable[int]) -> None:
+    """指定タグの件数を数え直す (コミットは呼び出し側)。"""
+    db.execute(_upsert_counts(tag_ids))
+
+
+def tags_with_usage(db: Session, include_deleted: bool = False) -> List[dict]:
+    """タグの一覧を使用件数とともに返す (件数は同じクエリで結合して取得する)。"""
+    query = db.query(models.MemoTag, models.MemoTagUsage).outerjoin(
+        models.MemoTagUsage, models.MemoTagUsage.tag_id == models.MemoTag.id
+    )
+    if not include_deleted:
+        query = query.filter(models.MemoTag.is_deleted == False)
+    rows = query.order_by(models.MemoTag.name, models.MemoTag.id).all()
+    return [serializers.tag_usage_dict(t, u) for t, u in rows]
+
+
+def reconcile(db: Session) -> int:
+    """紐付けテーブルから数え直し、値が変わったタグの数を返す。"""
+    changed = len(db.execute(_upsert_counts()).all())
+    db.commit()
+    return changed
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Tag usage counters.")
+    parser.add_argument(
+        "--reconcile", action="store_true", help="recount usage from the link tables"
+    )
+    args = parser.parse_args(argv)
+    if args.reconcile:
+        db = SessionLocal()
+        try:
+            print(f"repaired {reconcile(db)} tags")
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
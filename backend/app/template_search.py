@@ -0,0 +1,169 @@
+"""テンプレートの検索。
+
+テンプレートごとに名前・タイトル・タグ名・本文を ``search_text.normalize``
+で正規化した検索用文書を ``memo_template_search`` に保持し、
+テンプレートやタグ名を変更したときに ``refresh`` で作り直す。
+
+検索語は空白で区切った語のすべてを含むテンプレートを返し、
+どの項目に一致したかで順位を付ける (名前の前方一致 > 名前 > タイトル >
+タグ名 > 本文)。文書の部分一致には pg_trgm のインデックスが使える
+(``python -m backend.app.template_search --create-index``)。
+
+既存データからの作り直し::
+
+    python -m backend.app.template_search --rebuild
+"""
+
+import argparse
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import case, delete, literal, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+from .search_text import contains, escape_like, normalize
+
+# 一致した項目ごとの点数
+WEIGHTS = {"name_prefix": 8, "name": 4, "title": 3, "tags": 2, "document": 1}
+
+
+def document_row(
+    template_id: int,
+    name: Optional[str],
+    title: Optional[str],
+    content: Optional[str],
+    tag_names: Iterable[str],
+) -> dict:
+    tags = " ".join(normalize(t) for t in tag_names)
+    row = {
+        "template_id": template_id,
+        "name": normalize(name),
+        "title": normalize(title),
+        "tags": tags,
+    }
+    row["document"] = "|".join([row["name"], row["title"], tags, normalize(content)])
+    return row
+
+
+def refresh(db, template_ids: Iterable[int]) -> None:
+    """指定テンプレートの検索用文書を作り直す (コミットは呼び出し側)。
+
+    ``db`` は Session と Connection のどちらでもよい。
+    """
+    template_ids = list(template_ids)
+    if not template_ids:
+        return
+    tpl = models.MemoTemplate
+    link = models.MemoTemplateTagLink
+    tag = models.MemoTag
+    tag_names: Dict[int, List[str]] = {}
+    for template_id, name in db.execute(
+        select(link.template_id, tag.name)
+        .join(tag, tag.id == link.tag_id)
+        .where(link.template_id.in_(template_ids))
+        .order_by(link.template_id, tag.id)
+    ):
+        tag_names.setdefault(template_id, []).append(name)
+    rows = [
+        document_row(r.id, r.name, r.title, r.content, tag_names.get(r.id, []))
+        for r in db.execute(
+            select(tpl.id, tpl.name, tpl.title, tpl.content).where(tpl.id.in_(template_ids))
+        )
+    ]
+    search = models.MemoTemplateSearch
+    if not rows:
+        db.execute(delete(search).where(search.template_id.in_(template_ids)))
+        return
+    stmt = pg_insert(search).values(rows)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[search.template_id],
+            set_={c: stmt.excluded[c] for c in ("name", "title", "tags", "document")},
+        )
+    )
+
+
+def refresh_for_tag(db, tag_id: int) -> None:
+    """タグ名の変更を、そのタグが付いたテンプレートに反映する。"""
+    link = models.MemoTemplateTagLink
+    ids = db.execute(select(link.template_id).where(link.tag_id == tag_id)).scalars().all()
+    refresh(db, ids)
+
+
+def apply(query, search: str):
+    """テンプレート一覧のクエリに検索条件を加え、(クエリ, 順位の式) を返す。
+
+    検索語が空なら順位の式は None。
+    """
+    terms = [t for t in (normalize(w) for w in search.split()) if t]
+    if not terms:
+        return query, None
+    s = models.MemoTemplateSearch
+    query = query.join(s, s.template_id == models.MemoTemplate.id)
+    score = literal(0)
+    for term in terms:
+        query = query.filter(contains(s.document, term))
+        score = (
+            score
+            + case(
+                (s.name.like(f"{escape_like(term)}%", escape="\\"), WEIGHTS["name_prefix"]),
+                (contains(s.name, term), WEIGHTS["name"]),
+                else_=0,
+            )
+            + case((contains(s.title, term), WEIGHTS["title"]), else_=0)
+            + case((contains(s.tags, term), WEIGHTS["tags"]), else_=0)
+            + WEIGHTS["document"]
+        )
+    return query, score
+
+
+def rebuild(db: Session, batch_size: int = 500) -> int:
+    tpl = models.MemoTemplate
+    total = 0
+    last_id = 0
+    while True:
+        ids = db.execute(
+            select(tpl.id).where(tpl.id > last_id).order_by(tpl.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        refresh(db, ids)
+        db.commit()
+        total += len(ids)
+        last_id = ids[-1]
+    return total
+
+
+def create_index(db: Session) -> None:
+    db.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    db.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_memo_template_search_document_trgm "
+            "ON memo_template_search USING gin (document gin_trgm_ops)"
+        )
+    )
+    db.commit()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Template search utilities.")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild search documents")
+    parser.add_argument(
+        "--create-index", action="store_true", help="create the pg_trgm index"
+    )
+    args = parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        if args.rebuild:
+            print(f"indexed {rebuild(db)} templates")
+        if args.create_index:
+            create_index(db)
+            print("created ix_memo_template_search_document_trgm")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
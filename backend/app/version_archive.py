@@ -0,0 +1,298 @@
+"""メモ・テンプレート履歴の保存期間管理とアーカイブ。
+
+履歴テーブル (facility_memo_versions / memo_template_versions) には
+直近 ``VERSION_HOT_DAYS`` 日分だけを残し、それより古い履歴は
+月単位でパーティション分割したアーカイブテーブルへ圧縮して移す。
+``VERSION_ARCHIVE_KEEP=daily`` の場合、移す際に 1 日 1 件
+(その日の最後の版) に間引く。各メモ・テンプレートの最新版は
+版番号の採番に使うため常に履歴テーブルに残す。
+
+例::
+
+    python -m backend.app.version_archive --hot-days 90 --keep daily
+"""
+
+import argparse
+import os
+import zlib
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+HOT_DAYS = int(os.getenv("VERSION_HOT_DAYS", "90"))
+ARCHIVE_KEEP = os.getenv("VERSION_ARCHIVE_KEEP", "daily")
+
+
+@dataclass(frozen=True)
+class VersionTable:
+    """履歴テーブルとアーカイブテーブルの対応。"""
+
+    model: type
+    archive: type
+    owner: str  # 親を指す列名 (memo_id / template_id)
+
+    def owner_col(self, model):
+        return getattr(model, self.owner)
+
+
+MEMO_VERSIONS = VersionTable(
+    models.FacilityMemoVersion, models.FacilityMemoVersionArchive, "memo_id"
+)
+TEMPLATE_VERSIONS = VersionTable(
+    models.MemoTemplateVersion, models.MemoTemplateVersionArchive, "template_id"
+)
+
+
+def compress(content: Optional[str]) -> Optional[bytes]:
+    if content is None:
+        return None
+    return zlib.compress(content.encode("utf-8"))
+
+
+def decompress(data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    return zlib.decompress(data).decode("utf-8")
+
+
+def _month_start(d: date) -> date:
+    return d.replace(day=1)
+
+
+def _next_month(d: date) -> date:
+    return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def ensure_partitions(db: Session, table: VersionTable, months) -> None:
+    """指定月のパーティションとデフォルトパーティションを作成する。"""
+    name = table.archive.__tablename__
+    db.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {name}_default PARTITION OF {name} DEFAULT")
+    )
+    for month in sorted(set(months)):
+        db.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {name}_{month:%Y_%m} PARTITION OF {name} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+            )
+        )
+
+
+def _archive_owner_batch(
+    db: Session, table: VersionTable, owner_ids: List[int], cutoff: datetime, keep: str
+) -> Dict[str, int]:
+    model = table.model
+    owner_col = table.owner_col(model)
+    latest = (
+        select(owner_col.label("owner_id"), func.max(model.version_no).label("version_no"))
+        .where(owner_col.in_(owner_ids))
+        .group_by(owner_col)
+        .subquery()
+    )
+    rows = db.execute(
+        select(model)
+        .join(latest, owner_col == latest.c.owner_id)
+        .where(model.created_at < cutoff, model.version_no != latest.c.version_no)
+        .order_by(owner_col, model.version_no)
+    ).scalars().all()
+    if not rows:
+        return {"archived": 0, "dropped": 0}
+
+    if keep == "daily":
+        # 同じ日の版は最後のものだけを残す
+        kept: Dict[tuple, object] = {}
+        for row in rows:
+            kept[(getattr(row, table.owner), row.created_at.date())] = row
+        keep_rows = list(kept.values())
+    else:
+        keep_rows = rows
+
+    ensure_partitions(db, table, (_month_start(r.created_at.date()) for r in keep_rows))
+    db.execute(
+        insert(table.archive.__table__),
+        [
+            {
+                table.owner: getattr(r, table.owner),
+                "version_no": r.version_no,
+                "created_at": r.created_at,
+                "id": r.id,
+                "content": compress(r.content),
+                "content_length": len(r.content) if r.content is not None else None,
+                "ip_address": r.ip_address,
+                "action": r.action,
+            }
+            for r in keep_rows
+        ],
+    )
+    db.execute(delete(model).where(model.id.in_([r.id for r in rows])))
+    db.commit()
+    return {"archived": len(keep_rows), "dropped": len(rows) - len(keep_rows)}
+
+
+def archive_versions(
+    db: Session,
+    table: VersionTable,
+    hot_days: int = HOT_DAYS,
+    keep: str = ARCHIVE_KEEP,
+    batch_size: int = 200,
+) -> Dict[str, int]:
+    """保存期間を過ぎた履歴をアーカイブへ移す。
+
+    メモ (テンプレート) ``batch_size`` 件ごとにコミットし、
+    履歴テーブルを長時間ロックしないようにする。
+    """
+    cutoff = datetime.combine(date.today() - timedelta(days=hot_days), time.min)
+    model = table.model
+    owner_col = table.owner_col(model)
+    totals = {"archived": 0, "dropped": 0}
+    last_owner = None
+    while True:
+        query = select(owner_col).where(model.created_at < cutoff)
+        if last_owner is not None:
+            query = query.where(owner_col > last_owner)
+        owner_ids = list(
+            db.execute(query.group_by(owner_col).order_by(owner_col).limit(batch_size)).scalars()
+        )
+        if not owner_ids:
+            break
+        result = _archive_owner_batch(db, table, owner_ids, cutoff, keep)
+        for key, value in result.items():
+            totals[key] += value
+        last_owner = owner_ids[-1]
+    return totals
+
+
+def _archive_dict(table: VersionTable, row) -> dict:
+    return {
+        "id": row.id,
+        table.owner: getattr(row, table.owner),
+        "version_no": row.version_no,
+        "content": decompress(row.content),
+        "created_at": row.created_at,
+        "ip_address": row.ip_address,
+        "action": row.action,
+    }
+
+
+def archived_versions(
+    db: Session,
+    table: VersionTable,
+    owner_id: int,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    ip_address: Optional[str] = None,
+) -> List[dict]:
+    """アーカイブ済みの履歴を新しい順に返す。"""
+    archive = table.archive
+    query = select(archive).where(table.owner_col(archive) == owner_id)
+    if start_date:
+        query = query.where(archive.created_at >= start_date)
+    if end_date:
+        query = query.where(archive.created_at <= end_date)
+    if ip_address:
+        query = query.where(archive.ip_address == ip_address)
+    rows = db.execute(query.order_by(archive.version_no.desc())).scalars()
+    return [_archive_dict(table, r) for r in rows]
+
+
+def version_summaries(
+    db: Session,
+    table: VersionTable,
+    owner_id: int,
+    before: Optional[int] = None,
+    limit: int = 50,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    ip_address: Optional[str] = None,
+    include_archived: bool = False,
+) -> List[dict]:
+    """本文を除いた履歴を版番号の降順で返す。
+
+    ``before`` より小さい版番号から ``limit`` 件を返すキーセット方式。
+    アーカイブ済みの版は履歴テーブルの版より常に古いため、
+    履歴テーブルで足りない分だけアーカイブから補う。
+    """
+    results: List[dict] = []
+    sources = [(table.model, func.length(table.model.content))]
+    if include_archived:
+        sources.append((table.archive, table.archive.content_length))
+    for model, length in sources:
+        remaining = limit - len(results)
+        if remaining <= 0:
+            break
+        query = select(
+            model.id,
+            table.owner_col(model).label(table.owner),
+            model.version_no,
+            model.created_at,
+            model.ip_address,
+            model.action,
+            length.label("content_length"),
+        ).where(table.owner_col(model) == owner_id)
+        if before is not None:
+            query = query.where(model.version_no < before)
+        if start_date:
+            query = query.where(model.created_at >= start_date)
+        if end_date:
+            query = query.where(model.created_at <= end_date)
+        if ip_address:
+            query = query.where(model.ip_address == ip_address)
+        rows = db.execute(query.order_by(model.version_no.desc()).limit(remaining))
+        results.extend(dict(r._mapping) for r in rows)
+    return results
+
+
+def find_archived_version(
+    db: Session, table: VersionTable, owner_id: int, version_no: int
+) -> Optional[dict]:
+    archive = table.archive
+    row = db.execute(
+        select(archive).where(
+            table.owner_col(archive) == owner_id, archive.version_no == version_no
+        )
+    ).scalars().first()
+    return _archive_dict(table, row) if row else None
+
+
+def find_version_content(
+    db: Session, table: VersionTable, owner_id: int, version_no: int
+) -> Optional[dict]:
+    """履歴テーブル、なければアーカイブから版を探し ``{"content": ...}`` で返す。"""
+    model = table.model
+    row = db.execute(
+        select(model.content).where(
+            table.owner_col(model) == owner_id, model.version_no == version_no
+        )
+    ).first()
+    if row is not None:
+        return {"content": row.content}
+    archived = find_archived_version(db, table, owner_id, version_no)
+    return {"content": archived["content"]} if archived else None
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Archive old memo/template versions.")
+    parser.add_argument("--hot-days", type=int, default=HOT_DAYS)
+    parser.add_argument("--keep", choices=["daily", "all"], default=ARCHIVE_KEEP)
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        for label, table in (("memo", MEMO_VERSIONS), ("template", TEMPLATE_VERSIONS)):
+            result = archive_versions(db, table, args.hot_days, args.keep, args.batch_size)
+            print(
+                f"{label} versions: archived {result['archived']}, "
+                f"dropped {result['dropped']}"
+            )
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
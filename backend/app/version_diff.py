@@ -0,0 +1,126 @@
+"""履歴の版同士の差分計算とキャッシュ。
+
+差分は difflib で行単位または文字単位に計算し、変化のない区間は
+件数だけを返すコンパクトな形式にする。版の内容は変更されないため、
+計算結果は ``(種類, 親 id, from, to, mode)`` をキーにした上限付き LRU に
+保持する。計算はイベントループの外で行い、小さな差分はスレッドプール、
+大きな差分はプロセスプールで計算する。文字単位の差分は長さの 2 乗程度の
+時間がかかるため、プロセスプールに回す閾値を行単位より小さくしている。
+
+2 つの版の合計が ``DIFF_MAX_CHARS`` (文字単位は ``DIFF_MAX_CHARS_CHAR``) を
+超える場合は 413 を返す。プロセスプールでの計算が ``DIFF_TIMEOUT`` 秒を
+超えた場合はプールごと止めて作り直し、503 を返す (後続の差分を待たせない)。
+"""
+
+import asyncio
+import difflib
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Hashable, List, Optional
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from .lru import LRUCache
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+CACHE_SIZE = int(os.getenv("DIFF_CACHE_SIZE", "256"))
+OFFLOAD_CHARS = int(os.getenv("DIFF_OFFLOAD_CHARS", "20000"))
+OFFLOAD_CHARS_CHAR = int(os.getenv("DIFF_OFFLOAD_CHARS_CHAR", "2000"))
+MAX_CHARS = int(os.getenv("DIFF_MAX_CHARS", "2000000"))
+MAX_CHARS_CHAR = int(os.getenv("DIFF_MAX_CHARS_CHAR", "100000"))
+TIMEOUT = float(os.getenv("DIFF_TIMEOUT", "10"))
+WORKERS = int(os.getenv("DIFF_WORKERS", "2"))
+
+_cache = LRUCache(CACHE_SIZE)
+_pool: Optional["ProcessPoolExecutor"] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> "ProcessPoolExecutor":
+    global _pool
+    # API ワーカーの起動時には読み込まず、最初に必要になったときに用意する
+    from concurrent.futures import ProcessPoolExecutor
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=WORKERS)
+        return _pool
+
+
+def _discard_pool(pool: "ProcessPoolExecutor") -> None:
+    """時間切れの計算を止めるため、プールのプロセスを終了して次回作り直させる。"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    # ProcessPoolExecutor には計算中のプロセスを止める公開 API が無い
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def compute_diff(old: str, new: str, mode: str = "line", full: bool = False) -> List[dict]:
+    """``old`` から ``new`` への差分を equal / delete / insert の列で返す。
+
+    equal 区間は ``count`` (行数または文字数) のみ返し、
+    ``full`` が真の場合は ``text`` も含める。
+    """
+    if mode == "line":
+        a = old.splitlines(keepends=True)
+        b = new.splitlines(keepends=True)
+    else:
+        a, b = old, new
+    ops: List[dict] = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            op = {"op": "equal", "count": i2 - i1}
+            if full:
+                op["text"] = "".join(a[i1:i2])
+            ops.append(op)
+            continue
+        if tag in ("delete", "replace"):
+            ops.append({"op": "delete", "count": i2 - i1, "text": "".join(a[i1:i2])})
+        if tag in ("insert", "replace"):
+            ops.append({"op": "insert", "count": j2 - j1, "text": "".join(b[j1:j2])})
+    return ops
+
+
+def cached(key: Hashable, mode: str, full: bool) -> Optional[List[dict]]:
+    return _cache.get((key, mode, full))
+
+
+async def diff(
+    key: Hashable, old: Optional[str], new: Optional[str], mode: str, full: bool
+) -> List[dict]:
+    """差分を計算してキャッシュに格納する。"""
+    old = old or ""
+    new = new or ""
+    size = len(old) + len(new)
+    if size > (MAX_CHARS_CHAR if mode == "char" else MAX_CHARS):
+        detail = "Versions are too large to diff"
+        if mode == "char" and size <= MAX_CHARS:
+            detail += " by character; use mode=line"
+        raise HTTPException(status_code=413, detail=detail)
+    if size > (OFFLOAD_CHARS_CHAR if mode == "char" else OFFLOAD_CHARS):
+        pool = _get_pool()
+        loop = asyncio.get_running_loop()
+        try:
+            ops = await asyncio.wait_for(
+                loop.run_in_executor(pool, compute_diff, old, new, mode, full), TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            _discard_pool(pool)
+            raise HTTPException(status_code=503, detail="Diff timed out")
+        except BrokenProcessPool:
+            # 他の差分の時間切れでプールが止められた (ワーカーが落ちた場合も作り直す)
+            _discard_pool(pool)
+            raise HTTPException(status_code=503, detail="Diff was interrupted")
+    else:
+        ops = await run_in_threadpool(compute_diff, old, new, mode, full)
+    _cache.put((key, mode, full), ops)
+    return ops
@@ -0,0 +1,83 @@
+"""API ワーカーの起動時の処理。
+
+テーブルの作成は行わず (``python -m backend.app.migrate`` で事前に行う)、
+スキーマが最新かを 1 回の問い合わせで確かめる。その後、接続プールと
+プロセス内のインデックス (医療機関検索・タグ絞り込み) を温めてから
+リクエストを受け付ける。各段階の所要時間はログと ``/metrics`` の
+``app_startup_seconds`` に出力する。
+"""
+
+import logging
+import os
+import time
+from typing import Dict
+
+from sqlalchemy import text
+
+from . import facility_search, metrics, migrate, tag_index
+from .database import SessionLocal, engine
+
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "1") != "0"
+ENABLED = os.getenv("STARTUP_WARMUP", "1") != "0"
+# 既定はプールの常駐接続数
+POOL_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", str(engine.pool.size())))
+
+# uvicorn の起動ログと並べて出力する
+logger = logging.getLogger("uvicorn.error")
+
+
+def check_schema() -> None:
+    remaining = migrate.pending()
+    if remaining:
+        names = ", ".join(f"{m.version} {m.name}" for m in remaining)
+        raise RuntimeError(
+            f"database schema is out of date (pending: {names}); "
+            "run `python -m backend.app.migrate` first"
+        )
+
+
+def prime_pool(connections: int = POOL_CONNECTIONS) -> None:
+    """接続を確立してプールに戻し、最初のリクエストで接続を待たないようにする。"""
+    conns = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            conns.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def prime_indexes() -> None:
+    db = SessionLocal()
+    try:
+        facility_search.index.ensure_fresh(db)
+        if tag_index.ENABLED:
+            tag_index.index.ensure_fresh(db)
+    finally:
+        db.close()
+
+
+def run(import_seconds: float) -> Dict[str, float]:
+    """起動時の処理を行い、段階ごとの所要時間 (秒) を返す。"""
+    timings = {"import": import_seconds}
+
+    def timed(phase, func):
+        started = time.perf_counter()
+        func()
+        timings[phase] = time.perf_counter() - started
+
+    if SCHEMA_CHECK:
+        timed("schema_check", check_schema)
+    if ENABLED:
+        timed("pool", prime_pool)
+        timed("indexes", prime_indexes)
+    timings["total"] = sum(timings.values())
+    metrics.record_startup(timings)
+    logger.info(
+        "worker ready in %.3fs (%s)",
+        timings["total"],
+        ", ".join(f"{k}={v:.3f}s" for k, v in timings.items() if k != "total"),
+    )
+    return timings
@@ -11,9 +11,31 @@ CREATE TABLE medical_facility (
     emails JSONB,
     fax TEXT,
     remarks TEXT,
-    is_deleted BOOLEAN DEFAULT FALSE
+    is_deleted BOOLEAN DEFAULT FALSE,
+    deleted_at TIMESTAMPTZ
 );
 
+-- 医療機関検索 (app/facility_search.py の search_expression と同じ式)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX ix_medical_facility_search_trgm ON medical_facility USING gin ((
+    replace(translate(lower(normalize(
+        coalesce(short_name, '') || '|' || coalesce(official_name, '') || '|' ||
+        coalesce(prefecture, '') || '|' || coalesce(city, '') || '|' ||
+        coalesce(address_detail, ''), NFKC)),
+        'ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペホボポマミムメモャヤュユョヨラリルレロヮワヰヱヲンヴヵヶ',
+        'ぁあぃいぅうぇえぉおかがきぎくぐけげこごさざしじすずせぜそぞただちぢっつづてでとどなにぬねのはばぱひびぴふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろゎわゐゑをんゔゕゖ'), ' ', '')
+) gin_trgm_ops);
+
+CREATE TABLE facility_phone_numbers (
+    digits TEXT NOT NULL,
+    facility_id INTEGER NOT NULL REFERENCES medical_facility(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    comment TEXT,
+    PRIMARY KEY (digits, facility_id, kind)
+);
+CREATE INDEX ix_facility_phone_numbers_facility_id ON facility_phone_numbers (facility_id);
+
 CREATE TABLE function_categories (
     id SERIAL PRIMARY KEY,
     name TEXT NOT NULL,
@@ -29,7 +51,8 @@ CREATE TABLE functions (
     selection_type TEXT CHECK (selection_type IN ('single', 'multiple')),
     choices TEXT[],
     category_id INTEGER REFERENCES function_categories(id),
-    is_deleted BOOLEAN DEFAULT FALSE
+    is_deleted BOOLEAN DEFAULT FALSE,
+    deleted_at TIMESTAMPTZ
 );
 
 CREATE TABLE facility_function_entries (
@@ -52,7 +75,16 @@ CREATE TABLE memo_tags (
     name TEXT NOT NULL,
     remark TEXT,
     color TEXT,
-    is_deleted BOOLEAN DEFAULT FALSE
+    is_deleted BOOLEAN DEFAULT FALSE,
+    deleted_at TIMESTAMPTZ
+);
+
+-- タグごとの使用件数 (app/tag_usage.py)
+CREATE TABLE memo_tag_usage (
+    tag_id INTEGER PRIMARY KEY REFERENCES memo_tags(id) ON DELETE CASCADE,
+    memos INTEGER NOT NULL DEFAULT 0,
+    deleted_memos INTEGER NOT NULL DEFAULT 0,
+    templates INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE TABLE facility_memos (
@@ -62,6 +94,7 @@ CREATE TABLE facility_memos (
     title TEXT NOT NULL,
     content TEXT,
     is_deleted BOOLEAN DEFAULT FALSE,
+    deleted_at TIMESTAMPTZ,
     sort_order INTEGER DEFAULT 0,
     updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
 );
@@ -77,6 +110,10 @@ CREATE TABLE facility_memo_versions (
     UNIQUE (memo_id, version_no)
 );
 
+-- 履歴一覧のキーセットページング用
+CREATE INDEX IF NOT EXISTS ix_facility_memo_versions_memo_version
+    ON facility_memo_versions (memo_id, version_no);
+
 CREATE TABLE facility_memo_tag_links (
     memo_id INTEGER REFERENCES facility_memos(id) ON DELETE CASCADE,
     tag_id INTEGER REFERENCES memo_tags(id),
@@ -90,15 +127,41 @@ CREATE TABLE facility_memo_locks (
     ip_address TEXT
 );
 
+CREATE TABLE image_blobs (
+    sha256 TEXT PRIMARY KEY,
+    data BYTEA NOT NULL,
+    size INTEGER NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE note_images (
     id UUID PRIMARY KEY,
     memo_id INTEGER REFERENCES facility_memos(id) ON DELETE CASCADE,
     file_name TEXT NOT NULL,
     mime_type TEXT NOT NULL,
-    data BYTEA NOT NULL,
+    data BYTEA,
+    blob_hash TEXT REFERENCES image_blobs(sha256),
     created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX ix_note_images_blob_hash ON note_images (blob_hash);
+
+-- アーカイブしたメモの画像が参照している blob (app/deleted_archive.py)
+CREATE TABLE archived_blob_refs (
+    image_id UUID PRIMARY KEY,
+    memo_id INTEGER NOT NULL,
+    blob_hash TEXT NOT NULL REFERENCES image_blobs(sha256)
+);
+
+CREATE INDEX ix_archived_blob_refs_memo_id ON archived_blob_refs (memo_id);
+CREATE INDEX ix_archived_blob_refs_blob_hash ON archived_blob_refs (blob_hash);
+
+CREATE TABLE note_image_gc_marks (
+    image_id UUID PRIMARY KEY REFERENCES note_images(id) ON DELETE CASCADE,
+    marked_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Template feature tables
 
 CREATE TABLE memo_templates (
@@ -107,6 +170,7 @@ CREATE TABLE memo_templates (
     title TEXT NOT NULL,
     content TEXT,
     is_deleted BOOLEAN DEFAULT FALSE,
+    deleted_at TIMESTAMPTZ,
     updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
     sort_order INTEGER DEFAULT 0
 );
@@ -122,15 +186,108 @@ CREATE TABLE memo_template_versions (
     UNIQUE (template_id, version_no)
 );
 
+CREATE INDEX IF NOT EXISTS ix_memo_template_versions_template_version
+    ON memo_template_versions (template_id, version_no);
+
 CREATE TABLE memo_template_tag_links (
     template_id INTEGER REFERENCES memo_templates(id) ON DELETE CASCADE,
     tag_id INTEGER REFERENCES memo_tags(id),
     PRIMARY KEY (template_id, tag_id)
 );
 
+CREATE TABLE memo_template_search (
+    template_id INTEGER PRIMARY KEY REFERENCES memo_templates(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    title TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX ix_memo_template_search_document_trgm
+    ON memo_template_search USING gin (document gin_trgm_ops);
+
 CREATE TABLE memo_template_locks (
     template_id INTEGER PRIMARY KEY REFERENCES memo_templates(id) ON DELETE CASCADE,
     locked_by TEXT,
     locked_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
     ip_address TEXT
 );
+
+-- Version history archive (partitioned by month, content is zlib compressed)
+
+CREATE TABLE facility_memo_version_archive (
+    memo_id INTEGER NOT NULL,
+    version_no INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    id INTEGER NOT NULL,
+    content BYTEA,
+    content_length INTEGER,
+    ip_address TEXT,
+    action TEXT,
+    PRIMARY KEY (memo_id, version_no, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE facility_memo_version_archive_default
+    PARTITION OF facility_memo_version_archive DEFAULT;
+
+CREATE TABLE memo_template_version_archive (
+    template_id INTEGER NOT NULL,
+    version_no INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    id INTEGER NOT NULL,
+    content BYTEA,
+    content_length INTEGER,
+    ip_address TEXT,
+    action TEXT,
+    PRIMARY KEY (template_id, version_no, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE memo_template_version_archive_default
+    PARTITION OF memo_template_version_archive DEFAULT;
+
+-- 保存期間を過ぎた削除済みデータ (app/deleted_archive.py、payload は zlib 圧縮した JSON)
+
+CREATE TABLE deleted_record_archive (
+    kind TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    label TEXT,
+    deleted_at TIMESTAMPTZ,
+    archived_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    payload BYTEA NOT NULL,
+    PRIMARY KEY (kind, record_id)
+);
+
+-- バックグラウンドジョブ (app/jobs.py)
+
+CREATE TABLE jobs (
+    id SERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB,
+    input BYTEA,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    progress_done INTEGER,
+    progress_total INTEGER,
+    message TEXT,
+    result JSONB,
+    error TEXT,
+    output BYTEA,
+    output_name TEXT,
+    output_type TEXT,
+    worker TEXT,
+    run_after TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    heartbeat_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX ix_jobs_status_run_after ON jobs (status, run_after);
+
+-- 適用済みのスキーマ移行手順 (app/migrate.py)
+-- このファイルから作成した場合も python -m backend.app.migrate を 1 回実行する
+
+CREATE TABLE schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
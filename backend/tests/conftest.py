@@ -0,0 +1,28 @@
+"""テスト共通の設定。
+
+テストは ``DATABASE_URL`` のデータベースに書き込むため、テスト用のデータベースで実行する。
+接続できない場合はデータベースを使うテストを読み飛ばす。
+"""
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from backend.app.database import SessionLocal
+from backend.app.migrate import migrate
+
+
+@pytest.fixture(scope="session")
+def migrated():
+    try:
+        migrate()
+    except OperationalError as exc:
+        pytest.skip(f"database is not available: {exc.orig}")
+
+
+@pytest.fixture
+def db(migrated):
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
@@ -0,0 +1,79 @@
+"""削除済みデータのアーカイブのテスト。"""
+
+import hashlib
+import uuid
+from datetime import datetime, timedelta
+
+from backend.app import deleted_archive, image_gc, image_store, models
+
+
+def test_archived_memo_images_survive_gc(db):
+    data = uuid.uuid4().bytes * 8
+    sha256 = hashlib.sha256(data).hexdigest()
+    memo = models.FacilityMemo(
+        title="archived",
+        content="",
+        is_deleted=True,
+        deleted_at=datetime.now() - timedelta(days=2),
+    )
+    db.add(memo)
+    db.flush()
+    image_store.acquire_blob(db, sha256, data)
+    image = models.NoteImage(
+        memo_id=memo.id, file_name="a.png", mime_type="image/png", blob_hash=sha256
+    )
+    db.add(image)
+    db.commit()
+    memo_id, image_id = memo.id, image.id
+
+    deleted_archive.archive_deleted(db, deleted_archive.KINDS[deleted_archive.MEMO], days=1)
+    assert db.get(models.FacilityMemo, memo_id) is None
+
+    image_gc.run_gc(db, grace_days=0)
+    assert db.get(models.ImageBlob, sha256) is not None
+
+    deleted_archive.restore(db, deleted_archive.MEMO, memo_id)
+    db.commit()
+    restored = db.get(models.NoteImage, image_id)
+    assert restored is not None
+    assert image_store.image_data(db, restored) == data
+    assert db.get(models.ArchivedBlobRef, image_id) is None
+
+
+def test_images_referenced_by_live_memos_are_kept(db):
+    data = uuid.uuid4().bytes * 8
+    sha256 = hashlib.sha256(data).hexdigest()
+    archived = models.FacilityMemo(
+        title="archived",
+        content="",
+        is_deleted=True,
+        deleted_at=datetime.now() - timedelta(days=2),
+    )
+    db.add(archived)
+    db.flush()
+    image_store.acquire_blob(db, sha256, data)
+    image = models.NoteImage(
+        memo_id=archived.id, file_name="a.png", mime_type="image/png", blob_hash=sha256
+    )
+    db.add(image)
+    db.flush()
+    # 別のメモに本文ごとコピーされた画像
+    live = models.FacilityMemo(title="live", content=f"![a](/images/{image.id})")
+    db.add(live)
+    db.commit()
+    memo_id, image_id = archived.id, image.id
+
+    deleted_archive.archive_deleted(db, deleted_archive.KINDS[deleted_archive.MEMO], days=1)
+    db.expire_all()
+    assert db.get(models.FacilityMemo, memo_id) is None
+    kept = db.get(models.NoteImage, image_id)
+    assert kept is not None and kept.memo_id is None
+    assert db.get(models.ArchivedBlobRef, image_id) is None
+
+    image_gc.run_gc(db, grace_days=0)
+    assert db.get(models.NoteImage, image_id) is not None
+
+    deleted_archive.restore(db, deleted_archive.MEMO, memo_id)
+    db.commit()
+    db.expire_all()
+    assert db.get(models.NoteImage, image_id).memo_id == memo_id
@@ -0,0 +1,62 @@
+"""編集ロックのテスト。"""
+
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from backend.app import edit_lock, models
+from backend.app.database import SessionLocal
+
+
+@pytest.fixture
+def memo_id(db):
+    memo = models.FacilityMemo(title="edit-lock", content="")
+    db.add(memo)
+    db.commit()
+    yield memo.id
+    db.query(models.FacilityMemoLock).filter_by(memo_id=memo.id).delete()
+    db.query(models.FacilityMemo).filter_by(id=memo.id).delete()
+    db.commit()
+
+
+def test_concurrent_acquire_has_one_winner(memo_id):
+    users = [f"user{i}" for i in range(8)]
+    barrier = threading.Barrier(len(users))
+    results = {}
+
+    def acquire(user):
+        db = SessionLocal()
+        try:
+            barrier.wait()
+            edit_lock.acquire(db, edit_lock.MEMO, memo_id, user, None)
+            results[user] = 200
+        except HTTPException as e:
+            results[user] = e.status_code
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=acquire, args=(u,)) for u in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results.values()) == [200] + [409] * (len(users) - 1)
+
+
+def test_expired_lock_can_be_taken(db, memo_id):
+    edit_lock.acquire(db, edit_lock.MEMO, memo_id, "alice", None)
+    with pytest.raises(HTTPException) as e:
+        edit_lock.acquire(db, edit_lock.MEMO, memo_id, "bob", None)
+    assert e.value.status_code == 409
+    # 自分のロックは取り直せる
+    edit_lock.acquire(db, edit_lock.MEMO, memo_id, "alice", None)
+
+    db.query(models.FacilityMemoLock).filter_by(memo_id=memo_id).update(
+        {"locked_at": models.FacilityMemoLock.locked_at - edit_lock.LOCK_TIMEOUT}
+    )
+    db.commit()
+    assert edit_lock.acquire(db, edit_lock.MEMO, memo_id, "bob", None)["locked_by"] == "bob"
+    with pytest.raises(HTTPException) as e:
+        edit_lock.heartbeat(db, edit_lock.MEMO, memo_id, "alice")
+    assert e.value.status_code == 409
@@ -0,0 +1,53 @@
+"""医療機関検索のテスト。"""
+
+import uuid
+
+import pytest
+
+from backend.app import facility_search, jobs, models
+
+
+@pytest.fixture
+def index(monkeypatch):
+    fresh = facility_search.PrefixIndex()
+    monkeypatch.setattr(facility_search, "index", fresh)
+    monkeypatch.setattr(facility_search, "CHECK_INTERVAL", 0)
+    return fresh
+
+
+def test_sync_job_rebuilds_index(db, index):
+    name = f"idxsync{uuid.uuid4().hex[:8]}"
+    assert facility_search.search(db, name) == []
+    db.rollback()
+
+    csv = f"short_name,prefecture,city,address_detail\n{name},福岡県,福岡市,1-1\n"
+    job = jobs.enqueue(
+        db, "sync_facilities_csv", {"delete_missing": False}, input=csv.encode()
+    )
+    db.commit()
+    try:
+        assert jobs.run_job(job.id) == "succeeded"
+        db.rollback()
+        # DB の部分一致ではなくインデックスから引けること
+        index.ensure_fresh(db)
+        assert [h.short_name for h in index.search(name, 20)] == [name]
+    finally:
+        db.rollback()
+        fac = models.MedicalFacility
+        ids = [r[0] for r in db.query(fac.id).filter(fac.short_name == name)]
+        db.query(models.FacilityPhoneNumber).filter(
+            models.FacilityPhoneNumber.facility_id.in_(ids)
+        ).delete()
+        db.query(fac).filter(fac.id.in_(ids)).delete()
+        db.query(models.Job).filter(models.Job.id == job.id).delete()
+        db.commit()
+
+
+def test_short_query_skips_db(db, index, monkeypatch):
+    def fail(*args):
+        raise AssertionError("short queries must not use the LIKE fallback")
+
+    monkeypatch.setattr(facility_search, "_search_db", fail)
+    facility_search.search(db, "ab")
+    with pytest.raises(AssertionError):
+        facility_search.search(db, "abc")
@@ -0,0 +1,42 @@
+"""画像 GC のテスト。"""
+
+import hashlib
+import uuid
+from datetime import timedelta
+
+from backend.app import image_gc, image_store, models
+
+
+def _image(db, data):
+    sha256 = hashlib.sha256(data).hexdigest()
+    image_store.acquire_blob(db, sha256, data)
+    image = models.NoteImage(file_name="a.png", mime_type="image/png", blob_hash=sha256)
+    db.add(image)
+    db.flush()
+    db.add(models.NoteImageGcMark(image_id=image.id))
+    return image.id
+
+
+def test_dry_run_reports_released_blob_bytes(db):
+    freed = uuid.uuid4().bytes * 8
+    shared = uuid.uuid4().bytes * 4
+    # 同じ blob を参照する 2 枚はどちらも消えるので blob も解放される
+    _image(db, freed)
+    _image(db, freed)
+    # 片方がまだ参照されている blob は残る
+    _image(db, shared)
+    referenced = _image(db, shared)
+    db.commit()
+    refs = {str(referenced)}
+
+    planned = image_gc.sweep(db, refs, timedelta(0), dry_run=True)
+    assert planned["bytes"] >= len(freed)
+    done = image_gc.sweep(db, refs, timedelta(0))
+    assert planned == done
+    assert db.get(models.ImageBlob, hashlib.sha256(freed).hexdigest()) is None
+    assert db.get(models.ImageBlob, hashlib.sha256(shared).hexdigest()) is not None
+
+    db.query(models.NoteImageGcMark).filter_by(image_id=referenced).delete()
+    db.query(models.NoteImage).filter_by(id=referenced).delete()
+    image_store.release_blobs(db, [hashlib.sha256(shared).hexdigest()])
+    db.commit()
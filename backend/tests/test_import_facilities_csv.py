@@ -0,0 +1,45 @@
+"""医療機関 CSV の差分同期のテスト。"""
+
+import uuid
+
+import pytest
+from sqlalchemy import event
+
+from backend.app import import_facilities_csv, models
+from backend.app.database import engine
+
+
+@pytest.fixture
+def csv_text(db):
+    prefix = f"csvsync{uuid.uuid4().hex[:8]}"
+    text = "short_name,official_name,prefecture,city,address_detail,phone_numbers\n" + "".join(
+        f"{prefix}-{i},医療法人 {i},福岡県,福岡市,中央区{i}-1,092-000-000{i}\n" for i in range(5)
+    )
+    yield text
+    fac = models.MedicalFacility
+    ids = [r[0] for r in db.query(fac.id).filter(fac.short_name.like(f"{prefix}-%"))]
+    db.query(models.FacilityPhoneNumber).filter(
+        models.FacilityPhoneNumber.facility_id.in_(ids)
+    ).delete()
+    db.query(fac).filter(fac.id.in_(ids)).delete()
+    db.commit()
+
+
+def test_second_sync_of_same_file_writes_nothing(db, csv_text):
+    first = import_facilities_csv.sync_csv_text(db, csv_text, delete_missing=False)
+    assert first.inserted == 5
+
+    writes = []
+
+    def count_writes(conn, cursor, statement, *args):
+        if statement.lstrip().split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE"):
+            writes.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_writes)
+    try:
+        second = import_facilities_csv.sync_csv_text(db, csv_text, delete_missing=False)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_writes)
+    assert second.writes == 0
+    assert second.unchanged == 5
+    assert writes == []
@@ -0,0 +1,82 @@
+"""バックグラウンドジョブのキューのテスト。"""
+
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import func, select, text
+
+from backend.app import jobs, models
+from backend.app.database import SessionLocal
+
+
+@pytest.fixture
+def queued(db, monkeypatch):
+    """失敗するだけのジョブを登録し、積んだジョブを返す。"""
+
+    def fail(ctx, payload):
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(jobs.HANDLERS, "test_fail", fail)
+    created = []
+
+    def enqueue(n=1, **kwargs):
+        batch = [jobs.enqueue(db, "test_fail", **kwargs) for _ in range(n)]
+        db.commit()
+        created.extend(j.id for j in batch)
+        return [j.id for j in batch]
+
+    yield enqueue
+    db.rollback()
+    db.query(models.Job).filter(models.Job.id.in_(created)).delete()
+    db.commit()
+
+
+def _claim_all(db, ids):
+    """他のテストの残りを除いて、取り出した自分のジョブだけを返す。"""
+    return [i for i in jobs.claim(db, "test", 1000) if i in ids]
+
+
+def test_claim_skips_locked_jobs(db, queued):
+    ids = queued(3)
+    other = SessionLocal()
+    try:
+        # 他のワーカーが取り出し中の行
+        other.execute(
+            select(models.Job.id).where(models.Job.id == ids[0]).with_for_update()
+        ).all()
+        # 待たされるようなら SKIP LOCKED が効いていない
+        db.execute(text("SET lock_timeout = '2s'"))
+        assert sorted(_claim_all(db, ids)) == ids[1:]
+    finally:
+        db.execute(text("RESET lock_timeout"))
+        db.commit()
+        other.rollback()
+        other.close()
+    assert _claim_all(db, ids) == ids[:1]
+    assert _claim_all(db, ids) == []
+
+
+def _delay(db, job_id):
+    return db.execute(
+        select(models.Job.run_after - func.now()).where(models.Job.id == job_id)
+    ).scalar()
+
+
+def test_failed_jobs_are_retried_with_backoff(db, queued):
+    (job_id,) = queued(max_attempts=3)
+    delay = timedelta(seconds=jobs.RETRY_DELAY)
+    for attempt in (1, 2):
+        assert _claim_all(db, [job_id]) == [job_id]
+        assert jobs.run_job(job_id) == "queued"
+        db.rollback()
+        expected = delay * 2 ** (attempt - 1)
+        assert expected - timedelta(seconds=5) < _delay(db, job_id) <= expected
+        # 待ち時間の間は取り出されない
+        assert _claim_all(db, [job_id]) == []
+        db.query(models.Job).filter_by(id=job_id).update({"run_after": func.now()})
+        db.commit()
+    assert _claim_all(db, [job_id]) == [job_id]
+    assert jobs.run_job(job_id) == "failed"
+    db.rollback()
+    job = db.get(models.Job, job_id)
+    assert job.attempts == 3 and "boom" in job.error
@@ -0,0 +1,34 @@
+"""メモ API のテスト。"""
+
+from fastapi.testclient import TestClient
+
+from backend.app import markdown_render, models
+from backend.app.main import app
+from backend.app.routers import memo as memo_router
+
+client = TestClient(app)
+
+
+def test_contents_return_bodies_with_hashes(db):
+    memos = [
+        models.FacilityMemo(title="contents", content="# 見出し\n本文"),
+        models.FacilityMemo(title="contents", content=""),
+    ]
+    db.add_all(memos)
+    db.commit()
+    ids = [m.id for m in memos]
+    try:
+        res = client.get("/memos/contents", params={"ids": ids + [ids[0], 999999999]})
+        assert res.status_code == 200
+        body = res.json()
+        # 重複と存在しない id は含めない
+        assert [r["id"] for r in body] == ids
+        for row, memo in zip(body, memos):
+            assert row["content"] == memo.content
+            assert row["content_hash"] == markdown_render.content_hash(memo.content)
+
+        too_many = list(range(1, memo_router.MAX_CONTENT_IDS + 2))
+        assert client.get("/memos/contents", params={"ids": too_many}).status_code == 400
+    finally:
+        db.query(models.FacilityMemo).filter(models.FacilityMemo.id.in_(ids)).delete()
+        db.commit()
@@ -0,0 +1,31 @@
+"""画像のアップロードのテスト。"""
+
+import hashlib
+import uuid
+
+from fastapi.testclient import TestClient
+
+from backend.app import models
+from backend.app.main import app
+
+client = TestClient(app)
+
+
+def test_upload_deduplicates_blobs(db):
+    memo = models.FacilityMemo(title="upload", content="")
+    db.add(memo)
+    db.commit()
+    data = uuid.uuid4().bytes * 100
+    ids = []
+    for _ in range(2):
+        res = client.post(
+            "/images/",
+            data={"memo_id": str(memo.id)},
+            files={"file": ("a.png", data, "image/png")},
+        )
+        assert res.status_code == 200
+        ids.append(res.json()["id"])
+    blob = db.get(models.ImageBlob, hashlib.sha256(data).hexdigest())
+    assert blob is not None and blob.ref_count == 2 and blob.size == len(data)
+    res = client.get(f"/images/{ids[1]}")
+    assert res.status_code == 200 and res.content == data
@@ -0,0 +1,9 @@
+"""一覧の dict 直組み立てと response_model の経路の比較。"""
+
+from backend.app import bench_serializers
+
+
+def test_fast_path_matches_response_model():
+    # 出力が異なる場合は run が AssertionError を送出する
+    result = bench_serializers.run(facilities=20, functions=3, repeat=1)
+    assert result["old_bytes"] > 0 and result["new_bytes"] > 0
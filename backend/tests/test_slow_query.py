@@ -0,0 +1,29 @@
+import pytest
+
+from backend.app import slow_query
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "SELECT count(*) FROM facility_memos WHERE facility_id IN (%(ids)s)",
+        "SELECT id FROM facility_memos WHERE lower(title) = 'setval(' "
+        "AND EXISTS (SELECT 1 FROM memo_tags WHERE memo_tags.memo_id = facility_memos.id)",
+    ],
+)
+def test_plain_reads_are_explained(statement):
+    assert slow_query._explainable(statement)
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "SELECT pg_advisory_lock(%(key)s)",
+        "SELECT setval('facility_memos_id_seq', 10)",
+        "SELECT pg_export_snapshot()",
+        "SELECT id FROM jobs WHERE status = 'queued' FOR UPDATE SKIP LOCKED",
+        "UPDATE jobs SET status = 'running'",
+    ],
+)
+def test_side_effects_are_not_explained(statement):
+    assert not slow_query._explainable(statement)
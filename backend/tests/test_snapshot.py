@@ -0,0 +1,64 @@
+"""スナップショットのバックアップ・リストアのテスト。"""
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from backend.app import models, snapshot
+from backend.app.database import engine
+
+
+@pytest.fixture
+def restore_engine(migrated):
+    """リストア先の空のデータベース。"""
+    name = f"{engine.url.database}_restore"
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+        conn.execute(text(f'CREATE DATABASE "{name}"'))
+    target = create_engine(engine.url.set(database=name))
+    models.Base.metadata.create_all(target)
+    yield target
+    target.dispose()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+
+
+def test_incremental_restore_drops_deleted_rows(db, restore_engine, tmp_path, monkeypatch):
+    kept = models.FacilityMemo(title="snapshot-kept", content="before")
+    removed = models.FacilityMemo(title="snapshot-removed", content="")
+    db.add_all([kept, removed])
+    db.flush()
+    # 削除された行を参照する子も残っていると、リストアで外部キー違反になる
+    version = models.FacilityMemoVersion(
+        memo_id=removed.id, version_no=1, content="", action="edit"
+    )
+    db.add(version)
+    db.commit()
+    kept_id, removed_id = kept.id, removed.id
+    try:
+        full, diff = str(tmp_path / "full"), str(tmp_path / "diff")
+        snapshot.backup(full, workers=1)
+        kept.content = "after"
+        db.delete(version)
+        db.flush()
+        db.delete(removed)
+        db.commit()
+        manifest = snapshot.backup(diff, since=full, workers=1)
+        assert manifest["tables"]["facility_memos"]["mode"] == "incremental"
+
+        monkeypatch.setattr(snapshot, "engine", restore_engine)
+        snapshot.restore(diff, workers=1)
+        with restore_engine.connect() as conn:
+            rows = dict(
+                conn.execute(
+                    text("SELECT id, content FROM facility_memos WHERE id IN (:a, :b)"),
+                    {"a": kept_id, "b": removed_id},
+                ).all()
+            )
+        assert rows == {kept_id: "after"}
+    finally:
+        db.rollback()
+        db.query(models.FacilityMemoVersion).filter_by(memo_id=removed_id).delete()
+        db.query(models.FacilityMemo).filter(
+            models.FacilityMemo.id.in_([kept_id, removed_id])
+        ).delete()
+        db.commit()
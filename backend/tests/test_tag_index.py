@@ -0,0 +1,80 @@
+"""タグ絞り込みのインデックスのテスト。"""
+
+import itertools
+
+import pytest
+
+from backend.app import models, tag_index
+
+
+@pytest.fixture
+def tagged(db):
+    """タグ 3 つとメモ 8 つを作り、メモ i にはビット j が立っているタグ j を付ける。"""
+    tags = [models.MemoTag(name=f"tag-index-{i}") for i in range(3)]
+    db.add_all(tags)
+    memos = [models.FacilityMemo(title=f"tag-index-{i}", content="") for i in range(8)]
+    db.add_all(memos)
+    db.flush()
+    for i, memo in enumerate(memos):
+        for j, tag in enumerate(tags):
+            if i >> j & 1:
+                db.add(models.FacilityMemoTagLink(memo_id=memo.id, tag_id=tag.id))
+    db.commit()
+    yield [t.id for t in tags], [m.id for m in memos]
+    memo_ids = [m.id for m in memos]
+    db.query(models.FacilityMemoTagLink).filter(
+        models.FacilityMemoTagLink.memo_id.in_(memo_ids)
+    ).delete()
+    db.query(models.FacilityMemo).filter(models.FacilityMemo.id.in_(memo_ids)).delete()
+    db.query(models.MemoTag).filter(models.MemoTag.id.in_([t.id for t in tags])).delete()
+    db.commit()
+
+
+def _sql_ids(db, memo_ids, tag_ids, mode):
+    query = db.query(models.FacilityMemo.id).filter(
+        models.FacilityMemo.id.in_(memo_ids), tag_index.sql_condition(tag_ids, mode)
+    )
+    return {r[0] for r in query}
+
+
+def _combinations(tag_ids):
+    for n in range(1, len(tag_ids) + 1):
+        for combo in itertools.combinations(tag_ids, n):
+            for mode in ("and", "or"):
+                yield list(combo), mode
+
+
+def test_index_matches_sql(db, tagged):
+    tag_ids, memo_ids = tagged
+    index = tag_index.TagBitmapIndex()
+    index.rebuild(db)
+    for combo, mode in _combinations(tag_ids):
+        expected = _sql_ids(db, memo_ids, combo, mode)
+        assert index.match(combo, mode) & set(memo_ids) == expected, (combo, mode)
+
+
+def test_set_tags_keeps_index_in_sync(db, tagged):
+    tag_ids, memo_ids = tagged
+    index = tag_index.TagBitmapIndex()
+    index.rebuild(db)
+    link = models.FacilityMemoTagLink
+    db.query(link).filter(link.memo_id == memo_ids[7]).delete()
+    db.add(link(memo_id=memo_ids[0], tag_id=tag_ids[2]))
+    db.commit()
+    index.set_tags(memo_ids[7], [])
+    index.set_tags(memo_ids[0], [tag_ids[2]])
+    for combo, mode in _combinations(tag_ids):
+        expected = _sql_ids(db, memo_ids, combo, mode)
+        assert index.match(combo, mode) & set(memo_ids) == expected, (combo, mode)
+
+
+def test_filter_query_falls_back_to_sql(db, tagged, monkeypatch):
+    tag_ids, memo_ids = tagged
+    monkeypatch.setattr(tag_index, "ENABLED", True)
+    monkeypatch.setattr(tag_index, "index", tag_index.TagBitmapIndex())
+    base = db.query(models.FacilityMemo.id).filter(models.FacilityMemo.id.in_(memo_ids))
+    expected = _sql_ids(db, memo_ids, tag_ids[:2], "and")
+    for max_ids in (10_000, 0):
+        monkeypatch.setattr(tag_index, "MAX_IDS", max_ids)
+        query = tag_index.filter_query(db, base, tag_ids[:2], "and")
+        assert {r[0] for r in query} == expected
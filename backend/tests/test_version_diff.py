@@ -0,0 +1,77 @@
+"""版の差分計算のテスト。"""
+
+import asyncio
+import random
+import string
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from backend.app import version_diff
+
+
+def _text(n: int, seed: int) -> str:
+    rng = random.Random(seed)
+    return "".join(rng.choice(string.ascii_lowercase + "\n") for _ in range(n))
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_compute_diff_line_mode():
+    ops = version_diff.compute_diff("a\nb\nc\n", "a\nx\nc\n", "line", full=True)
+    assert ops == [
+        {"op": "equal", "count": 1, "text": "a\n"},
+        {"op": "delete", "count": 1, "text": "b\n"},
+        {"op": "insert", "count": 1, "text": "x\n"},
+        {"op": "equal", "count": 1, "text": "c\n"},
+    ]
+
+
+def test_offloaded_diff_matches_and_keeps_loop_running(monkeypatch):
+    monkeypatch.setattr(version_diff, "OFFLOAD_CHARS_CHAR", 0)
+    old, new = _text(3000, 1), _text(3000, 2)
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        started = time.monotonic()
+        ops = await version_diff.diff(("test", 1), old, new, "char", False)
+        elapsed = time.monotonic() - started
+        task.cancel()
+        return ops, ticks, elapsed
+
+    ops, ticks, elapsed = _run(main())
+    assert ops == version_diff.compute_diff(old, new, "char")
+    assert version_diff.cached(("test", 1), "char", False) == ops
+    # 計算中もイベントループが止まらない
+    assert ticks >= elapsed / 0.01 / 4
+
+
+def test_too_large_diff_is_rejected(monkeypatch):
+    monkeypatch.setattr(version_diff, "MAX_CHARS_CHAR", 10)
+    with pytest.raises(HTTPException) as exc:
+        _run(version_diff.diff(("test", 2), "a" * 6, "b" * 6, "char", False))
+    assert exc.value.status_code == 413
+    assert _run(version_diff.diff(("test", 2), "a" * 6, "b" * 6, "line", False))
+
+
+def test_timed_out_diff_frees_the_pool(monkeypatch):
+    monkeypatch.setattr(version_diff, "OFFLOAD_CHARS_CHAR", 0)
+    monkeypatch.setattr(version_diff, "TIMEOUT", 0.05)
+    old, new = _text(40000, 3), _text(40000, 4)
+    with pytest.raises(HTTPException) as exc:
+        _run(version_diff.diff(("test", 3), old, new, "char", False))
+    assert exc.value.status_code == 503
+    # 作り直したプールで次の差分を計算できる
+    monkeypatch.setattr(version_diff, "TIMEOUT", 30)
+    assert _run(version_diff.diff(("test", 4), "ab", "ac", "char", False))
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from 'react';
+import { useState, useEffect, useCallback, useRef } from 'react';
 import MemoList from './MemoList';
 import MemoViewer from './MemoViewer';
 import MemoEditor from './MemoEditor';
@@ -15,6 +15,9 @@ export interface MemoItem {
   tag_ids: number[];
   deleted?: boolean;
   sort_order: number;
+  content_hash?: string;
+  // 一覧は本文を含まずに取得するため、本文を読み込むまでは false
+  loaded?: boolean;
 }
 
 export interface MemoTag {
@@ -23,21 +26,84 @@ export interface MemoTag {
   remark?: string;
   color?: string;
   is_deleted: boolean;
+  memo_count?: number;
+  deleted_memo_count?: number;
+  template_count?: number;
 }
 
-interface FacilityMemoResponse {
+interface MemoSummaryResponse {
   id: number;
   facility_id: number;
   parent_id: number | null;
   title: string;
-  content: string | null;
+  content_length: number;
+  content_hash: string;
   is_deleted: boolean;
   tags: MemoTag[];
   sort_order: number;
 }
+
+interface MemoContentResponse {
+  id: number;
+  content: string | null;
+  content_hash: string | null;
+}
+
+interface BootstrapResponse {
+  memos: MemoSummaryResponse[];
+  tags: MemoTag[];
+  selected: MemoContentResponse | null;
+}
 
 const initialMemos: MemoItem[] = [];
 const apiBase = import.meta.env.VITE_API_URL || 'http://localhost:8001';
+// 本文をまとめて取得する件数
+const CONTENT_BATCH = 50;
+const CONTENT_STORAGE_PREFIX = 'memoContent:';
+
+// 取得した本文はハッシュごとに保持し、sessionStorage にも保存して再読み込み後も使う
+const contentByHash = new Map<string, string>();
+
+const cachedContent = (hash?: string | null): string | null => {
+  if (!hash) return null;
+  let content = contentByHash.get(hash) ?? null;
+  if (content === null) {
+    try {
+      content = sessionStorage.getItem(CONTENT_STORAGE_PREFIX + hash);
+    } catch {
+      content = null;
+    }
+    if (content !== null) contentByHash.set(hash, content);
+  }
+  return content;
+};
+
+const storeContent = (c: MemoContentResponse) => {
+  if (!c.content_hash) return;
+  contentByHash.set(c.content_hash, c.content || '');
+  try {
+    sessionStorage.setItem(CONTENT_STORAGE_PREFIX + c.content_hash, c.content || '');
+  } catch {
+    // 容量を超えた場合はメモリ上にだけ保持する
+  }
+};
+
+// 手元にある本文のうち、ハッシュが一覧と一致するものを反映する
+const withContent = (m: MemoItem): MemoItem => {
+  if (m.loaded) return m;
+  const content = cachedContent(m.content_hash);
+  return content === null ? m : { ...m, content, loaded: true };
+};
+
+// ブラウザの空き時間に実行する (戻り値で取り消す)
+const whenIdle = (fn: () => void): (() => void) => {
+  if (typeof window.requestIdleCallback === 'function') {
+    const handle = window.requestIdleCallback(fn);
+    return () => window.cancelIdleCallback(handle);
+  }
+  const timer = window.setTimeout(fn, 200);
+  return () => window.clearTimeout(timer);
+};
 
 const getCurrentUser = (): string => {
   let user = localStorage.getItem('memoUser');
@@ -80,6 +146,11 @@ export default function MemoApp({ facilityId, facilityName, initialSelectedId }:
   const [tagFilter, setTagFilter] = useState<number[]>([]);
   const [isHistoryOpen, setIsHistoryOpen] = useState(false);
   const [isTemplateOpen, setIsTemplateOpen] = useState(false);
+  // 取得中の本文の ID (先読みで同じ本文を重ねて要求しない)
+  const contentRequests = useRef(new Set<number>());
+  const listUrl = facilityId
+    ? `${apiBase}/memos/facility/${facilityId}`
+    : `${apiBase}/memos/general`;
 
   useEffect(() => {
     if (initialSelectedId) {
@@ -102,49 +173,86 @@ export default function MemoApp({ facilityId, facilityName, initialSelectedId }:
   };
 
 
+  const applyTags = useCallback((data: MemoTag[]) => {
+    const sorted = data.slice().sort((a, b) => a.name.localeCompare(b.name));
+    const saved = getCookie('memoTagOrder');
+    let order = sorted.map((t) => t.id);
+    if (saved) {
+      const parsed = saved
+        .split(',')
+        .map((v) => parseInt(v))
+        .filter((id) => sorted.some((t) => t.id === id));
+      const missing = sorted.map((t) => t.id).filter((id) => !parsed.includes(id));
+      order = [...parsed, ...missing];
+    }
+    const ordered = order
+      .map((id) => sorted.find((t) => t.id === id)!)
+      .filter(Boolean) as MemoTag[];
+    setTagMaster(ordered);
+    setCookie('memoTagOrder', order.join(','));
+  }, []);
+
   const fetchTags = useCallback(() => {
     fetch(`${apiBase}/memo-tags`)
       .then((res) => res.json())
-      .then((data: MemoTag[]) => {
-        const sorted = data.slice().sort((a, b) => a.name.localeCompare(b.name));
-        const saved = getCookie('memoTagOrder');
-        let order = sorted.map((t) => t.id);
-        if (saved) {
-          const parsed = saved
-            .split(',')
-            .map((v) => parseInt(v))
-            .filter((id) => sorted.some((t) => t.id === id));
-          const missing = sorted.map((t) => t.id).filter((id) => !parsed.includes(id));
-          order = [...parsed, ...missing];
-        }
-        const ordered = order
-          .map((id) => sorted.find((t) => t.id === id)!)
-          .filter(Boolean) as MemoTag[];
-        setTagMaster(ordered);
-        setCookie('memoTagOrder', order.join(','));
-      });
+      .then(applyTags);
+  }, [applyTags]);
+
+  const loadContents = useCallback((ids: number[]) => {
+    let chain = Promise.resolve([] as MemoContentResponse[]);
+    for (let i = 0; i < ids.length; i += CONTENT_BATCH) {
+      const batch = ids.slice(i, i + CONTENT_BATCH);
+      const query = batch.map((id) => `ids=${id}`).join('&');
+      batch.forEach((id) => contentRequests.current.add(id));
+      chain = chain.then((loaded) =>
+        fetch(`${apiBase}/memos/contents?${query}`)
+          .then((res) => res.json())
+          .then((data: MemoContentResponse[]) => {
+            data.forEach(storeContent);
+            const byId = new Map(data.map((c) => [c.id, c]));
+            // 一覧の取得後に更新された本文は、取得した本文とハッシュで置き換える
+            setMemos((prev) => prev.map((m) => {
+              const c = byId.get(m.id);
+              if (!c) return m;
+              return {
+                ...m,
+                content: c.content || '',
+                content_hash: c.content_hash ?? m.content_hash,
+                loaded: true,
+              };
+            }));
+            return [...loaded, ...data];
+          })
+          // 失敗しても残りの本文の取得は続ける
+          .catch(() => loaded)
+          .finally(() => batch.forEach((id) => contentRequests.current.delete(id))));
+    }
+    return chain;
+  }, []);
+
+  // 一覧 (本文なし) を反映する。本文は選択中のメモを先に、残りは空き時間に取得する
+  // (検索は本文の取得後に対象になる)
+  const applyMemos = useCallback((data: MemoSummaryResponse[]) => {
+    const list: MemoItem[] = data.map((m) => withContent({
+      id: m.id,
+      parent_id: m.parent_id,
+      title: m.title,
+      content: '',
+      content_hash: m.content_hash,
+      tag_ids: (m.tags || []).map((t) => t.id),
+      deleted: m.is_deleted,
+      sort_order: m.sort_order,
+      loaded: m.content_length === 0,
+    }));
+    list.sort((a, b) => a.sort_order - b.sort_order);
+    setMemos(list);
   }, []);
 
   const fetchMemos = useCallback(() => {
-    const url = facilityId
-      ? `${apiBase}/memos/facility/${facilityId}?include_deleted=true`
-      : `${apiBase}/memos/general?include_deleted=true`;
-    fetch(url)
+    fetch(`${listUrl}?include_deleted=true&view=summary`)
       .then((res) => res.json())
-      .then((data: FacilityMemoResponse[]) => {
-        const list: MemoItem[] = data.map((m) => ({
-          id: m.id,
-          parent_id: m.parent_id,
-          title: m.title,
-          content: m.content || '',
-          tag_ids: (m.tags || []).map((t) => t.id),
-          deleted: m.is_deleted,
-          sort_order: m.sort_order,
-        }));
-        list.sort((a, b) => a.sort_order - b.sort_order);
-        setMemos(list);
-      });
-  }, [facilityId]);
+      .then(applyMemos);
+  }, [listUrl, applyMemos]);
 
   const lockMemo = (id: number) =>
     fetch(`${apiBase}/memos/${id}/lock?user=${currentUser}`, { method: 'POST' });
@@ -152,10 +260,36 @@ export default function MemoApp({ facilityId, facilityName, initialSelectedId }:
   const unlockMemo = (id: number) =>
     fetch(`${apiBase}/memos/${id}/lock?user=${currentUser}`, { method: 'DELETE' });
 
+  // 編集中はロックの期限 (既定 5 分) が切れないように定期的に延長する
+  const editingLockId = editing && !editingReadOnly ? editing.id : 0;
   useEffect(() => {
-    fetchTags();
-    fetchMemos();
-  }, [fetchTags, fetchMemos]);
+    if (!editingLockId) return;
+    const timer = setInterval(() => {
+      fetch(`${apiBase}/memos/${editingLockId}/lock/heartbeat?user=${currentUser}`, {
+        method: 'POST',
+      }).then((res) => {
+        if (res.status === 409) {
+          clearInterval(timer);
+          setEditingMessage('編集ロックが失効しました。保存前に他の端末での変更を確認してください。');
+        }
+      });
+    }, 60000);
+    return () => clearInterval(timer);
+  }, [editingLockId]);
+
+  // 初期表示は一覧・タグ・選択中のメモの本文を 1 回のリクエストで取得する
+  useEffect(() => {
+    const params = new URLSearchParams({ include_deleted: 'true' });
+    if (initialSelectedId) params.set('selected', String(initialSelectedId));
+    fetch(`${listUrl}/bootstrap?${params}`)
+      .then((res) => (res.ok ? res.json() : Promise.reject(res)))
+      .then((data: BootstrapResponse) => {
+        if (data.selected) storeContent(data.selected);
+        applyTags(data.tags);
+        applyMemos(data.memos);
+      })
+      .catch(() => setMemos([]));
+  }, [listUrl, initialSelectedId, applyTags, applyMemos]);
 
   const filtered = memos.filter((m) => {
     if (!showDeleted && m.deleted) return false;
@@ -184,6 +318,30 @@ export default function MemoApp({ facilityId, facilityName, initialSelectedId }:
   const childMemos = selected
     ? memos.filter((m) => m.parent_id === selected.id && (showDeleted || !m.deleted))
     : [];
+
+  // 選択したメモの本文が未取得なら先に読む
+  const selectedPending = selected !== null && selected.loaded === false;
+  useEffect(() => {
+    if (selectedPending && selectedId) loadContents([selectedId]);
+  }, [selectedPending, selectedId, loadContents]);
+
+  // 残りの本文は空き時間に、表示中のメモ・削除されていないメモの順に先読みする
+  // (削除済みのメモは表示しているときだけ)
+  const prefetchIds = memos
+    .filter((m) => m.loaded === false && (showDeleted || !m.deleted))
+    .filter((m) => !contentRequests.current.has(m.id))
+    .map((m) => ({ id: m.id, rank: (visibleIds.has(m.id) ? 0 : 2) + (m.deleted ? 1 : 0) }))
+    .sort((a, b) => a.rank - b.rank)
+    .slice(0, CONTENT_BATCH)
+    .map((m) => m.id);
+  const prefetchKey = prefetchIds.join(',');
+  useEffect(() => {
+    if (!prefetchKey) return;
+    const ids = prefetchKey.split(',').map(Number);
+    return whenIdle(() => {
+      loadContents(ids);
+    });
+  }, [prefetchKey, loadContents]);
 
   const handleCreate = () => {
     const memo: MemoItem = {
@@ -200,6 +358,21 @@ export default function MemoApp({ facilityId, facilityName, initialSelectedId }:
   };
 
   const handleEdit = (memo: MemoItem) => {
+    if (memo.loaded === false) {
+      // 本文の取得前に編集を始めると空の本文で保存してしまうため、取得してから開く
+      loadContents([memo.id]).then((data) => {
+        const loaded = data.find((c) => c.id === memo.id);
+        if (loaded) {
+          handleEdit({
+            ...memo,
+            content: loaded.content || '',
+            content_hash: loaded.content_hash ?? memo.content_hash,
+            loaded: true,
+          });
+        }
+      });
+      return;
+    }
     lockMemo(memo.id)
       .then(async (res) => {
         if (res.ok) {
@@ -126,24 +126,26 @@ export default function MemoEditor({ memo, tagOptions, onSave, onCancel, onOpenT
       alert('画像を追加する前にメモを保存してください');
       return;
     }
-    Array.from(files).forEach((file) => {
-      if (!file.type.startsWith('image/')) return;
-      const form = new FormData();
-      form.append('file', file);
-      form.append('memo_id', String(memo.id));
-      fetch(`${apiBase}/images`, {
-        method: 'POST',
-        body: form,
+    const images = Array.from(files).filter((file) => file.type.startsWith('image/'));
+    if (images.length === 0) return;
+    const form = new FormData();
+    images.forEach((file) => form.append('files', file));
+    form.append('memo_id', String(memo.id));
+    fetch(`${apiBase}/images/batch`, {
+      method: 'POST',
+      body: form,
+    })
+      .then((res) => {
+        if (!res.ok) throw new Error();
+        return res.json();
       })
-        .then((res) => res.json())
-        .then((data) => {
-          const textarea = textareaRef.current;
-          const pos = textarea ? textarea.selectionStart || content.length : content.length;
-          const tag = generateTag(data.id, file.name);
-          insertTagAt(tag, pos);
-        })
-        .catch(() => alert('画像アップロードに失敗しました'));
-    });
+      .then((data: { id: string; file_name: string }[]) => {
+        const textarea = textareaRef.current;
+        const pos = textarea ? textarea.selectionStart || content.length : content.length;
+        const tag = data.map((img) => generateTag(img.id, img.file_name)).join('');
+        insertTagAt(tag, pos);
+      })
+      .catch(() => alert('画像アップロードに失敗しました'));
   };
 
   const applyStyle = (style: string) => {
@@ -1,5 +1,5 @@
 import { Dialog, Transition } from '@headlessui/react';
-import { Fragment, useEffect, useState } from 'react';
+import { Fragment, useCallback, useEffect, useState } from 'react';
 
 interface Version {
   id: number;
@@ -11,6 +11,8 @@ interface Version {
   action: string | null;
 }
 
+type VersionSummary = Omit<Version, 'content'> & { content_length: number | null };
+
 interface Props {
   memoId: number;
   isOpen: boolean;
@@ -20,6 +22,7 @@ interface Props {
 }
 
 const apiBase = import.meta.env.VITE_API_URL || 'http://localhost:8001';
+const PAGE_SIZE = 50;
 const actionLabels: Record<string, string> = {
   create: '新規',
   edit: '修正',
@@ -28,21 +31,42 @@ const actionLabels: Record<string, string> = {
 };
 
 export default function MemoHistoryModal({ memoId, isOpen, onClose, onRestore, onView }: Props) {
-  const [versions, setVersions] = useState<Version[]>([]);
+  const [versions, setVersions] = useState<VersionSummary[]>([]);
+  const [hasMore, setHasMore] = useState(false);
   const [start, setStart] = useState('');
   const [end, setEnd] = useState('');
   const [ip, setIp] = useState('');
 
+  // 一覧は本文を含まない summary を取得し、表示時に版ごとの本文を取得する
+  const loadVersions = useCallback(
+    (before?: number) => {
+      const params = new URLSearchParams();
+      if (start) params.append('start_date', start);
+      if (end) params.append('end_date', `${end}T23:59`);
+      if (ip) params.append('ip_address', ip);
+      if (before !== undefined) params.append('before', String(before));
+      params.append('limit', String(PAGE_SIZE));
+      params.append('include_archived', 'true');
+      fetch(`${apiBase}/memos/${memoId}/versions/summary?${params.toString()}`)
+        .then((res) => res.json())
+        .then((data: VersionSummary[]) => {
+          setVersions((prev) => (before === undefined ? data : [...prev, ...data]));
+          setHasMore(data.length === PAGE_SIZE);
+        });
+    },
+    [memoId, start, end, ip],
+  );
+
   useEffect(() => {
     if (!isOpen) return;
-    const params = new URLSearchParams();
-    if (start) params.append('start_date', start);
-    if (end) params.append('end_date', `${end}T23:59`);
-    if (ip) params.append('ip_address', ip);
-    fetch(`${apiBase}/memos/${memoId}/versions?${params.toString()}`)
+    loadVersions();
+  }, [isOpen, loadVersions]);
+
+  const handleView = (v: VersionSummary) => {
+    fetch(`${apiBase}/memos/${memoId}/versions/${v.version_no}`)
       .then((res) => res.json())
-      .then((data: Version[]) => setVersions(data));
-  }, [memoId, isOpen, start, end, ip]);
+      .then((data: Version) => onView(data));
+  };
 
   return (
     <Transition appear show={isOpen} as={Fragment}>
@@ -81,7 +105,7 @@ export default function MemoHistoryModal({ memoId, isOpen, onClose, onRestore, o
                   <div className="space-x-2">
                     <button
                       className="px-2 py-1 bg-green-500 text-white text-sm rounded"
-                      onClick={() => onView(v)}
+                      onClick={() => handleView(v)}
                     >
                       表示
                     </button>
@@ -95,6 +119,16 @@ export default function MemoHistoryModal({ memoId, isOpen, onClose, onRestore, o
                 </li>
               ))}
             </ul>
+            {hasMore && (
+              <div className="flex justify-center mt-2">
+                <button
+                  className="px-2 py-1 bg-gray-200 text-sm rounded"
+                  onClick={() => loadVersions(versions[versions.length - 1].version_no)}
+                >
+                  さらに表示
+                </button>
+              </div>
+            )}
             <div className="flex justify-end mt-4">
               <button className="px-4 py-2 bg-gray-500 text-white rounded" onClick={onClose}>
                 閉じる
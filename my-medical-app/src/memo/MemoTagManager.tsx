@@ -140,6 +140,8 @@ export default function MemoTagManager() {
             <th className="border p-1">名前</th>
             <th className="border p-1">備考</th>
             <th className="border p-1">色</th>
+            <th className="border p-1">メモ</th>
+            <th className="border p-1">テンプレート</th>
             <th className="border p-1">操作</th>
           </tr>
         </thead>
@@ -164,6 +166,13 @@ export default function MemoTagManager() {
                   />
                 )}
               </td>
+              <td className="border p-1 text-right">
+                {tag.memo_count ?? 0}
+                {!!tag.deleted_memo_count && (
+                  <span className="text-gray-400">（削除済み {tag.deleted_memo_count}）</span>
+                )}
+              </td>
+              <td className="border p-1 text-right">{tag.template_count ?? 0}</td>
               <td className="border p-1 space-x-1">
                 <button className="px-1 bg-green-500 text-white" onClick={() => startEdit(tag)}>
                   編集
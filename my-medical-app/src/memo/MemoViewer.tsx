@@ -3,9 +3,21 @@ import Markdown from 'react-markdown';
 import remarkGfm from 'remark-gfm';
 import remarkBreaks from 'remark-breaks';
 import rehypeRaw from 'rehype-raw';
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
+import type { MouseEvent } from 'react';
 import ImageModal from '../components/ImageModal';
 
+const apiBase = import.meta.env.VITE_API_URL || 'http://localhost:8001';
+
+// サーバーに変換用のライブラリが無い (501) 場合はこの画面で Markdown を変換する
+let serverRendering = true;
+
+interface RenderedHtml {
+  id: number;
+  hash?: string;
+  html: string | null; // null は取得に失敗したもの
+}
+
 interface Props {
   memo: MemoItem | null;
   tagOptions: MemoTag[];
@@ -19,6 +31,31 @@ interface Props {
 export default function MemoViewer({ memo, tagOptions, childMemos = [], onEdit, onToggleDelete, onShowHistory, onSelectMemo }: Props) {
   const [imageSrc, setImageSrc] = useState<string | null>(null);
   const [imageAlt, setImageAlt] = useState<string>('');
+  const [rendered, setRendered] = useState<RenderedHtml | null>(null);
+  const memoId = memo?.id ?? 0;
+  const contentHash = memo?.content_hash;
+  const ready = memo !== null && memo.loaded !== false;
+
+  // サーバーで変換済みの HTML を取得する (ETag によりブラウザのキャッシュから再利用される)
+  useEffect(() => {
+    if (!memoId || !ready || !serverRendering) return;
+    let cancelled = false;
+    fetch(`${apiBase}/memos/${memoId}/html`)
+      .then((res) => {
+        if (res.status === 501) serverRendering = false;
+        return res.ok ? res.text() : Promise.reject(res);
+      })
+      .then((html) => {
+        if (!cancelled) setRendered({ id: memoId, hash: contentHash, html });
+      })
+      .catch(() => {
+        if (!cancelled) setRendered({ id: memoId, hash: contentHash, html: null });
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [memoId, contentHash, ready]);
+
   if (!memo) return <div className="flex-1 p-4">メモを選択してください</div>;
   const tagObjs = memo.tag_ids
     .map((id) => tagOptions.find((t) => t.id === id))
@@ -33,6 +70,18 @@ export default function MemoViewer({ memo, tagOptions, childMemos = [], onEdit,
     const yiq = (r * 299 + g * 587 + b * 114) / 1000;
     return yiq >= 128 ? '#000' : '#fff';
   };
+
+  const handleHtmlClick = (e: MouseEvent<HTMLDivElement>) => {
+    const target = e.target as HTMLElement;
+    if (target.tagName !== 'IMG') return;
+    setImageSrc(target.getAttribute('src') || '');
+    setImageAlt(target.getAttribute('alt') || '');
+  };
+  const current =
+    rendered && rendered.id === memo.id && rendered.hash === memo.content_hash
+      ? rendered
+      : null;
+  const useMarkdown = !serverRendering || (current !== null && current.html === null);
   return (
     <div className="flex-1 p-4 overflow-y-auto">
       <div className="flex justify-end mb-2 space-x-2">
@@ -84,28 +133,36 @@ export default function MemoViewer({ memo, tagOptions, childMemos = [], onEdit,
         </button>
       </div>
       <div className="prose max-w-none">
-        <Markdown
-          remarkPlugins={[remarkGfm, remarkBreaks]}
-          rehypePlugins={[rehypeRaw]}
-          components={{
-            img(props: React.ImgHTMLAttributes<HTMLImageElement>) {
-              const src = props.src || '';
-              const alt = props.alt as string | undefined;
-              return (
-                <img
-                  {...props}
-                  className="cursor-pointer max-w-full"
-                  onClick={() => {
-                    setImageSrc(src);
-                    setImageAlt(alt || '');
-                  }}
-                />
-              );
-            },
-          }}
-        >
-          {memo.content}
-        </Markdown>
+        {!useMarkdown ? (
+          <div
+            className="[&_img]:cursor-pointer [&_img]:max-w-full"
+            onClick={handleHtmlClick}
+            dangerouslySetInnerHTML={{ __html: current?.html ?? '' }}
+          />
+        ) : (
+          <Markdown
+            remarkPlugins={[remarkGfm, remarkBreaks]}
+            rehypePlugins={[rehypeRaw]}
+            components={{
+              img(props: React.ImgHTMLAttributes<HTMLImageElement>) {
+                const src = props.src || '';
+                const alt = props.alt as string | undefined;
+                return (
+                  <img
+                    {...props}
+                    className="cursor-pointer max-w-full"
+                    onClick={() => {
+                      setImageSrc(src);
+                      setImageAlt(alt || '');
+                    }}
+                  />
+                );
+              },
+            }}
+          >
+            {memo.content}
+          </Markdown>
+        )}
         {imageSrc && (
           <ImageModal
             src={imageSrc}
@@ -41,7 +41,8 @@ export default function TemplateSelectModal({ isOpen, tagOptions, onSelect, onCl
     fetch(`${apiBase}/memo-templates?${params.toString()}`)
       .then((res) => res.json())
       .then((data: Template[]) => {
-        data.sort((a, b) => a.sort_order - b.sort_order);
+        // 検索語がある場合はサーバー側の順位順のまま表示する
+        if (!search.trim()) data.sort((a, b) => a.sort_order - b.sort_order);
         setTemplates(data);
       });
   };